@@ -12,3 +12,8 @@ application = ProtocolTypeRouter({
         URLRouter(tokens.routing.websocket_urlpatterns)
     ),
 })
+
+# This process serves the queue: it may build the in-memory queue engine
+from tokens import engine  # noqa: E402
+
+engine.serve()
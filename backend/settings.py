@@ -174,6 +174,72 @@ SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ("Bearer",),
 }
 
+# ---------------- Channels ---------------- #
+CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+}
+
+# ---------------- Tokens ---------------- #
+# "sync" renders QR images inside the issuing request; "async" commits the
+# token first and renders the image on a background worker (tokens/tasks.py).
+QR_RENDER_MODE = os.environ.get("QR_RENDER_MODE", "sync")
+QR_RENDER_WORKERS = int(os.environ.get("QR_RENDER_WORKERS", "2"))
+# Size of the process pool that renders QR images (tokens.utils.QRRenderService);
+# 0 renders inline in the calling process.
+QR_RENDER_PROCESSES = int(os.environ.get("QR_RENDER_PROCESSES", "0"))
+QR_RENDER_START_METHOD = os.environ.get("QR_RENDER_START_METHOD", "spawn")
+# Recently rendered QR images, and image paths known to be stored, kept in memory per
+# process (tokens.utils.image_cache, tokens.utils.stored_paths)
+QR_IMAGE_CACHE_SIZE = int(os.environ.get("QR_IMAGE_CACHE_SIZE", "512"))
+
+# Configuration snapshot (tokens/config.py): each worker re-reads the shared version
+# row this often, and reloads a snapshot older than TOKEN_CONFIG_MAX_AGE regardless.
+TOKEN_CONFIG_CHECK_SECONDS = float(os.environ.get("TOKEN_CONFIG_CHECK_SECONDS", "1.0"))
+TOKEN_CONFIG_MAX_AGE = int(os.environ.get("TOKEN_CONFIG_MAX_AGE", "300"))
+
+# Optional in-memory queue engine (tokens/engine.py): dispatch and queue reads
+# are served from memory and written behind. Single-process deployments only; the
+# engine lives in the web process (backend/wsgi.py, backend/asgi.py), and cron
+# commands announce their changes through a shared epoch row instead.
+QUEUE_ENGINE = os.environ.get("QUEUE_ENGINE", "false").lower() in ("1", "true", "yes")
+QUEUE_ENGINE_FLUSH_INTERVAL = float(os.environ.get("QUEUE_ENGINE_FLUSH_INTERVAL", "0.5"))
+QUEUE_ENGINE_BATCH_SIZE = int(os.environ.get("QUEUE_ENGINE_BATCH_SIZE", "500"))
+
+# Departed positions listed per category for "people ahead" (tokens/positions.py); beyond
+# this many, a category counts its waiting tokens instead
+TOKEN_TOMBSTONE_LIMIT = int(os.environ.get("TOKEN_TOMBSTONE_LIMIT", "1000"))
+
+# Recent decisions kept by the cross-category scheduler (tokens/scheduling.py)
+TOKEN_SCHEDULER_LOG_SIZE = int(os.environ.get("TOKEN_SCHEDULER_LOG_SIZE", "200"))
+
+# Streaming wait-time statistics (tokens/estimates.py), one database row per series:
+# EWMA smoothing factor, and the longest gap between calls still counted as service.
+TOKEN_ESTIMATE_ALPHA = float(os.environ.get("TOKEN_ESTIMATE_ALPHA", "0.2"))
+TOKEN_ESTIMATE_MAX_INTERVAL = int(os.environ.get("TOKEN_ESTIMATE_MAX_INTERVAL", "1800"))
+
+# No-show sweep (tokens/noshow.py): how long a called token may go unanswered and what
+# happens to it ("noshow" or "requeue"), unless its category's schedule says otherwise.
+TOKEN_NO_SHOW_SECONDS = int(os.environ.get("TOKEN_NO_SHOW_SECONDS", "900"))
+TOKEN_NO_SHOW_ACTION = os.environ.get("TOKEN_NO_SHOW_ACTION", "noshow")
+TOKEN_NO_SHOW_BATCH_SIZE = int(os.environ.get("TOKEN_NO_SHOW_BATCH_SIZE", "500"))
+
+# Numbered WebSocket deltas kept per category, per process, for clients resuming after a
+# reconnect (tokens/notifications.py). Delta numbers come from the SharedSequence table, so
+# web workers and cron commands share one sequence per category.
+TOKEN_STREAM_REPLAY_SIZE = int(os.environ.get("TOKEN_STREAM_REPLAY_SIZE", "500"))
+
+# QR codes flagged per transaction by expire_qr_codes (tokens/expiry.py); run it from cron
+QR_EXPIRY_CHUNK_SIZE = int(os.environ.get("QR_EXPIRY_CHUNK_SIZE", "1000"))
+
+# Token-bucket limits on public-create/admin-generate (tokens/throttling.py): "30/min" allows
+# bursts of 30 refilled at 30 a minute. Buckets are database rows shared by every worker.
+TOKEN_ISSUANCE_RATES = {
+    "client": os.environ.get("TOKEN_ISSUANCE_CLIENT_RATE", "30/min"),
+    "category": os.environ.get("TOKEN_ISSUANCE_CATEGORY_RATE", "600/min"),
+}
+# Each worker counts its rejections in memory and adds them to the shared totals this often
+TOKEN_THROTTLED_FLUSH_SECONDS = float(os.environ.get("TOKEN_THROTTLED_FLUSH_SECONDS", "10"))
+
 # ---------------- CSRF ---------------- #
 CSRF_TRUSTED_ORIGINS = [
     "https://public-token-generate.netlify.app",
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# This process serves the queue: it may build the in-memory queue engine
+from tokens import engine  # noqa: E402
+
+engine.serve()
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0002_initial'),
+        ('tokens', '0029_qr_expired'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scan',
+            name='token_history',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='desk_scans', to='tokens.tokenhistory'),
+        ),
+        migrations.AlterField(
+            model_name='scan',
+            name='token',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='tokens.token'),
+        ),
+    ]
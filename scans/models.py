@@ -1,8 +1,12 @@
 from django.db import models
-from tokens.models import Token
+from tokens.models import Token, TokenHistory
 from users.models import User
 
 class Scan(models.Model):
-    token = models.ForeignKey(Token, on_delete=models.CASCADE)
+    token = models.ForeignKey(Token, on_delete=models.CASCADE, null=True, blank=True)
+    # Set instead of ``token`` once the token has been archived by the daily reset
+    token_history = models.ForeignKey(
+        TokenHistory, on_delete=models.SET_NULL, null=True, blank=True, related_name="desk_scans"
+    )
     scanned_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     scanned_at = models.DateTimeField(auto_now_add=True)
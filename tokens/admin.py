@@ -1,9 +1,8 @@
 from django.contrib import admin
 from django.db import models
 from django.utils.html import format_html
-from .models import Token, QRCode, QRScan, QRSettings
-from .utils import generate_qr_code
-from .models import QRSettings as QRSettingsModel
+from .models import Token, QRCode, QRScan, QRSettings, TokenSequence, TokenPool, SequenceLease, TokenHistory, TokenTransition, Counter, CategorySchedule
+from .issuance import issue_qr
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from .serializers import TokenSerializer  # Ensure you have this serializer
@@ -20,49 +19,14 @@ class TokenAdmin(admin.ModelAdmin):
         if not obj.issued_by:
             obj.issued_by = request.user
 
-        # Auto-generate token_id if not provided
-        if not obj.token_id:
-            last_token = Token.objects.filter(category=obj.category).order_by('-id').first()
-            next_id = 1 if not last_token else int(last_token.token_id[1:]) + 1
-            prefix = obj.category.name[0].upper()
-            obj.token_id = f"{prefix}{next_id:03d}"
-
-        # Auto-assign queue position
-        if not obj.queue_position:
-            max_position = Token.objects.filter(
-                category=obj.category,
-                status='waiting'
-            ).aggregate(models.Max('queue_position'))['queue_position__max']
-            obj.queue_position = 1 if max_position is None else max_position + 1
+        # token_id and queue_position are allocated from the category's
+        # TokenSequence inside Token.save()
 
         super().save_model(request, obj, form, change)
 
-        # Auto-generate QRCode if it does not exist
-        if not QRCode.objects.filter(token=obj).exists():
-            qr_settings = QRSettingsModel.objects.first()
-            qr_data, checksum, file = generate_qr_code(obj, qr_settings)
-
-            format_value = qr_settings.default_format if qr_settings else 'PNG'
-
-            # Properly serialize payload (no model instances)
-            payload_data = {
-                "token_id": obj.token_id,
-                "category_id": obj.category.id,
-                "category_name": obj.category.name,
-                "category_color": getattr(obj.category, 'color', None),
-                "expires_at": qr_data.get("expires_at"),
-            }
-
-            QRCode.objects.create(
-                token=obj,
-                category=obj.category,  # ForeignKey assignment is safe
-                expires_at=qr_data["expires_at"],
-                checksum=checksum,
-                payload=payload_data,
-                image=file,
-                format=format_value,
-                created_by=obj.issued_by
-            )
+        # New tokens get their QR inside Token.save(); backfill older tokens that have none
+        if obj.source != "manual" and not QRCode.objects.filter(token=obj).exists():
+            issue_qr(obj)
 
     # Example for a custom admin view or API endpoint
     @action(detail=False, methods=["get"], url_path="admin-tokens")
@@ -101,3 +65,49 @@ class QRScanAdmin(admin.ModelAdmin):
 @admin.register(QRSettings)
 class QRSettingsAdmin(admin.ModelAdmin):
     list_display = ('size', 'border', 'error_correction', 'expiry_hours')  # Only use actual model fields
+
+
+@admin.register(TokenSequence)
+class TokenSequenceAdmin(admin.ModelAdmin):
+    list_display = ('category', 'prefix', 'next_number', 'next_position', 'serving_position', 'buried', 'reset_at', 'updated_at')
+    readonly_fields = ('serving_position', 'buried', 'reset_at', 'updated_at')
+
+
+@admin.register(TokenPool)
+class TokenPoolAdmin(admin.ModelAdmin):
+    list_display = ('category', 'enabled', 'size', 'refill_threshold', 'hits', 'misses', 'hit_rate', 'last_refilled_at')
+    readonly_fields = ('hits', 'misses', 'last_refilled_at')
+
+
+@admin.register(CategorySchedule)
+class CategoryScheduleAdmin(admin.ModelAdmin):
+    list_display = ('category', 'weight', 'priority', 'max_wait_seconds', 'no_show_seconds', 'no_show_action')
+
+
+@admin.register(SequenceLease)
+class SequenceLeaseAdmin(admin.ModelAdmin):
+    list_display = ('kiosk_id', 'category', 'prefix', 'start_number', 'count', 'high_water', 'status', 'expires_at')
+    list_filter = ('status', 'category')
+
+
+@admin.register(TokenHistory)
+class TokenHistoryAdmin(admin.ModelAdmin):
+    list_display = ('token_id', 'category', 'status', 'issued_at', 'archived_at')
+    list_filter = ('status', 'category')
+    search_fields = ('token_id',)
+    date_hierarchy = 'issued_at'
+
+
+@admin.register(TokenTransition)
+class TokenTransitionAdmin(admin.ModelAdmin):
+    list_display = ('token', 'category', 'from_status', 'to_status', 'counter', 'actor', 'at')
+    list_filter = ('to_status', 'category')
+    date_hierarchy = 'at'
+
+
+@admin.register(Counter)
+class CounterAdmin(admin.ModelAdmin):
+    list_display = ('name', 'staff', 'current_token', 'is_active', 'updated_at')
+    list_filter = ('is_active', 'categories')
+    filter_horizontal = ('categories',)
+    raw_id_fields = ('current_token',)
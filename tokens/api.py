@@ -2,6 +2,10 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from .config import get_config
+from .engine import get_engine
+from .emergency import pause_queue, resume_all, clear_queue
+from .estimates import WaitEstimator
 from .models import Token, QRCode, QRScan
 from users.models import Category
 from users.serializers import CategorySerializer
@@ -16,11 +20,19 @@ class QueueViewSet(viewsets.ViewSet):
         """
         Live queue monitoring: List all tokens by category and status, with QR code status.
         """
+        engine = get_engine()
+        if engine is not None:
+            tokens = [record.as_token() for record in engine.tokens()]
+        else:
+            tokens = Token.objects.filter(status='waiting').order_by('queue_position')
+        by_category = {}
+        for token in tokens:
+            by_category.setdefault(token.category_id, []).append(token)
         data = []
-        for category in Category.objects.all():
-            tokens = Token.objects.filter(category=category, status='waiting').order_by('queue_position')
+        for category in get_config().categories.values():
             tokens_data = []
-            for token in tokens:
+            estimator = WaitEstimator(category.pk)
+            for ahead, token in enumerate(by_category.get(category.pk, [])):
                 qr_status = "generated" if hasattr(token, "qr_code") else "pending"
                 tokens_data.append({
                     "token_id": token.token_id,
@@ -28,6 +40,7 @@ class QueueViewSet(viewsets.ViewSet):
                     "status": token.status,
                     "issued_at": token.issued_at,
                     "qr_status": qr_status,
+                    **estimator.payload(ahead),
                 })
             data.append({
                 "category": CategorySerializer(category).data,
@@ -71,23 +84,18 @@ class QueueViewSet(viewsets.ViewSet):
         """
         action_type = request.data.get("action")
         category_id = request.data.get("category_id")
-        if category_id:
-            try:
-                category = Category.objects.get(pk=category_id)
-            except Category.DoesNotExist:
-                return Response({"detail": "Category not found."}, status=404)
-            tokens = Token.objects.filter(category=category)
-        else:
-            tokens = Token.objects.all()
+        if category_id and not Category.objects.filter(pk=category_id).exists():
+            return Response({"detail": "Category not found."}, status=404)
 
+        actor_id = request.user.pk
         if action_type == "pause":
-            tokens.update(status="waiting")
+            pause_queue(category_id, statuses=("called", "inprogress"), actor_id=actor_id)
             return Response({"detail": "Queue paused."})
         elif action_type == "resume":
-            tokens.filter(status="waiting").update(status="inprogress")
+            resume_all(category_id, actor_id=actor_id)
             return Response({"detail": "Queue resumed."})
         elif action_type == "clear":
-            tokens.delete()
+            clear_queue(category_id)
             return Response({"detail": "Queue cleared."})
         else:
             return Response({"detail": "Invalid action."}, status=400)
@@ -0,0 +1,93 @@
+from collections import namedtuple
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from users.models import Category
+from .models import QRSettings, CategorySchedule, SharedSequence
+
+
+CONFIG_VERSION_KEY = "tokens-config-version"
+# How long a worker trusts its snapshot before re-reading the shared version
+CONFIG_CHECK_INTERVAL = getattr(settings, "TOKEN_CONFIG_CHECK_SECONDS", 1.0)
+# Snapshots older than this are reloaded even if the version has not moved
+CONFIG_MAX_AGE = getattr(settings, "TOKEN_CONFIG_MAX_AGE", 300)
+
+_snapshot = None
+_checked_at = 0.0
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+class ConfigSnapshot(namedtuple("ConfigSnapshot", ["version", "qr_settings", "categories", "schedules"])):
+    """
+    Read-only view of ``QRSettings``, every ``Category`` and every
+    ``CategorySchedule`` (keyed by category id) at one version.
+    The model instances are shared between requests and must not be modified.
+    """
+
+    def category(self, category_id):
+        """Like ``Category.objects.get(id=...)`` without the query."""
+        try:
+            return self.categories[int(category_id)]
+        except (KeyError, TypeError, ValueError):
+            raise Category.DoesNotExist(f"Category {category_id!r} does not exist")
+
+
+def get_config():
+    """
+    The current configuration snapshot, loaded once per worker and reloaded
+    after any worker saves or deletes ``QRSettings``, a ``Category`` or a
+    ``CategorySchedule``. The version lives in the database, so every worker
+    notices a change within ``CONFIG_CHECK_INTERVAL``; a snapshot is reloaded
+    after ``CONFIG_MAX_AGE`` seconds regardless.
+    """
+    global _snapshot, _checked_at, _loaded_at
+    snapshot, now = _snapshot, time.monotonic()
+    if snapshot is not None and now - _checked_at < CONFIG_CHECK_INTERVAL:
+        return snapshot
+    with _lock:
+        # Read the version before the rows so a concurrent change is picked up on the next check
+        version = SharedSequence.read(CONFIG_VERSION_KEY)
+        if _snapshot is None or _snapshot.version != version or now - _loaded_at >= CONFIG_MAX_AGE:
+            _snapshot = ConfigSnapshot(
+                version,
+                QRSettings.objects.first(),
+                {category.pk: category for category in Category.objects.order_by("pk")},
+                {schedule.category_id: schedule for schedule in CategorySchedule.objects.all()},
+            )
+            _loaded_at = now
+        _checked_at = now
+        return _snapshot
+
+
+def current_qr_settings():
+    return get_config().qr_settings
+
+
+def invalidate_config():
+    """
+    Bump the shared version in the transaction making the change, so other
+    workers reload once it commits, and drop this worker's snapshot now and
+    again on commit.
+    """
+    global _snapshot
+    SharedSequence.advance(CONFIG_VERSION_KEY)
+    _snapshot = None
+
+    def drop():
+        global _snapshot
+        _snapshot = None
+
+    transaction.on_commit(drop)
+
+
+@receiver([post_save, post_delete], sender=QRSettings, dispatch_uid="tokens-config-qrsettings")
+@receiver([post_save, post_delete], sender=Category, dispatch_uid="tokens-config-category")
+@receiver([post_save, post_delete], sender=CategorySchedule, dispatch_uid="tokens-config-schedule")
+def _config_changed(sender, **kwargs):
+    invalidate_config()
@@ -1,14 +1,97 @@
 import json
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .config import get_config
+from .notifications import ADMIN_GROUP, STAFF_GROUP, category_group, current_seq, missed, remember
+from .stream import snapshot
+
+
+def _ids(values):
+    return [int(part) for value in values for part in value.split(",") if part.strip().isdigit()]
+
+
+def _resume_points(values):
+    # "1:1234,2:99" -> {1: 1234, 2: 99}
+    points = {}
+    for value in values:
+        for part in value.split(","):
+            category_id, _, seq = part.partition(":")
+            if category_id.strip().isdigit() and seq.strip().isdigit():
+                points[int(category_id)] = int(seq)
+    return points
+
+
 class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    Live events, one channel group per category. Connect with
+    ``?categories=1,2`` to watch those categories (a department display);
+    without it, staff watch the categories they are assigned and anonymous
+    displays watch every category. Staff also join the staff group for scan
+    events; admins without a category filter join only the admin group,
+    which receives every event once.
+
+    For each watched category the socket first gets a ``snapshot`` of the
+    line, then deltas carrying ``category_id`` and a ``seq`` that rises by
+    one per event. A client reconnecting with ``?resume=1:<seq>,2:<seq>``
+    (the last ``seq`` it applied per category) gets only the deltas it
+    missed, replayed from the bounded ring this process fills as it
+    broadcasts and receives deltas, or a fresh snapshot if they are no
+    longer all held.
+    """
+
     async def connect(self):
-        self.group_name = "notifications"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.subscriptions, self.categories = await self._subscriptions(_ids(query.get("categories", [])))
+        for group in self.subscriptions:
+            await self.channel_layer.group_add(group, self.channel_name)
         await self.accept()
+        # Deltas numbered up to here were covered by the snapshot or replay; later ones go out as they come
+        self.baseline = {}
+        resume = _resume_points(query.get("resume", []))
+        for category_id in self.categories:
+            messages = None
+            if category_id in resume:
+                latest = await database_sync_to_async(current_seq)(category_id)
+                messages = missed(category_id, resume[category_id], latest)
+                self.baseline[category_id] = latest
+            if messages is None:
+                messages = [await database_sync_to_async(snapshot)(category_id)]
+                self.baseline[category_id] = messages[0]["seq"]
+            for message in messages:
+                await self.send(text_data=json.dumps(message))
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        for group in getattr(self, "subscriptions", ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
 
     async def send_notification(self, event):
-        await self.send(text_data=json.dumps(event["message"]))
+        message = event["message"]
+        if "seq" in message:
+            # Deltas broadcast by other processes reach the ring here
+            remember(message)
+            if message["seq"] <= self.baseline.get(message["category_id"], 0):
+                return
+        await self.send(text_data=json.dumps(message))
+
+    @database_sync_to_async
+    def _subscriptions(self, requested):
+        # ``(groups, category_ids)`` this socket joins
+        user = self.scope.get("user")
+        role = getattr(user, "role", None) if user is not None and user.is_authenticated else None
+        is_admin = role == "admin" or getattr(user, "is_superuser", False)
+        known = get_config().categories
+        if requested:
+            ids = [category_id for category_id in dict.fromkeys(requested) if category_id in known]
+        elif is_admin:
+            return [ADMIN_GROUP], []
+        elif role == "staff":
+            ids = list(user.categories.values_list("pk", flat=True))
+        else:
+            ids = list(known)
+        groups = [category_group(category_id) for category_id in ids]
+        if role == "staff":
+            groups.append(STAFF_GROUP)
+        return groups, ids
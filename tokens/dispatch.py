@@ -0,0 +1,329 @@
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from users.models import Category
+from .config import get_config
+from .engine import get_engine
+from .estimates import record_call, record_service
+from .models import Token, TokenSequence, Counter
+from .notifications import broadcast, broadcast_tokens
+from .positions import advance_serving, tombstone
+from .scheduling import scheduler
+from .transitions import Changed, TransitionError, transition, transition_many
+
+
+Dispatch = namedtuple("Dispatch", ["completed", "token"])
+
+
+class CounterError(Exception):
+    pass
+
+
+def complete_tokens(pks, counter_id=None, actor_id=None):
+    """
+    Mark the tokens with primary keys ``pks`` completed unless they already
+    are. Each token is completed by a conditional UPDATE, so a token
+    completed by two desks at once is reported by only one of them.
+    ``counter_id`` and ``actor_id`` are the desk and user completing them,
+    for the transition log and the desk's service-time statistics. Returns
+    the completed token_ids.
+    """
+    pks = list(pks)
+    if not pks:
+        return []
+    engine = get_engine()
+    if engine is not None:
+        with engine.lock:
+            rows = _engine_rows(engine, pks)
+            completed = engine.complete(pks, actor_id, counter_id)
+        _completed(rows, counter_id, engine=True)
+        broadcast_tokens("completed", ((row.category_id, row.token_id, row.queue_position) for row in rows))
+        return completed
+    with transaction.atomic():
+        rows = transition_many(pks, "completed", counter_id=counter_id, actor_id=actor_id)
+        _completed(rows, counter_id)
+    return [row.token_id for row in rows]
+
+
+def _engine_rows(engine, pks):
+    # What transition_many returns, for the tokens in ``pks`` the engine still holds
+    records = (engine.records.get(pk) for pk in pks)
+    return [
+        Changed(r.pk, r.token_id, r.category_id, r.queue_position, r.called_at, r.status)
+        for r in records if r is not None
+    ]
+
+
+def _completed(rows, counter_id=None, engine=False):
+    # Waiting tokens completed directly leave the line out of order (transition_many records that itself,
+    # the engine does not); called ones finished a service
+    if engine:
+        tombstone((row.category_id, row.queue_position) for row in rows if row.from_status == "waiting")
+    if rows:
+        # A desk serving a completed token is idle again, however the token was completed
+        Counter.objects.filter(current_token_id__in=[row.pk for row in rows]).update(
+            current_token=None, updated_at=timezone.now(),
+        )
+    record_service([(row.category_id, row.called_at) for row in rows if row.from_status != "waiting"], counter_id)
+
+
+def called_tokens(category_ids, called_by):
+    """
+    Primary keys of the tokens ``called_by`` currently has called in
+    ``category_ids`` (``None`` for all). Tokens nobody called (manual ones,
+    heads resumed after an emergency) belong to no desk, so without a user
+    this is empty.
+    """
+    if called_by is None:
+        return []
+    engine = get_engine()
+    if engine is not None:
+        return engine.called_by(category_ids, called_by.pk)
+    tokens = Token.objects.filter(status="called", called_by=called_by)
+    if category_ids is not None:
+        tokens = tokens.filter(category_id__in=category_ids)
+    return list(tokens.values_list("pk", flat=True))
+
+
+def waiting_heads(category_ids):
+    """
+    ``{category_id: issued_at}`` of the first waiting token in each of
+    ``category_ids`` (``None`` for all) that has one. One query, one index
+    probe per category.
+    """
+    ids = list(get_config().categories) if category_ids is None else list(category_ids)
+    head = Token.objects.filter(category_id=OuterRef("pk"), status="waiting").order_by("queue_position")
+    rows = (
+        Category.objects.filter(pk__in=ids)
+        .annotate(head_issued_at=Subquery(head.values("issued_at")[:1]))
+        .filter(head_issued_at__isnull=False)
+        .values_list("pk", "head_issued_at")
+    )
+    return dict(rows)
+
+
+def _claim_first(queue):
+    return queue.select_for_update(skip_locked=True).filter(status="waiting").order_by("queue_position").first()
+
+
+def dispatch_next(category_ids, called_by=None, complete=(), counter_id=None):
+    """
+    Claim the next waiting token in ``category_ids`` (the categories a desk
+    serves; ``None`` for all) and mark it called by ``called_by``.
+
+    With more than one category the scheduler (tokens/scheduling.py) picks
+    the category by priority, weight and aging; within a category tokens
+    go in queue order. The claim takes the row with ``SELECT ... FOR UPDATE
+    SKIP LOCKED``, so desks calling at the same moment each get a different
+    token instead of queueing behind one another. ``complete`` holds
+    primary keys of tokens to complete in the same transaction, by desk
+    ``counter_id`` if one is calling. With the
+    queue engine enabled both steps happen in memory under the engine lock.
+    Returns ``Dispatch(completed, token)``; ``token`` is ``None`` when
+    nobody is waiting.
+    """
+    engine = get_engine()
+    if engine is not None:
+        complete = list(complete)
+        with engine.lock:
+            rows = _engine_rows(engine, complete)
+            completed, record = engine.dispatch(
+                None if category_ids is None else set(category_ids), called_by.pk if called_by else None, complete,
+                counter_id,
+            )
+        _completed(rows, counter_id, engine=True)
+        broadcast_tokens("completed", ((row.category_id, row.token_id, row.queue_position) for row in rows))
+        if record is not None:
+            advance_serving(record.category_id, record.queue_position)
+            record_call(record.category_id, record.called_at)
+            broadcast_tokens("called", [(record.category_id, record.token_id, record.queue_position)])
+        return Dispatch(completed, record.as_token() if record else None)
+
+    now = timezone.now()
+    with transaction.atomic():
+        completed = complete_tokens(complete, counter_id, called_by.pk if called_by else None)
+        if category_ids is not None and len(category_ids) == 1:
+            token = _claim_first(Token.objects.filter(category_id__in=category_ids))
+        else:
+            token = None
+            ranking = scheduler.order(waiting_heads(category_ids), now)
+            for candidate in ranking:
+                # A category whose waiting rows are all locked by other desks is passed over
+                token = _claim_first(Token.objects.filter(category_id=candidate.category_id))
+                if token is not None:
+                    scheduler.charge(ranking, candidate, called_by.pk if called_by else None, now)
+                    break
+        if token is not None:
+            # The row is locked by the claim, so the conditional UPDATE cannot miss
+            transition(
+                token.pk, "called", ("waiting",), counter_id, called_by.pk if called_by else None, now,
+                called_by_id=called_by.pk if called_by else None, called_at=now,
+            )
+            token.status, token.called_by, token.called_at, token.updated_at = "called", called_by, now, now
+            advance_serving(token.category_id, token.queue_position)
+            record_call(token.category_id, now)
+    return Dispatch(completed, token)
+
+
+def call_token(token, called_by=None):
+    """Call one specific waiting token. Returns ``False`` if another desk got to it first."""
+    engine = get_engine()
+    if engine is not None:
+        record = engine.call(token.pk, called_by.pk if called_by else None)
+        if record is None:
+            return False
+        token.status, token.called_by, token.called_at, token.updated_at = "called", called_by, record.called_at, record.updated_at
+        tombstone([(token.category_id, token.queue_position)])
+        record_call(token.category_id, record.called_at)
+        broadcast_tokens("called", [(token.category_id, token.token_id, token.queue_position)])
+        return True
+    now = timezone.now()
+    called_by_id = called_by.pk if called_by else None
+    called = transition(
+        token.pk, "called", ("waiting",), actor_id=called_by_id, now=now, called_by_id=called_by_id, called_at=now,
+    )
+    if called:
+        token.status, token.called_by, token.called_at, token.updated_at = "called", called_by, now, now
+        record_call(token.category_id, now)
+    return bool(called)
+
+
+def flush_engine():
+    # Pending engine transitions must reach the table before a row is read and saved directly
+    engine = get_engine()
+    if engine is not None:
+        engine.flush()
+
+
+def display_payload(counter, token):
+    """``token X -> desk N`` as sent to the displays; ``token`` may be ``None`` for an idle desk."""
+    category = get_config().categories.get(token.category_id) if token else None
+    return {
+        "counter": {"id": counter.pk, "name": counter.name},
+        "token_id": token.token_id if token else None,
+        "category": {"id": category.id, "name": category.name} if category else None,
+    }
+
+
+def announce(counter, token, event="token_called"):
+    payload = dict(display_payload(counter, token), event=event)
+    transaction.on_commit(lambda: broadcast(payload, token.category_id))
+
+
+def _lock_counter(counter_id):
+    counter = Counter.objects.select_for_update().filter(pk=counter_id, is_active=True).first()
+    if counter is None:
+        raise CounterError("Counter not found or inactive")
+    return counter
+
+
+def counter_call_next(counter_id, called_by=None, complete=()):
+    """
+    Complete the token ``counter_id`` is serving (and the tokens ``complete``)
+    and call the next one from the categories it serves, all in one
+    transaction with the desk row locked. Returns ``Dispatch(completed, token)``.
+    """
+    with transaction.atomic():
+        counter = _lock_counter(counter_id)
+        complete = {*complete, *([counter.current_token_id] if counter.current_token_id else [])}
+        result = dispatch_next(
+            list(counter.categories.values_list("pk", flat=True)),
+            called_by=called_by or counter.staff,
+            complete=sorted(complete),
+            counter_id=counter.pk,
+        )
+        counter.current_token = result.token
+        counter.save(update_fields=["current_token", "updated_at"])
+        if result.token is not None:
+            announce(counter, result.token)
+    return result
+
+
+def counter_complete(counter_id):
+    """Complete the token ``counter_id`` is serving and leave the desk idle. Returns the completed token_ids."""
+    with transaction.atomic():
+        counter = _lock_counter(counter_id)
+        if counter.current_token_id is None:
+            return []
+        completed = complete_tokens([counter.current_token_id], counter_id=counter.pk, actor_id=counter.staff_id)
+        counter.current_token = None
+        counter.save(update_fields=["current_token", "updated_at"])
+    return completed
+
+
+def counter_recall(counter_id):
+    """Announce the desk's current token again (the customer did not come up). Returns the token."""
+    flush_engine()
+    with transaction.atomic():
+        counter = _lock_counter(counter_id)
+        token = counter.current_token
+        if token is None:
+            raise CounterError("Counter is not serving a token")
+        token.called_at = timezone.now()
+        token.save(update_fields=["called_at", "updated_at"])
+        announce(counter, token, event="token_recalled")
+    return token
+
+
+def counter_transfer(counter_id, to_counter_id=None, to_category=None):
+    """
+    Hand the desk's current token to another idle desk, or send it to the
+    back of another category's queue as waiting. Returns the token.
+    """
+    if (to_counter_id is None) == (to_category is None):
+        raise CounterError("Give either a target counter or a target category")
+    try:
+        counter_id = int(counter_id)
+        to_counter_id = int(to_counter_id) if to_counter_id is not None else None
+    except (TypeError, ValueError):
+        raise CounterError("Counter ids must be integers")
+    flush_engine()
+    with transaction.atomic():
+        # Lock both desks in id order so two opposite transfers cannot deadlock
+        ids = sorted({counter_id, to_counter_id} - {None})
+        locked = {c.pk: c for c in Counter.objects.select_for_update().filter(pk__in=ids, is_active=True)}
+        counter = locked.get(counter_id)
+        if counter is None or counter.current_token is None:
+            raise CounterError("Counter is not serving a token")
+        token = counter.current_token
+        now = timezone.now()
+        if to_counter_id is not None:
+            target = locked.get(to_counter_id)
+            if target is None or target.pk == counter.pk:
+                raise CounterError("Target counter not found or inactive")
+            if target.current_token_id is not None:
+                raise CounterError(f"{target.name} is already serving a token")
+            counter.current_token = None
+            counter.save(update_fields=["current_token", "updated_at"])
+            target.current_token = token
+            target.save(update_fields=["current_token", "updated_at"])
+            token.called_by, token.called_at = target.staff, now
+            token.save(update_fields=["called_by", "called_at", "updated_at"])
+            announce(target, token)
+        else:
+            counter.current_token = None
+            counter.save(update_fields=["current_token", "updated_at"])
+            position = TokenSequence.allocate(to_category, numbers=False).position()
+            try:
+                moved = transition(
+                    token.pk, "waiting", (token.status,), counter.pk, counter.staff_id, now,
+                    category_id=to_category.pk, queue_position=position, called_by_id=None, called_at=None,
+                )
+            except TransitionError as exc:
+                raise CounterError(str(exc))
+            if moved is None:
+                raise CounterError("Token changed status during the transfer")
+            # The old position stays empty in the old line
+            tombstone([(token.category_id, token.queue_position)])
+            token.category, token.status, token.queue_position = to_category, "waiting", position
+            token.called_by, token.called_at, token.updated_at = None, None, now
+    return token
+
+
+def now_serving():
+    """Display rows for every active desk that is serving a token; one join by primary key, no token scan."""
+    counters = Counter.objects.filter(is_active=True, current_token__isnull=False).select_related("current_token")
+    return [display_payload(counter, counter.current_token) for counter in counters]
@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from users.models import Category
+from .dispatch import flush_engine
+from .engine import tokens_changed
+from .models import Token
+from .notifications import broadcast_each
+from .positions import resync_categories
+from .transitions import sources, transition_matching
+
+
+def _scope(category_id=None):
+    tokens = Token.objects.all()
+    if category_id:
+        tokens = tokens.filter(category_id=category_id)
+    return tokens
+
+
+def _apply(selected, status, expected, action, category_id=None, actor_id=None):
+    """
+    Move the tokens of ``selected`` from ``expected`` to ``status`` with one
+    set-based UPDATE per expected status, the transition log written by
+    INSERT ... SELECT (see ``transition_matching``), then resync the cursors
+    and send one ``queue_emergency`` notification per category once it
+    commits. Returns the number of tokens changed.
+    """
+    flush_engine()
+    with transaction.atomic():
+        now = timezone.now()
+        changes = {"called_at": now} if status == "called" else {}
+        rows = transition_matching(selected, status, expected, actor_id=actor_id, now=now, **changes)
+        if not rows:
+            return 0
+        by_category = defaultdict(list)
+        for row in rows:
+            by_category[row.category_id].append(row.token_id)
+        message = {"event": "queue_emergency", "action": action, "status": status}
+        transaction.on_commit(lambda: _applied(by_category, message))
+    return len(rows)
+
+
+def _applied(by_category, message):
+    resync_categories(list(by_category))
+    broadcast_each(message, by_category)
+
+
+def pause_queue(category_id=None, statuses=("called",), actor_id=None):
+    """
+    Send tokens in ``statuses`` (``"called"`` and ``"inprogress"`` at most)
+    back to waiting, in one category or all of them. Completed tokens and
+    no-shows are never touched.
+    """
+    statuses = sources("waiting", statuses)
+    return _apply(_scope(category_id), "waiting", statuses, "pause", category_id, actor_id)
+
+
+def resume_heads(category_id=None, actor_id=None):
+    """
+    Call the first waiting token of every category at once. The heads are
+    picked by one subquery probing each category's queue index, so the
+    cost does not grow with the number of categories.
+    """
+    head = (
+        Token.objects.filter(category_id=OuterRef("pk"), status="waiting")
+        .order_by("queue_position").values("pk")[:1]
+    )
+    categories = Category.objects.all()
+    if category_id:
+        categories = categories.filter(pk=category_id)
+    heads = categories.annotate(head=Subquery(head)).filter(head__isnull=False).values("head")
+    selected = Token.objects.filter(pk__in=Subquery(heads))
+    return _apply(selected, "called", ("waiting",), "resume", category_id, actor_id)
+
+
+def resume_all(category_id=None, status="inprogress", actor_id=None):
+    """Move every waiting token to ``status`` in one statement."""
+    return _apply(_scope(category_id), status, ("waiting",), "resume", category_id, actor_id)
+
+
+def clear_queue(category_id=None):
+    """Delete the tokens of one category or all of them. Returns the count deleted."""
+    flush_engine()
+    tokens = _scope(category_id)
+    with transaction.atomic():
+        rows = list(tokens.values_list("pk", "token_id", "category_id"))
+        if not rows:
+            return 0
+        pks = [pk for pk, _, _ in rows]
+        Token.objects.filter(pk__in=pks).delete()
+        tokens_changed(pks)
+        by_category = defaultdict(list)
+        for _, token_id, cat_id in rows:
+            by_category[cat_id].append(token_id)
+        message = {"event": "queue_emergency", "action": "clear"}
+        transaction.on_commit(lambda: _applied(by_category, message))
+    return len(pks)
@@ -0,0 +1,472 @@
+from collections import defaultdict
+import heapq
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Token, QRCode, SharedSequence
+from .scheduling import scheduler
+from .transitions import Transition, TransitionError, log_transitions, sources
+
+
+logger = logging.getLogger(__name__)
+
+ENGINE_EPOCH_KEY = "queue-engine-epoch"
+ACTIVE_STATUSES = ("waiting", "called", "inprogress")
+PERSISTED_FIELDS = ["status", "called_by", "called_at", "updated_at"]
+
+
+class TokenRecord:
+    """Hot state for one token; mirrors the Token columns queue views need."""
+    __slots__ = (
+        "pk", "token_id", "category_id", "queue_position", "status", "issued_at", "source",
+        "called_by_id", "called_at", "updated_at", "qr_image", "qr_status", "stored_status",
+    )
+
+    def __init__(self, pk, token_id, category_id, queue_position, status, issued_at, source,
+                 called_by_id=None, called_at=None, updated_at=None, qr_image=None, qr_status=None):
+        self.pk = pk
+        self.token_id = token_id
+        self.category_id = category_id
+        self.queue_position = queue_position
+        self.status = status
+        self.issued_at = issued_at
+        self.source = source
+        self.called_by_id = called_by_id
+        self.called_at = called_at
+        self.updated_at = updated_at
+        self.qr_image = qr_image
+        self.qr_status = qr_status
+        # The status the table holds for this token, as far as the engine knows
+        self.stored_status = status
+
+    @classmethod
+    def from_token(cls, token):
+        qr_code = getattr(token, "qr_code", None)
+        return cls(
+            token.pk, token.token_id, token.category_id, token.queue_position, token.status,
+            token.issued_at, token.source, token.called_by_id, token.called_at, token.updated_at,
+            qr_code.image.name if qr_code is not None and qr_code.image else None,
+            qr_code.render_status if qr_code is not None else None,
+        )
+
+    def as_token(self):
+        """An unsaved-looking Token instance carrying this record's values (no query)."""
+        from .config import get_config
+
+        token = Token(
+            pk=self.pk, token_id=self.token_id, category_id=self.category_id,
+            queue_position=self.queue_position, status=self.status, issued_at=self.issued_at,
+            source=self.source, called_by_id=self.called_by_id, called_at=self.called_at,
+            updated_at=self.updated_at,
+        )
+        token._state.adding = False
+        category = get_config().categories.get(self.category_id)
+        if category is not None:
+            token.category = category
+        if self.qr_status is not None:
+            token.qr_code = QRCode(token=token, category_id=self.category_id, image=self.qr_image, render_status=self.qr_status)
+        return token
+
+
+class QueueEngine:
+    """
+    In-memory queue state, enabled with ``QUEUE_ENGINE = True``.
+
+    Every token that is not completed is held as a ``TokenRecord``, with one
+    heap of waiting tokens per category, so dispatch is O(log n) and queue
+    reads make no queries. Transitions are applied here first and written
+    behind, together with their transition log rows, in batched
+    transactions by a flusher thread.
+
+    The engine is authoritative within one process only, so enable it for
+    single-worker deployments. Only the process serving the queue builds
+    one (see ``serve``); other processes, such as cron commands, bump a
+    shared epoch in the database when they change tokens, and the engine
+    rebuilds when it sees a new one.
+    """
+
+    def __init__(self, flush_interval=0.5, batch_size=500):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.records = {}               # pk -> TokenRecord, active tokens only
+        self.heaps = defaultdict(list)  # category_id -> [(queue_position, pk)], stale entries skipped lazily
+        self.pending = {}               # pk -> TokenRecord awaiting write-behind
+        self.log = []                   # Transitions awaiting write-behind with their rows
+        self.epoch = None
+        self._wake = threading.Event()
+        self._flusher = None
+
+    # ---- loading ----
+
+    def rebuild(self):
+        """Load all active tokens and their QR state with two queries, then heapify per category."""
+        self.flush()
+        epoch = SharedSequence.read(ENGINE_EPOCH_KEY)
+        rows = Token.objects.filter(status__in=ACTIVE_STATUSES).values_list(
+            "pk", "token_id", "category_id", "queue_position", "status", "issued_at", "source",
+            "called_by_id", "called_at", "updated_at",
+        )
+        records = {row[0]: TokenRecord(*row) for row in rows.iterator(chunk_size=2000)}
+        qr_rows = QRCode.objects.filter(token__status__in=ACTIVE_STATUSES).order_by("id").values_list(
+            "token_id", "image", "render_status",
+        )
+        for token_pk, image, render_status in qr_rows.iterator(chunk_size=2000):
+            record = records.get(token_pk)
+            if record is not None:
+                record.qr_image, record.qr_status = image or None, render_status
+        heaps = defaultdict(list)
+        for record in records.values():
+            if record.status == "waiting":
+                heaps[record.category_id].append((record.queue_position, record.pk))
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        with self.lock:
+            self.records, self.heaps, self.epoch = records, heaps, epoch
+        logger.info("Queue engine rebuilt with %d active tokens", len(records))
+
+    def track(self, tokens):
+        """Add newly issued tokens (after their transaction committed)."""
+        with self.lock:
+            for token in tokens:
+                self._put(TokenRecord.from_token(token))
+
+    def refresh(self, pks):
+        """Re-read tokens changed in the database outside the engine."""
+        self.flush()
+        self._reload(pks)
+
+    def _reload(self, pks):
+        pks = list(pks)
+        rows = Token.objects.filter(pk__in=pks).values_list(
+            "pk", "token_id", "category_id", "queue_position", "status", "issued_at", "source",
+            "called_by_id", "called_at", "updated_at",
+        )
+        fresh = {row[0]: TokenRecord(*row) for row in rows}
+        with self.lock:
+            reloaded = set(pks)
+            self.log = [t for t in self.log if t.token not in reloaded]
+            for pk in pks:
+                old = self.records.pop(pk, None)
+                self.pending.pop(pk, None)
+                record = fresh.get(pk)
+                if record is None or record.status not in ACTIVE_STATUSES:
+                    continue
+                if old is not None:
+                    record.qr_image, record.qr_status = old.qr_image, old.qr_status
+                self._put(record)
+
+    def set_qr(self, pk, image, render_status):
+        with self.lock:
+            record = self.records.get(pk)
+            if record is not None:
+                record.qr_image, record.qr_status = image, render_status
+
+    def _put(self, record):
+        self.records[record.pk] = record
+        if record.status == "waiting":
+            heapq.heappush(self.heaps[record.category_id], (record.queue_position, record.pk))
+
+    # ---- transitions ----
+
+    def _peek_waiting(self, category_id):
+        heap = self.heaps.get(category_id)
+        while heap:
+            position, pk = heap[0]
+            record = self.records.get(pk)
+            if record is not None and record.status == "waiting" and record.queue_position == position \
+                    and record.category_id == category_id:
+                return record
+            heapq.heappop(heap)
+        return None
+
+    def _transition(self, record, status, called_by_id=None, now=None, actor_id=None, counter_id=None):
+        if record.status not in sources(status):
+            raise TransitionError(f"A {record.status} token cannot become {status}")
+        now = now or timezone.now()
+        self.log.append(Transition(
+            record.pk, record.category_id, record.status, status, counter_id,
+            called_by_id if status == "called" else actor_id, now,
+        ))
+        record.status, record.updated_at = status, now
+        if status == "called":
+            record.called_by_id, record.called_at = called_by_id, now
+        if status not in ACTIVE_STATUSES:
+            self.records.pop(record.pk, None)
+        self.pending[record.pk] = record
+
+    def complete(self, pks, actor_id=None, counter_id=None):
+        """Complete the given active tokens. Returns the completed token_ids."""
+        now = timezone.now()
+        completed = []
+        with self.lock:
+            for pk in pks:
+                record = self.records.get(pk)
+                if record is not None:
+                    self._transition(record, "completed", now=now, actor_id=actor_id, counter_id=counter_id)
+                    completed.append(record.token_id)
+        self._kick()
+        return completed
+
+    def dispatch(self, category_ids, called_by_id=None, complete=(), counter_id=None):
+        """
+        Complete ``complete`` and call the next waiting token across
+        ``category_ids`` (``None`` for all; the scheduler picks between
+        categories) as one step under the engine lock. Returns
+        ``(completed_token_ids, record or None)``.
+        """
+        now = timezone.now()
+        with self.lock:
+            completed = []
+            for pk in complete:
+                record = self.records.get(pk)
+                if record is not None:
+                    self._transition(record, "completed", now=now, actor_id=called_by_id, counter_id=counter_id)
+                    completed.append(record.token_id)
+            ids = list(self.heaps.keys() if category_ids is None else category_ids)
+            heads = {}
+            for category_id in ids:
+                head = self._peek_waiting(category_id)
+                if head is not None:
+                    heads[category_id] = head
+            best = None
+            if len(ids) == 1:
+                best = heads.get(ids[0])
+            elif heads:
+                ranking = scheduler.order({category_id: r.issued_at for category_id, r in heads.items()}, now)
+                chosen = next(iter(ranking))
+                scheduler.charge(ranking, chosen, called_by_id, now)
+                best = heads[chosen.category_id]
+            if best is not None:
+                heapq.heappop(self.heaps[best.category_id])
+                self._transition(best, "called", called_by_id, now, counter_id=counter_id)
+        self._kick()
+        return completed, best
+
+    def call(self, pk, called_by_id=None):
+        """Call one specific waiting token. Returns its record, or ``None`` if it is not waiting."""
+        with self.lock:
+            record = self.records.get(pk)
+            if record is None or record.status != "waiting":
+                return None
+            self._transition(record, "called", called_by_id)
+        self._kick()
+        return record
+
+    # ---- reads ----
+
+    def called_by(self, category_ids, called_by_id):
+        with self.lock:
+            return [
+                r.pk for r in self.records.values()
+                if r.status == "called" and r.called_by_id == called_by_id
+                and (category_ids is None or r.category_id in category_ids)
+            ]
+
+    def tokens(self, category_ids=None, statuses=("waiting",), exclude_manual=False):
+        """Active records in queue order, optionally limited to some categories and statuses."""
+        with self.lock:
+            records = [
+                r for r in self.records.values()
+                if r.status in statuses
+                and (category_ids is None or r.category_id in category_ids)
+                and not (exclude_manual and r.source == "manual")
+            ]
+        records.sort(key=lambda r: (r.queue_position, r.pk))
+        return records
+
+    # ---- write-behind ----
+
+    def flush(self):
+        """
+        Persist pending transitions in batched transactions. Returns the
+        number of rows written. Like ``transition_many`` the write is a
+        compare-and-set: a token whose row no longer holds the status the
+        engine last stored was changed elsewhere (a scan, a sweep, an
+        emergency action), so its transitions are dropped and the engine
+        re-reads it instead of overwriting the row.
+        """
+        written = 0
+        while True:
+            with self.lock:
+                if not self.pending and not self.log:
+                    return written
+                batch = [self.pending.pop(pk) for pk in list(self.pending)[:self.batch_size]]
+                batched = {record.pk for record in batch}
+                log = [t for t in self.log if t.token in batched]
+                self.log = [t for t in self.log if t.token not in batched]
+                # Snapshot the values now; the records keep changing under the lock
+                rows = [
+                    (r.stored_status, Token(
+                        pk=r.pk, status=r.status, called_by_id=r.called_by_id, called_at=r.called_at,
+                        updated_at=r.updated_at,
+                    ))
+                    for r in batch
+                ]
+            try:
+                with transaction.atomic():
+                    stored = self._write(rows, log)
+            except Exception:
+                logger.exception("Queue engine flush failed; %d transitions will be retried", len(batch))
+                with self.lock:
+                    for record in batch:
+                        self.pending.setdefault(record.pk, record)
+                    self.log[:0] = log
+                return written
+            with self.lock:
+                for record, (_expected, row) in zip(batch, rows):
+                    if row.pk in stored:
+                        record.stored_status = row.status
+            conflicts = [row.pk for _expected, row in rows if row.pk not in stored]
+            if conflicts:
+                logger.warning("Queue engine dropped transitions of %d token(s) changed elsewhere", len(conflicts))
+                self._reload(conflicts)
+            written += len(stored)
+
+    def _write(self, rows, log):
+        # Lock the rows still in the status the engine expects, then write only those
+        expected = defaultdict(list)
+        for status, row in rows:
+            expected[status].append(row.pk)
+        stored = set()
+        for status, pks in expected.items():
+            current = Token.objects.select_for_update().filter(pk__in=pks, status=status)
+            stored.update(current.values_list("pk", flat=True))
+        Token.objects.bulk_update([row for _status, row in rows if row.pk in stored], PERSISTED_FIELDS)
+        log_transitions(t for t in log if t.token in stored)
+        return stored
+
+    def _kick(self):
+        if len(self.pending) >= self.batch_size:
+            self._wake.set()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name="queue-engine-flush", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+                if SharedSequence.read(ENGINE_EPOCH_KEY) != self.epoch:
+                    self.rebuild()
+            except Exception:
+                logger.exception("Queue engine flusher error")
+            finally:
+                connection.close()
+
+    # ---- consistency ----
+
+    def check(self):
+        """
+        Flush, then diff the engine against the database. Returns a list of
+        ``(pk, token_id, field, engine_value, db_value)``; empty means consistent.
+        """
+        self.flush()
+        fields = ["status", "category_id", "queue_position", "called_by_id"]
+        db = {
+            row["pk"]: row
+            for row in Token.objects.filter(status__in=ACTIVE_STATUSES).values("pk", "token_id", *fields)
+        }
+        with self.lock:
+            engine = dict(self.records)
+        diffs = []
+        for pk in engine.keys() - db.keys():
+            diffs.append((pk, engine[pk].token_id, "present", True, False))
+        for pk in db.keys() - engine.keys():
+            diffs.append((pk, db[pk]["token_id"], "present", False, True))
+        for pk in engine.keys() & db.keys():
+            for field in fields:
+                ours, theirs = getattr(engine[pk], field), db[pk][field]
+                if ours != theirs:
+                    diffs.append((pk, engine[pk].token_id, field, ours, theirs))
+        return sorted(diffs)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_serving = False
+
+
+def serve():
+    """
+    Mark this process as the one serving the queue, so ``get_engine`` builds
+    the engine here. Called by the WSGI and ASGI entry points; management
+    commands never build one.
+    """
+    global _serving
+    _serving = True
+
+
+def get_engine():
+    """
+    The process-wide queue engine, built on first use; ``None`` unless
+    ``QUEUE_ENGINE`` is on and this process serves the queue.
+    """
+    global _engine
+    if not _serving or not getattr(settings, "QUEUE_ENGINE", False):
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = QueueEngine(
+                    flush_interval=getattr(settings, "QUEUE_ENGINE_FLUSH_INTERVAL", 0.5),
+                    batch_size=getattr(settings, "QUEUE_ENGINE_BATCH_SIZE", 500),
+                )
+                engine.rebuild()
+                engine.start()
+                _engine = engine
+    return _engine
+
+
+def invalidate_engine():
+    """
+    Make the serving process's engine rebuild from the database once the
+    current transaction commits (after changes made outside it).
+    """
+    SharedSequence.advance(ENGINE_EPOCH_KEY)
+
+
+def tokens_changed(pks):
+    """
+    Tell the engine that tokens ``pks`` changed in the database outside it;
+    call inside the transaction making the change. The serving process
+    re-reads them on commit, any other process bumps the shared epoch.
+    """
+    if not getattr(settings, "QUEUE_ENGINE", False):
+        return
+    engine = get_engine()
+    if engine is None:
+        invalidate_engine()
+        return
+    pks = list(pks)
+    transaction.on_commit(lambda: engine.refresh(pks))
+
+
+def track_tokens(tokens):
+    """Hand freshly inserted tokens to the engine once their transaction commits."""
+    if not getattr(settings, "QUEUE_ENGINE", False):
+        return
+    engine = get_engine()
+    if engine is None:
+        invalidate_engine()
+        return
+    tokens = list(tokens)
+    transaction.on_commit(lambda: engine.track(tokens))
+
+
+@receiver(post_save, sender=Token, dispatch_uid="tokens-queue-engine")
+def _token_saved(sender, instance, created, raw=False, **kwargs):
+    # New tokens are tracked by Token.save() once their QR exists; this catches later edits
+    if not created and not raw:
+        tokens_changed([instance.pk])
@@ -0,0 +1,185 @@
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import StreamSummary
+
+
+ALPHA = getattr(settings, "TOKEN_ESTIMATE_ALPHA", 0.2)
+# Longer gaps between calls are idle time, not service, and are clipped to this
+MAX_INTERVAL = getattr(settings, "TOKEN_ESTIMATE_MAX_INTERVAL", 1800)
+
+# Histogram buckets grow by 1.5x from 5 seconds (~3 hours at the top)
+BUCKET_BASE = 5.0
+BUCKET_GROWTH = 1.5
+BUCKETS = 20
+DECAY = 0.98  # weight kept by older observations at each new one
+
+
+class StreamStats:
+    """
+    Streaming summary of one series of durations: an EWMA of the values and
+    of their spread, plus a decaying log-bucket histogram for quantiles.
+    Every update is O(1) (a fixed number of buckets) and the state is a few
+    numbers, so it is kept in one ``StreamSummary`` row instead of being
+    recomputed from history.
+    """
+    __slots__ = ("mean", "var", "count", "last_at", "buckets")
+
+    def __init__(self, mean=None, var=0.0, count=0, last_at=None, buckets=None):
+        self.mean = mean
+        self.var = var
+        self.count = count
+        self.last_at = last_at
+        self.buckets = buckets or [0.0] * BUCKETS
+
+    def observe(self, value):
+        value = max(float(value), 0.0)
+        if self.mean is None:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            self.mean += ALPHA * delta
+            self.var = (1 - ALPHA) * (self.var + ALPHA * delta * delta)
+        self.count += 1
+        index = 0 if value < BUCKET_BASE else min(int(math.log(value / BUCKET_BASE, BUCKET_GROWTH)) + 1, BUCKETS - 1)
+        self.buckets = [weight * DECAY for weight in self.buckets]
+        self.buckets[index] += 1.0
+
+    def quantile(self, q):
+        """Upper edge of the bucket holding the ``q`` quantile; ``None`` before any observation."""
+        total = sum(self.buckets)
+        if not total:
+            return None
+        running = 0.0
+        for index, weight in enumerate(self.buckets):
+            running += weight
+            if running >= q * total:
+                return BUCKET_BASE * BUCKET_GROWTH ** index
+        return BUCKET_BASE * BUCKET_GROWTH ** (BUCKETS - 1)
+
+    def as_dict(self):
+        return {
+            "mean": self.mean, "var": self.var, "count": self.count,
+            "last_at": self.last_at, "buckets": self.buckets,
+        }
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.mean, row.var, row.count, row.last_at, row.buckets) if row else cls()
+
+
+def _streams(scope, scope_id, streams):
+    rows = StreamSummary.objects.filter(scope=scope, scope_id=scope_id, stream__in=streams)
+    found = {row.stream: row for row in rows}
+    return {stream: StreamStats.from_row(found.get(stream)) for stream in streams}
+
+
+def get_stats(scope, scope_id, stream):
+    return _streams(scope, scope_id, [stream])[stream]
+
+
+def _update(scope, scope_id, stream, value=None, at=None, repeat=0):
+    # Read-modify-write under the row lock, so updates from every worker and cron command apply in turn.
+    # Without a value, the gap since the previous event at ``at`` is observed; ``repeat`` more
+    # events at the same instant add zero gaps.
+    with transaction.atomic():
+        row, _created = StreamSummary.objects.select_for_update().get_or_create(
+            scope=scope, scope_id=scope_id, stream=stream,
+        )
+        stats = StreamStats.from_row(row)
+        if value is None and at is not None and stats.last_at is not None:
+            value = min(max(at - stats.last_at, 0.0), MAX_INTERVAL)
+        if value is not None:
+            stats.observe(value)
+        for _ in range(repeat):
+            stats.observe(0.0)
+        if at is not None:
+            stats.last_at = at
+        StreamSummary.objects.filter(pk=row.pk).update(**stats.as_dict())
+
+
+def record_arrivals(category_id, count=1, now=None):
+    """Tokens issued in ``category_id``; feeds the inter-arrival series."""
+    at = (now or timezone.now()).timestamp()
+    transaction.on_commit(lambda: _update("category", category_id, "arrival", at=at, repeat=count - 1))
+
+
+def record_call(category_id, now=None):
+    """A token of ``category_id`` was dispatched; feeds the time-between-calls series."""
+    at = (now or timezone.now()).timestamp()
+    transaction.on_commit(lambda: _update("category", category_id, "interval", at=at))
+
+
+def record_service(completed, counter_id=None, now=None):
+    """
+    ``completed`` holds ``(category_id, called_at)`` of tokens just completed;
+    each one's service time feeds its category's series and, when a desk
+    completed it, the desk's.
+    """
+    now = now or timezone.now()
+    samples = [(category_id, (now - called_at).total_seconds()) for category_id, called_at in completed if called_at]
+    if not samples:
+        return
+
+    def update():
+        for category_id, seconds in samples:
+            _update("category", category_id, "service", value=seconds)
+            if counter_id is not None:
+                _update("counter", counter_id, "service", value=seconds)
+
+    transaction.on_commit(update)
+
+
+class WaitEstimator:
+    """Estimated wait for any number of people ahead in one category, from one query."""
+
+    def __init__(self, category_id):
+        streams = _streams("category", category_id, ["interval", "service"])
+        self.interval = streams["interval"]
+        if self.interval.mean is None:
+            # No calls seen yet: fall back to how long one service takes
+            self.interval = streams["service"]
+
+    def seconds(self, people_ahead):
+        """``(expected, p90)`` seconds until the token is called; ``(None, None)`` without data."""
+        if self.interval.mean is None or people_ahead is None:
+            return None, None
+        turns = people_ahead + 1
+        expected = turns * self.interval.mean
+        # Spread of a sum grows with the square root of the number of turns
+        high = self.interval.quantile(0.9)
+        spread = max((high or self.interval.mean) - self.interval.mean, math.sqrt(self.interval.var))
+        return round(expected), round(expected + spread * math.sqrt(turns))
+
+    def payload(self, people_ahead):
+        expected, high = self.seconds(people_ahead)
+        return {"estimated_wait_seconds": expected, "estimated_wait_p90_seconds": high}
+
+
+def _round(value):
+    return round(value, 1) if value is not None else None
+
+
+def summarize(stats):
+    return {
+        "mean_seconds": _round(stats.mean),
+        "p50_seconds": _round(stats.quantile(0.5)),
+        "p90_seconds": _round(stats.quantile(0.9)),
+        "samples": stats.count,
+    }
+
+
+def category_summary(category_id):
+    """Current statistics for a category, for front-desk screens and tuning."""
+    streams = _streams("category", category_id, ["arrival", "interval", "service"])
+    summary = {stream: summarize(stats) for stream, stats in streams.items()}
+    arrival = summary["arrival"]["mean_seconds"]
+    summary["arrivals_per_hour"] = round(3600 / arrival, 1) if arrival else None
+    return summary
+
+
+def counter_summary(counter_id):
+    return {"service": summarize(get_stats("counter", counter_id, "service"))}
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import QRCode, Token
+
+
+CHUNK_SIZE = getattr(settings, "QR_EXPIRY_CHUNK_SIZE", 1000)
+
+
+def expire_qr_codes(now=None, chunk_size=None):
+    """
+    Flag QR codes whose ``expires_at`` has passed, and their tokens, so
+    verification can reject them from ``QRCode.expired`` / ``Token.qr_expired``
+    alone. Codes are read through the partial index on unflagged
+    ``expires_at`` in chunks of ``chunk_size``, each chunk flagged with two
+    UPDATEs in one transaction. Returns ``{"qr_codes": n, "tokens": n}``.
+    """
+    now = now or timezone.now()
+    chunk_size = chunk_size or CHUNK_SIZE
+    due = QRCode.objects.filter(expired=False, expires_at__lte=now).order_by("expires_at")
+    totals = {"qr_codes": 0, "tokens": 0}
+    while True:
+        rows = list(due.values_list("pk", "token_id")[:chunk_size])
+        if not rows:
+            return totals
+        with transaction.atomic():
+            totals["qr_codes"] += QRCode.objects.filter(pk__in=[pk for pk, _ in rows], expired=False).update(expired=True)
+            totals["tokens"] += Token.objects.filter(
+                pk__in={token_pk for _, token_pk in rows}, qr_expired=False,
+            ).update(qr_expired=True)
+        if len(rows) < chunk_size:
+            return totals
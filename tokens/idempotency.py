@@ -0,0 +1,95 @@
+from datetime import timedelta
+from functools import wraps
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+HEADER = "Idempotency-Key"
+KEY_TTL = timedelta(hours=getattr(settings, "IDEMPOTENCY_KEY_TTL_HOURS", 24))
+# A request still unanswered after this long is taken to have died with its worker
+IN_PROGRESS_TIMEOUT = timedelta(seconds=getattr(settings, "IDEMPOTENCY_IN_PROGRESS_SECONDS", 60))
+
+
+def _request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _replay(record):
+    response = Response(record.response, status=record.status_code)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(scope):
+    """
+    Make a view method replay its first response for requests carrying the
+    same ``Idempotency-Key`` header, without running the view again.
+
+    A retry that arrives while the first request is still running gets a
+    409, for up to ``IN_PROGRESS_TIMEOUT``; after that the key is reclaimed
+    and the retry runs the view. Reusing a key with a different body gets a
+    422. Server errors are not stored, so the client can retry them.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view_method(self, request, *args, **kwargs)
+            key = key[:128]
+            request_hash = _request_hash(request)
+            now = timezone.now()
+
+            IdempotencyKey.objects.filter(scope=scope, key=key).filter(
+                Q(expires_at__lte=now) | Q(status_code__isnull=True, created_at__lte=now - IN_PROGRESS_TIMEOUT)
+            ).delete()
+            try:
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(
+                        scope=scope, key=key, request_hash=request_hash, expires_at=now + KEY_TTL,
+                    )
+            except IntegrityError:
+                record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+                if record is None:
+                    return Response({"detail": "Idempotency key was just released; retry."}, status=409)
+                if record.request_hash != request_hash:
+                    return Response({"detail": f"{HEADER} was already used with a different request."}, status=422)
+                if record.status_code is None:
+                    return Response({"detail": "A request with this idempotency key is still in progress."}, status=409)
+                return _replay(record)
+
+            try:
+                response = view_method(self, request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+            if response.status_code >= 500 or getattr(response, "data", None) is None:
+                record.delete()
+                return response
+            # A no-op if the key was reclaimed meanwhile: the retry's response is the one kept
+            IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True).update(
+                status_code=response.status_code, response=response.data,
+            )
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired_keys(batch_size=1000):
+    """Delete expired idempotency keys in batches; returns the number removed."""
+    removed = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return removed
+        removed += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,286 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .config import current_qr_settings
+from .engine import track_tokens
+from .estimates import record_arrivals
+from .notifications import broadcast_tokens
+from .positions import tombstone
+from .models import Token, QRCode, TokenSequence, TokenPool, PooledToken, SequenceLease
+from .tasks import enqueue_qr_render, schedule_pool_refill
+from .utils import store_qr_images, token_qr_job, token_qr_payload
+
+
+BULK_CHUNK_SIZE = getattr(settings, "TOKEN_BULK_CHUNK_SIZE", 200)
+
+
+def bulk_issue_tokens(category, count, status="waiting", created_by=None, source="admin", chunk_size=None):
+    """
+    Issue ``count`` tokens for ``category`` in bulk.
+
+    IDs and queue positions are reserved with one sequence allocation, then
+    each chunk renders and stores its QR images as one batch through the
+    content-addressed image store and inserts the tokens and QR rows with
+    ``bulk_create``. Yields ``(done, total, issued)`` after
+    every chunk, where ``issued`` is the list of ``(token, qr_code)`` pairs
+    created by that chunk.
+    """
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    block = TokenSequence.allocate(category, count)
+    qr_settings = current_qr_settings()
+
+    for start in range(0, count, chunk_size):
+        offsets = range(start, min(start + chunk_size, count))
+        issued_at = timezone.now()
+        tokens = [
+            Token(
+                token_id=block.token_id(i),
+                category=category,
+                status=status,
+                issued_at=issued_at,
+                created_by=created_by,
+                source=source,
+                queue_position=block.position(i),
+            )
+            for i in offsets
+        ]
+        yield start + len(tokens), count, insert_tokens_with_qr(tokens, qr_settings)
+
+
+def insert_tokens_with_qr(tokens, qr_settings=None, paths=None):
+    """
+    Store the QR images for unsaved ``tokens`` as one batch, then insert the
+    tokens and their QR rows with ``bulk_create``. ``paths`` holds images
+    already stored for them (``None`` entries are rendered). Returns
+    ``(token, qr_code)`` pairs.
+    """
+    paths = list(paths or [None] * len(tokens))
+    missing = [i for i, path in enumerate(paths) if path is None]
+    stored = store_qr_images(token_qr_job(tokens[i], qr_settings) for i in missing)
+    for i, path in zip(missing, stored):
+        paths[i] = path
+    with transaction.atomic():
+        Token.objects.bulk_create(tokens)
+        qr_codes = QRCode.objects.bulk_create([
+            build_qr_code(token, qr_settings, image=path)
+            for token, path in zip(tokens, paths)
+        ])
+        for token, qr_code in zip(tokens, qr_codes):
+            token.qr_code = qr_code
+        track_tokens(tokens)
+        tombstone((token.category_id, token.queue_position) for token in tokens if token.status != "waiting")
+        for category_id in {token.category_id for token in tokens}:
+            record_arrivals(category_id, sum(1 for token in tokens if token.category_id == category_id))
+        for status in {token.status for token in tokens}:
+            broadcast_tokens(status, (
+                (token.category_id, token.token_id, token.queue_position) for token in tokens if token.status == status
+            ))
+    return list(zip(tokens, qr_codes))
+
+
+def build_qr_code(token, qr_settings=None, image=None):
+    """Unsaved QRCode row for ``token`` following the single token QR policy."""
+    qr_data, checksum, expires_at = token_qr_payload(token, qr_settings)
+    return QRCode(
+        token=token,
+        category=token.category,
+        expires_at=expires_at,
+        checksum=checksum,
+        payload=qr_data,
+        image=image,
+        format="PNG",
+        created_by=token.issued_by or token.created_by,
+        data=token.token_id,
+        render_status=QRCode.RENDER_READY if image else QRCode.RENDER_PENDING,
+    )
+
+
+def issue_qr(token, qr_settings=None):
+    """
+    Create the one QR code for ``token``.
+
+    With ``QR_RENDER_MODE = "async"`` the row is committed as pending and the
+    image is rendered by the background worker; otherwise it is rendered here.
+    """
+    if qr_settings is None:
+        qr_settings = current_qr_settings()
+    if settings.QR_RENDER_MODE == "async":
+        qr_code = build_qr_code(token, qr_settings)
+        qr_code.save()
+        enqueue_qr_render(qr_code.pk)
+        return qr_code
+    image = store_qr_images([token_qr_job(token, qr_settings)])[0]
+    qr_code = build_qr_code(token, qr_settings, image=image)
+    qr_code.save()
+    return qr_code
+
+
+def refill_pool(pool, force=False):
+    """
+    Top ``pool`` up to its size with pre-minted token IDs and rendered QR
+    images. Only runs once the pool has dropped to its refill threshold,
+    unless ``force`` is set. Returns the number of tokens minted.
+    """
+    available = PooledToken.objects.filter(category=pool.category).count()
+    missing = pool.size - available
+    if missing <= 0 or (available > pool.refill_threshold and not force):
+        return 0
+    # Numbers are reserved now; queue positions are taken when a token is claimed
+    started = timezone.now()
+    block = TokenSequence.allocate(pool.category, missing, positions=False)
+    qr_settings = current_qr_settings()
+    stubs = [Token(token_id=block.token_id(i), category=pool.category) for i in range(missing)]
+    paths = store_qr_images(token_qr_job(stub, qr_settings) for stub in stubs)
+    with transaction.atomic():
+        sequence = TokenSequence.objects.select_for_update().get(category=pool.category)
+        if sequence.reset_at and sequence.reset_at >= started:
+            # The daily reset restarted numbering while we rendered; these numbers belong to the old day
+            return 0
+        PooledToken.objects.bulk_create([
+            PooledToken(category=pool.category, token_id=stub.token_id, image=path)
+            for stub, path in zip(stubs, paths)
+        ])
+    TokenPool.objects.filter(pk=pool.pk).update(last_refilled_at=timezone.now())
+    return missing
+
+
+def claim_pooled_token(category, **fields):
+    """
+    Issue a token for ``category`` from its pre-minted pool.
+
+    Returns ``None`` when the category has no enabled pool or the pool is
+    empty, in which case the caller issues the token the normal way.
+    """
+    pool = TokenPool.objects.filter(category=category, enabled=True).first()
+    if pool is None:
+        return None
+    with transaction.atomic():
+        pooled = PooledToken.objects.select_for_update(skip_locked=True).filter(category=category).first()
+        if pooled is None:
+            TokenPool.objects.filter(pk=pool.pk).update(misses=F("misses") + 1)
+            schedule_pool_refill(pool.pk)
+            return None
+        pooled.delete()
+        # Position is taken at claim time so pooled tokens queue in arrival order
+        block = TokenSequence.allocate(category, numbers=False)
+        token = Token(token_id=pooled.token_id, category=category, queue_position=block.position(), **fields)
+        token.save(with_qr=False)
+        token.qr_code = build_qr_code(token, current_qr_settings(), image=pooled.image.name)
+        token.qr_code.save()
+        TokenPool.objects.filter(pk=pool.pk).update(hits=F("hits") + 1)
+    schedule_pool_refill(pool.pk)
+    return token
+
+
+LEASE_TTL = timedelta(minutes=getattr(settings, "TOKEN_LEASE_TTL_MINUTES", 240))
+LEASE_MAX_BLOCK = getattr(settings, "TOKEN_LEASE_MAX_BLOCK", 500)
+LEASE_MAX_ACTIVE = getattr(settings, "TOKEN_LEASE_MAX_ACTIVE", 4)
+
+
+class LeaseError(Exception):
+    pass
+
+
+def expire_leases(category=None):
+    """
+    Mark leases past their deadline expired. Their unused numbers are never
+    handed out again: an offline kiosk may still be printing them, and its
+    late registration is accepted. Returns the number of leases expired.
+    """
+    leases = SequenceLease.objects.filter(status=SequenceLease.ACTIVE, expires_at__lte=timezone.now())
+    if category is not None:
+        leases = leases.filter(category=category)
+    return leases.update(status=SequenceLease.EXPIRED)
+
+
+def lease_block(category, kiosk_id, count, ttl=None, leased_by=None):
+    """
+    Lease ``count`` consecutive token numbers of ``category`` to a kiosk,
+    fresh from the category counter. The kiosk account ``leased_by`` may
+    hold at most ``LEASE_MAX_ACTIVE`` unexpired leases; its requests take
+    turns on its user row so two at once cannot both pass the check.
+    """
+    if not 1 <= count <= LEASE_MAX_BLOCK:
+        raise LeaseError(f"count must be between 1 and {LEASE_MAX_BLOCK}")
+    with transaction.atomic():
+        expire_leases(category)
+        now = timezone.now()
+        if leased_by is not None:
+            get_user_model().objects.select_for_update().filter(pk=leased_by.pk).first()
+            held = SequenceLease.objects.filter(leased_by=leased_by, status=SequenceLease.ACTIVE, expires_at__gt=now)
+            if held.count() >= LEASE_MAX_ACTIVE:
+                raise LeaseError(f"A kiosk may hold at most {LEASE_MAX_ACTIVE} active leases")
+        block = TokenSequence.allocate(category, count, positions=False)
+        return SequenceLease.objects.create(
+            category=category,
+            kiosk_id=kiosk_id,
+            leased_by=leased_by,
+            prefix=block.prefix,
+            start_number=block.start_number,
+            count=count,
+            high_water=block.start_number - 1,
+            expires_at=now + (ttl or LEASE_TTL),
+        )
+
+
+def register_leased_tokens(lease, entries):
+    """
+    Insert tokens a kiosk printed from ``lease``.
+
+    ``entries`` are dicts with ``token_id`` and optional ``issued_at``.
+    Queue positions are assigned in registration order. Returns
+    ``(issued, duplicates)``; token_ids already registered are reported as
+    duplicates so kiosks can safely resend a batch, even two copies at
+    once: registrations of one lease take turns on its row. Expired leases
+    are still accepted, since their numbers were never reused. Raises
+    ``LeaseError`` for a lease returned at the daily reset and
+    ``ValueError`` for numbers outside it.
+    """
+    if lease.status == SequenceLease.RETURNED:
+        raise LeaseError("Lease is no longer active")
+    numbers = {}
+    for entry in entries:
+        token_id = str(entry.get("token_id", ""))
+        number = token_id[len(lease.prefix):]
+        if not token_id.startswith(lease.prefix) or not number.isdigit() \
+                or not lease.start_number <= int(number) < lease.end_number:
+            raise ValueError(f"{token_id} is not part of lease {lease.pk}")
+        numbers[token_id] = (int(number), entry.get("issued_at") or timezone.now())
+
+    # Render outside any lock; the insert below finds the images already stored
+    qr_settings = current_qr_settings()
+    unseen = sorted(set(numbers) - set(Token.objects.filter(token_id__in=numbers).values_list("token_id", flat=True)))
+    paths = dict(zip(unseen, store_qr_images(
+        token_qr_job(Token(token_id=token_id, category=lease.category), qr_settings) for token_id in unseen
+    )))
+
+    with transaction.atomic():
+        locked = SequenceLease.objects.select_for_update().filter(pk=lease.pk).first()
+        if locked is None or locked.status == SequenceLease.RETURNED:
+            raise LeaseError("Lease is no longer active")
+        duplicates = set(Token.objects.filter(token_id__in=numbers).values_list("token_id", flat=True))
+        fresh = sorted((number, issued_at, token_id) for token_id, (number, issued_at) in numbers.items()
+                       if token_id not in duplicates)
+        if not fresh:
+            return [], sorted(duplicates)
+
+        block = TokenSequence.allocate(lease.category, len(fresh), numbers=False)
+        tokens = [
+            Token(
+                token_id=token_id,
+                category=lease.category,
+                status="waiting",
+                issued_at=issued_at,
+                source="kiosk",
+                queue_position=block.position(i),
+            )
+            for i, (_number, issued_at, token_id) in enumerate(fresh)
+        ]
+        issued = insert_tokens_with_qr(tokens, qr_settings, paths=[paths.get(token.token_id) for token in tokens])
+        SequenceLease.objects.filter(pk=lease.pk, high_water__lt=fresh[-1][0]).update(high_water=fresh[-1][0])
+    return issued, sorted(duplicates)
@@ -0,0 +1,41 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from tokens.utils import QRRenderService, colored_qr_job, render_qr_bytes
+
+
+class Command(BaseCommand):
+    help = "Compare QR rendering throughput of the inline path against the process-pool render service"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=500, help="Number of QR images to render per run")
+        parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Worker processes for the pool run")
+        parser.add_argument("--chunksize", type=int, default=16, help="Jobs handed to a worker per round-trip")
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        jobs = [colored_qr_job(f"B{i:05d}", "#2563EB") for i in range(count)]
+
+        started = time.perf_counter()
+        for job in jobs:
+            render_qr_bytes(job)
+        inline_seconds = time.perf_counter() - started
+        self._report("inline", count, inline_seconds)
+
+        service = QRRenderService(max_workers=options["processes"], chunksize=options["chunksize"])
+        try:
+            # Warm the pool so worker start-up is not billed to the batch
+            service.render_many(jobs[: options["processes"]])
+            started = time.perf_counter()
+            service.render_many(jobs)
+            pool_seconds = time.perf_counter() - started
+        finally:
+            service.shutdown()
+        self._report(f"pool x{options['processes']}", count, pool_seconds)
+
+        self.stdout.write(self.style.SUCCESS(f"Speed-up: {inline_seconds / pool_seconds:.2f}x"))
+
+    def _report(self, label, count, seconds):
+        self.stdout.write(f"{label:>10}: {count} images in {seconds:.2f}s ({count / seconds:.0f} images/s)")
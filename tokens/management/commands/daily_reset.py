@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tokens.rollover import run_daily_reset
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive finished tokens and restart per-category numbering once the configured "
+        "reset time has passed; safe to run from cron every few minutes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Reset now even if today's reset already ran")
+        parser.add_argument("--chunk-size", type=int, help="Tokens archived per transaction")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        result = run_daily_reset(force=options["force"], chunk_size=options["chunk_size"])
+        if result is None:
+            self.stdout.write("Daily reset not due.")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {result['archived']} token(s), reset {result['sequences']} sequence(s) "
+            f"in {time.monotonic() - started:.1f}s."
+        ))
@@ -0,0 +1,69 @@
+import hashlib
+import re
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+
+# Content-addressed names, as written by store_qr_images: kept in preference to any other copy
+CONTENT_ADDRESSED = re.compile(r"^qrcodes/[0-9a-f]{64}\.\w+$")
+
+
+def image_fields():
+    """``(model, field name)`` of every file field in the tokens app: live, pooled and archived QR images."""
+    return [
+        (model, field.name)
+        for model in apps.get_app_config("tokens").get_models()
+        for field in model._meta.get_fields()
+        if isinstance(field, models.FileField)
+    ]
+
+
+def _rows(model, field, path):
+    return model.objects.filter(**{field: path})
+
+
+class Command(BaseCommand):
+    help = "Point QR images with byte-identical content at one shared file and delete the redundant copies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report duplicates without changing anything")
+
+    def handle(self, *args, **options):
+        fields = image_fields()
+        paths = set()
+        for model, field in fields:
+            paths.update(
+                model.objects.exclude(**{field: ""}).exclude(**{field: None})
+                .values_list(field, flat=True).distinct().iterator()
+            )
+
+        by_digest = {}  # content hash -> every stored path with that content
+        for path in sorted(paths):
+            if not default_storage.exists(path):
+                continue
+            with default_storage.open(path, "rb") as fh:
+                by_digest.setdefault(hashlib.sha256(fh.read()).hexdigest(), []).append(path)
+
+        repoint = {}  # duplicate path -> canonical path
+        for copies in by_digest.values():
+            canonical = min(copies, key=lambda path: (not CONTENT_ADDRESSED.match(path), path))
+            repoint.update((path, canonical) for path in copies if path != canonical)
+
+        updated = removed = 0
+        if not options["dry_run"]:
+            for duplicate, path in repoint.items():
+                with transaction.atomic():
+                    updated += sum(_rows(model, field, duplicate).update(**{field: path}) for model, field in fields)
+                # A row written since the update still needs the file
+                if not any(_rows(model, field, duplicate).exists() for model, field in fields):
+                    default_storage.delete(duplicate)
+                    removed += 1
+
+        if options["dry_run"]:
+            summary = f"Would remove {len(repoint)} duplicate image(s)."
+        else:
+            summary = f"Removed {removed} duplicate image(s); {updated} row(s) repointed."
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tokens.expiry import expire_qr_codes
+
+
+class Command(BaseCommand):
+    help = "Flag QR codes past their expiry, and their tokens, so scans are rejected without date checks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, help="QR codes flagged per transaction")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        result = expire_qr_codes(chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Flagged {result['qr_codes']} expired QR code(s) and {result['tokens']} token(s) "
+            f"in {time.monotonic() - started:.1f}s."
+        ))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from tokens.issuance import expire_leases
+
+
+class Command(BaseCommand):
+    help = "Mark kiosk token-number leases past their deadline expired; their unused numbers are never reused"
+
+    def handle(self, *args, **options):
+        expired = expire_leases()
+        self.stdout.write(self.style.SUCCESS(f"Expired {expired} lease(s)."))
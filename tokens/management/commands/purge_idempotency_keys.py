@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from tokens.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = "Delete idempotency keys whose replay window has passed"
+
+    def handle(self, *args, **options):
+        removed = purge_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} expired idempotency key(s)."))
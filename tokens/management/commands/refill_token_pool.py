@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from tokens.issuance import refill_pool
+from tokens.models import TokenPool
+
+
+class Command(BaseCommand):
+    help = "Pre-mint tokens (IDs and QR images) into each enabled category pool; run during idle time"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--category", type=int, help="Only refill the pool of this category id")
+        parser.add_argument("--force", action="store_true", help="Top up to full size even above the refill threshold")
+
+    def handle(self, *args, **options):
+        pools = TokenPool.objects.filter(enabled=True).select_related("category")
+        if options["category"]:
+            pools = pools.filter(category_id=options["category"])
+        for pool in pools:
+            minted = refill_pool(pool, force=options["force"])
+            self.stdout.write(f"{pool.category.name}: minted {minted}")
+        self.stdout.write(self.style.SUCCESS("Token pools refilled."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from tokens.models import QRCode
+from tokens.tasks import render_qr_code
+
+
+class Command(BaseCommand):
+    help = "Render QR images left pending (or failed) by the background worker, e.g. after a restart"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--include-failed", action="store_true", help="Also retry renders that failed")
+
+    def handle(self, *args, **options):
+        statuses = [QRCode.RENDER_PENDING]
+        if options["include_failed"]:
+            statuses.append(QRCode.RENDER_FAILED)
+        rendered = 0
+        for qr_code_id in QRCode.objects.filter(render_status__in=statuses).values_list("id", flat=True).iterator():
+            if render_qr_code(qr_code_id):
+                rendered += 1
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} pending QR code(s)."))
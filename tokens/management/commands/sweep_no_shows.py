@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tokens.noshow import sweep_no_shows
+
+
+class Command(BaseCommand):
+    help = (
+        "Mark tokens left called past their category's no-show timeout as no-shows (or requeue them) "
+        "and free their desks; safe to run from cron every minute"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Tokens moved per transaction")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        result = sweep_no_shows(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Marked {result['noshow']} no-show(s), requeued {result['requeued']} token(s) "
+            f"in {result['batches']} batch(es), {time.monotonic() - started:.1f}s."
+        ))
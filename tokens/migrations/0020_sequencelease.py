@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0019_token_pool'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SequenceLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kiosk_id', models.CharField(max_length=64)),
+                ('prefix', models.CharField(max_length=8)),
+                ('start_number', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('high_water', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('active', 'Active'), ('expired', 'Expired'), ('returned', 'Returned')], default='active', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sequence_leases', to='users.category')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='tokens_sequ_status_47a524_idx')],
+            },
+        ),
+    ]
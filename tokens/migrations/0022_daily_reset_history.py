@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:02
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0021_idempotencykey'),
+        ('users', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrsettings',
+            name='last_reset_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='qrsettings',
+            name='reset_time',
+            field=models.TimeField(default='00:00'),
+        ),
+        migrations.AddField(
+            model_name='tokensequence',
+            name='reset_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='QRCodeHistory',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('image', models.ImageField(blank=True, null=True, upload_to='qrcodes/')),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('data', models.CharField(default='UNKNOWN', max_length=128)),
+                ('checksum', models.CharField(blank=True, max_length=128, null=True)),
+                ('generated_at', models.DateTimeField()),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('format', models.CharField(default='PNG', max_length=10)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.category')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='qrscan',
+            name='qr_history',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scans', to='tokens.qrcodehistory'),
+        ),
+        migrations.CreateModel(
+            name='TokenHistory',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('token_id', models.CharField(db_index=True, max_length=32)),
+                ('queue_position', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('called', 'Called'), ('inprogress', 'In Progress'), ('completed', 'Completed')], max_length=20)),
+                ('issued_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('source', models.CharField(default='public', max_length=20)),
+                ('archived_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_history', to='users.category')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('issued_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='qrcodehistory',
+            name='token',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='qrcodes', to='tokens.tokenhistory'),
+        ),
+        migrations.AddIndex(
+            model_name='tokenhistory',
+            index=models.Index(fields=['category', 'issued_at'], name='tokens_toke_categor_d173da_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:13
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def seed_cursors(apps, schema_editor):
+    # Same rule as tokens.positions.resync: the cursor sits just before the first waiting token
+    Token = apps.get_model('tokens', 'Token')
+    TokenSequence = apps.get_model('tokens', 'TokenSequence')
+    for sequence in TokenSequence.objects.all():
+        tokens = Token.objects.filter(category_id=sequence.category_id)
+        head = tokens.filter(status='waiting').aggregate(Min('queue_position'))['queue_position__min']
+        sequence.serving_position = max((head or sequence.next_position) - 1, 0)
+        sequence.tombstones = tokens.filter(queue_position__gt=sequence.serving_position).exclude(status='waiting').count()
+        sequence.save(update_fields=['serving_position', 'tombstones'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0025_categoryschedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokensequence',
+            name='serving_position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tokensequence',
+            name='tombstones',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(seed_cursors, migrations.RunPython.noop),
+    ]
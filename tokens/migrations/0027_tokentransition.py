@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0026_tokensequence_cursors'),
+        ('users', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BigIntegerField()),
+                ('from_status', models.PositiveSmallIntegerField(choices=[(0, 'none'), (1, 'waiting'), (2, 'called'), (3, 'inprogress'), (4, 'completed')])),
+                ('to_status', models.PositiveSmallIntegerField(choices=[(0, 'none'), (1, 'waiting'), (2, 'called'), (3, 'inprogress'), (4, 'completed')])),
+                ('at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('category', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.category')),
+                ('counter', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tokens.counter')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['at'], name='tokens_toke_at_7e44ef_idx'), models.Index(fields=['category', 'at'], name='tokens_toke_categor_40ab5c_idx'), models.Index(fields=['token', 'at'], name='tokens_toke_token_b13c8e_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0027_tokentransition'),
+        ('users', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoryschedule',
+            name='no_show_action',
+            field=models.CharField(blank=True, choices=[('noshow', 'Mark no-show'), ('requeue', 'Requeue at the back')], max_length=10),
+        ),
+        migrations.AddField(
+            model_name='categoryschedule',
+            name='no_show_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='token',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('called', 'Called'), ('inprogress', 'In Progress'), ('completed', 'Completed'), ('noshow', 'No show')], default='waiting', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='tokenhistory',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting'), ('called', 'Called'), ('inprogress', 'In Progress'), ('completed', 'Completed'), ('noshow', 'No show')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='tokentransition',
+            name='from_status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'none'), (1, 'waiting'), (2, 'called'), (3, 'inprogress'), (4, 'completed'), (5, 'noshow')]),
+        ),
+        migrations.AlterField(
+            model_name='tokentransition',
+            name='to_status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'none'), (1, 'waiting'), (2, 'called'), (3, 'inprogress'), (4, 'completed'), (5, 'noshow')]),
+        ),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['status', 'called_at'], name='tokens_toke_status_faa243_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0032_sequencelease_leased_by'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=16)),
+                ('scope_id', models.BigIntegerField()),
+                ('stream', models.CharField(max_length=16)),
+                ('mean', models.FloatField(blank=True, null=True)),
+                ('var', models.FloatField(default=0.0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('last_at', models.FloatField(blank=True, null=True)),
+                ('buckets', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('scope', 'scope_id', 'stream'), name='unique_stream_summary')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:16
+
+from django.db import migrations, models
+
+
+TOMBSTONE_LIMIT = 1000
+
+
+def seed_buried(apps, schema_editor):
+    # Same rule as tokens.positions.resync: the gaps between consecutive waiting positions
+    Token = apps.get_model('tokens', 'Token')
+    TokenSequence = apps.get_model('tokens', 'TokenSequence')
+    for sequence in TokenSequence.objects.all():
+        waiting = list(
+            Token.objects.filter(category_id=sequence.category_id, status='waiting')
+            .order_by('queue_position').values_list('queue_position', flat=True)
+        )
+        buried = [position for before, after in zip(waiting, waiting[1:]) for position in range(before + 1, after)]
+        sequence.serving_position = max((waiting[0] if waiting else sequence.next_position) - 1, 0)
+        sequence.buried = buried if len(buried) <= TOMBSTONE_LIMIT else None
+        sequence.save(update_fields=['serving_position', 'buried'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tokens', '0033_streamsummary'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='tokensequence',
+            name='tombstones',
+        ),
+        migrations.AddField(
+            model_name='tokensequence',
+            name='buried',
+            field=models.JSONField(blank=True, default=list, null=True),
+        ),
+        migrations.RunPython(seed_buried, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,14 @@
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
 from django.utils import timezone
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Max
 from users.models import Category
 from django.utils.crypto import get_random_string
+from collections import namedtuple
+from string import ascii_uppercase
 import logging
+import re
 
 
 class Token(models.Model):
@@ -13,6 +17,7 @@ class Token(models.Model):
         ('called', 'Called'),
         ('inprogress', 'In Progress'),
         ('completed', 'Completed'),
+        ('noshow', 'No show'),
     ]
 
     token_id = models.CharField(max_length=32, unique=True, blank=True)
@@ -28,50 +33,427 @@ class Token(models.Model):
         settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="tokens_issued"
     )
     source = models.CharField(max_length=20, default="public")  # "admin" or "public"
+    called_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="tokens_called"
+    )
+    called_at = models.DateTimeField(null=True, blank=True)
+    # Set by expire_qr_codes once the token's QR code has expired
+    qr_expired = models.BooleanField(default=False)
+
+    class Meta:
+        # Dispatch walks each category's waiting tokens in queue order
+        indexes = [
+            models.Index(fields=["category", "status", "queue_position"]),
+            # The no-show sweep: called tokens by how long ago they were called
+            models.Index(fields=["status", "called_at"]),
+        ]
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, with_qr=True, **kwargs):
         is_new = self.pk is None
 
-        if is_new:
-            # Generate token_id automatically
-            last_token = Token.objects.filter(category=self.category).order_by('-id').first()
-            next_id = 1 if not last_token else int(last_token.token_id[1:]) + 1
-            prefix = self.category.name[0].upper()
-            self.token_id = f"{prefix}{next_id:03d}"
-
-            # Assign queue position
-            max_position = Token.objects.filter(
-                category=self.category, status='waiting'
-            ).aggregate(Max('queue_position'))['queue_position__max']
-            self.queue_position = 1 if max_position is None else max_position + 1
+        if is_new and not (self.token_id and self.queue_position):
+            # One row-locked increment hands out both the token number and the queue position;
+            # a token that already has its number (manual MANxxx, leased) only takes a position
+            block = TokenSequence.allocate(self.category, numbers=not self.token_id)
+            if not self.token_id:
+                self.token_id = block.token_id()
+            self.queue_position = block.position()
 
         super().save(*args, **kwargs)
 
 
-        if is_new and not hasattr(self, "qr_code"):
+        # Manual tokens are called by number only and never get a QR
+        if is_new and with_qr and self.source != "manual" and not hasattr(self, "qr_code"):
             try:
-                from .utils import generate_qr_code
-                qr_settings = QRSettings.objects.first()
-                qr_data, checksum, file_path = generate_qr_code(self, qr_settings)
-                QRCode.objects.create(
-                    token=self,
-                    category=self.category,
-                    expires_at=qr_data["expires_at"],
-                    checksum=checksum,
-                    payload=qr_data,
-                    image=file_path,
-                    format=qr_settings.default_format if qr_settings else 'PNG',
-                    created_by=self.issued_by,
-                    data=self.token_id  # <-- This is critical!
-                )
-            except Exception as e:
+                from .issuance import issue_qr
+                self.qr_code = issue_qr(self)
+            except Exception:
                 logging.exception("QR generation failed for token %s", self.token_id)
-               
+                self.qr_code = None
+
+        if is_new:
+            from .engine import track_tokens
+            from .estimates import record_arrivals
+            track_tokens([self])
+            record_arrivals(self.category_id)
+            if self.status != "waiting":
+                # Issued straight into another state (manual tokens): its position is not in the line
+                from .positions import tombstone
+                tombstone([(self.category_id, self.queue_position)])
 
     def __str__(self):
         return f"{self.token_id} ({self.category}) - {self.status}"
 
 
+class TokenTransition(models.Model):
+    """
+    Append-only log of token status changes, written in the transaction that
+    made the change. Statuses are stored as small codes; ``token`` is the
+    token's primary key without a foreign key, so the log outlives the daily
+    reset (archived tokens keep their primary key in ``TokenHistory``).
+    """
+    NONE, WAITING, CALLED, INPROGRESS, COMPLETED, NOSHOW = range(6)
+    STATUS_CODES = {
+        None: NONE, 'waiting': WAITING, 'called': CALLED, 'inprogress': INPROGRESS, 'completed': COMPLETED,
+        'noshow': NOSHOW,
+    }
+    STATUS_CHOICES = [(code, status or 'none') for status, code in STATUS_CODES.items()]
+
+    token = models.BigIntegerField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, db_index=False, related_name="+")
+    from_status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES)
+    to_status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES)
+    counter = models.ForeignKey('Counter', null=True, blank=True, on_delete=models.SET_NULL, db_index=False, related_name="+")
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, db_index=False, related_name="+"
+    )
+    at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["at"]),
+            models.Index(fields=["category", "at"]),
+            models.Index(fields=["token", "at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.token}: {self.get_from_status_display()} -> {self.get_to_status_display()} @ {self.at:%H:%M:%S}"
+
+
+class SequenceBlock(namedtuple("SequenceBlock", ["prefix", "start_number", "start_position", "count"])):
+    """A contiguous run of token numbers and queue positions reserved for one category."""
+
+    def token_id(self, offset=0):
+        return f"{self.prefix}{self.start_number + offset:03d}"
+
+    def position(self, offset=0):
+        return self.start_position + offset
+
+
+class TokenSequence(models.Model):
+    """
+    Per-category counter for token numbers and queue positions.
+
+    Prefixes are letters only and unique per category, so ``<prefix><number>``
+    never collides between two categories whose names share a first letter.
+    """
+    RESERVED_PREFIXES = {"MAN"}  # manual tokens are entered as MANxxx
+
+    category = models.OneToOneField(Category, on_delete=models.CASCADE, related_name="token_sequence")
+    prefix = models.CharField(max_length=8, unique=True)
+    next_number = models.PositiveIntegerField(default=1)
+    next_position = models.PositiveIntegerField(default=1)
+    # Highest position dispatched from the head of the line, and the sorted
+    # positions above it that are no longer waiting; null once there are too
+    # many to list (see tokens/positions.py)
+    serving_position = models.PositiveIntegerField(default=0)
+    buried = models.JSONField(default=list, null=True, blank=True)
+    reset_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.category} [{self.prefix}] next={self.next_number} pos={self.next_position}"
+
+    @classmethod
+    def allocate(cls, category, count=1, numbers=True, positions=True):
+        """
+        Reserve ``count`` token numbers and queue positions for ``category``
+        with a single locked read-and-increment of its counter row.
+
+        Pass ``numbers=False`` or ``positions=False`` to leave that counter
+        untouched (the pool mints numbers early but takes positions on claim).
+        """
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        with transaction.atomic():
+            sequence = cls.objects.select_for_update().filter(category=category).first()
+            if sequence is None:
+                sequence = cls._create_for(category)
+            block = SequenceBlock(sequence.prefix, sequence.next_number, sequence.next_position, count)
+            if numbers:
+                sequence.next_number += count
+            if positions:
+                sequence.next_position += count
+            sequence.save(update_fields=["next_number", "next_position", "updated_at"])
+        return block
+
+    @classmethod
+    def _create_for(cls, category):
+        # Seed from the tokens issued before counters existed so numbering carries on
+        for prefix in cls._candidate_prefixes(category.name):
+            if cls.objects.filter(prefix=prefix).exists():
+                continue
+            pattern = re.compile(rf"^{prefix}(\d+)$")
+            numbers = [
+                int(match.group(1))
+                for match in map(pattern.match, Token.objects.filter(token_id__startswith=prefix).values_list("token_id", flat=True))
+                if match
+            ]
+            max_position = Token.objects.filter(category=category).aggregate(Max("queue_position"))["queue_position__max"]
+            try:
+                with transaction.atomic():
+                    cls.objects.create(
+                        category=category,
+                        prefix=prefix,
+                        next_number=max(numbers, default=0) + 1,
+                        next_position=(max_position or 0) + 1,
+                    )
+            except IntegrityError:
+                # Another worker created this category's row, or took the prefix first
+                pass
+            sequence = cls.objects.select_for_update().filter(category=category).first()
+            if sequence is not None:
+                return sequence
+        raise IntegrityError(f"No free token prefix for category {category.pk}")
+
+    @classmethod
+    def _candidate_prefixes(cls, name):
+        letters = "".join(ch for ch in name.upper() if ch in ascii_uppercase) or "T"
+        candidates = [letters[:n] for n in range(1, min(len(letters), 3) + 1)]
+        candidates += [letters[0] + a + b for a in ascii_uppercase for b in ("",) + tuple(ascii_uppercase)]
+        seen = set()
+        for prefix in candidates:
+            if prefix not in seen and prefix not in cls.RESERVED_PREFIXES:
+                seen.add(prefix)
+                yield prefix
+
+
+class TokenPool(models.Model):
+    """
+    Optional per-category pool of pre-minted tokens for peak-hour issuance.
+
+    ``refill_token_pool`` tops the pool up to ``size`` once it drops to
+    ``refill_threshold``; ``hits``/``misses`` count claims served from the
+    pool versus issued the slow way.
+    """
+    category = models.OneToOneField(Category, on_delete=models.CASCADE, related_name="token_pool")
+    enabled = models.BooleanField(default=True)
+    size = models.PositiveIntegerField(default=50)
+    refill_threshold = models.PositiveIntegerField(default=10)
+    hits = models.PositiveBigIntegerField(default=0)
+    misses = models.PositiveBigIntegerField(default=0)
+    last_refilled_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Pool for {self.category} (size={self.size}, refill at {self.refill_threshold})"
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
+class CategorySchedule(models.Model):
+    """
+    How a category competes with the others at desks serving several, and
+    how long its called tokens may go unanswered.
+
+    Higher ``priority`` goes first; within a priority level categories are
+    served in proportion to ``weight``. A category whose oldest waiting
+    token has waited ``max_wait_seconds`` (0 disables aging) jumps ahead of
+    both. Categories without a row get weight 1, priority 0, no aging.
+
+    A token still called ``no_show_seconds`` after its call (0 uses the
+    ``TOKEN_NO_SHOW_SECONDS`` setting) is swept by ``sweep_no_shows`` and
+    marked a no-show or sent to the back of the line, per ``no_show_action``
+    (blank uses ``TOKEN_NO_SHOW_ACTION``).
+    """
+    NO_SHOW = "noshow"
+    REQUEUE = "requeue"
+    NO_SHOW_ACTIONS = [(NO_SHOW, "Mark no-show"), (REQUEUE, "Requeue at the back")]
+
+    category = models.OneToOneField(Category, on_delete=models.CASCADE, related_name="schedule")
+    weight = models.PositiveIntegerField(default=1)
+    priority = models.SmallIntegerField(default=0)
+    max_wait_seconds = models.PositiveIntegerField(default=0)
+    no_show_seconds = models.PositiveIntegerField(default=0)
+    no_show_action = models.CharField(max_length=10, choices=NO_SHOW_ACTIONS, blank=True)
+
+    def __str__(self):
+        return f"Schedule for {self.category} (weight={self.weight}, priority={self.priority})"
+
+
+class PooledToken(models.Model):
+    """A reserved token_id with its QR image already rendered, waiting to be claimed."""
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="pooled_tokens")
+    token_id = models.CharField(max_length=32, unique=True)
+    image = models.ImageField(upload_to='qrcodes/')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.token_id} (pooled)"
+
+
+class SequenceLease(models.Model):
+    """
+    A contiguous block of token numbers leased to a kiosk (hi/lo style).
+
+    The kiosk prints tokens from ``[start_number, end_number)`` locally and
+    reports them back in batches. ``high_water`` is the highest number
+    registered so far. Leased numbers are never handed out again, so an
+    expired lease still accepts late registrations; only the daily reset
+    (``returned``) closes it. ``leased_by`` is the kiosk's account, the only
+    one that may register tokens from the lease.
+    """
+    ACTIVE = 'active'
+    EXPIRED = 'expired'
+    RETURNED = 'returned'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Active'),
+        (EXPIRED, 'Expired'),
+        (RETURNED, 'Returned'),
+    ]
+
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="sequence_leases")
+    kiosk_id = models.CharField(max_length=64)
+    leased_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="sequence_leases"
+    )
+    prefix = models.CharField(max_length=8)
+    start_number = models.PositiveIntegerField()
+    count = models.PositiveIntegerField()
+    high_water = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=ACTIVE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "expires_at"])]
+
+    def __str__(self):
+        return f"{self.kiosk_id}: {self.prefix}{self.start_number}-{self.end_number - 1} ({self.status})"
+
+    @property
+    def end_number(self):
+        return self.start_number + self.count
+
+    @property
+    def remaining(self):
+        """Unused numbers at the top of the block."""
+        return self.end_number - 1 - self.high_water
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response for an ``Idempotency-Key`` sent to an issuance endpoint,
+    replayed to retries until ``expires_at``. ``status_code`` is null while
+    the first request is still running; a record left that way longer than
+    ``IDEMPOTENCY_IN_PROGRESS_SECONDS`` (from ``created_at``) is reclaimed.
+    """
+    scope = models.CharField(max_length=32)
+    key = models.CharField(max_length=128)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["scope", "key"], name="unique_idempotency_key")]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key} -> {self.status_code}"
+
+
+class SharedSequence(models.Model):
+    """
+    Named counters every worker and cron process sees alike: the
+    configuration version (tokens/config.py), the queue engine epoch
+    (tokens/engine.py) and each category's event stream numbering
+    (tokens/notifications.py).
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}={self.value}"
+
+    @classmethod
+    def advance(cls, name, by=1):
+        """Add ``by`` to ``name`` and return the new value. The row stays locked until the transaction ends."""
+        with transaction.atomic():
+            if not cls.objects.filter(name=name).update(value=models.F("value") + by):
+                cls.objects.get_or_create(name=name)
+                cls.objects.filter(name=name).update(value=models.F("value") + by)
+            return cls.objects.filter(name=name).values_list("value", flat=True).get()
+
+    @classmethod
+    def advance_many(cls, names):
+        """
+        Add one to each of ``names`` and return ``{name: new value}``, in one
+        UPDATE ... RETURNING once the rows exist. The rows stay locked until
+        the transaction ends.
+        """
+        names = sorted(set(names))
+        if not names:
+            return {}
+        with transaction.atomic():
+            advanced = cls._advance_existing(names)
+            missing = [name for name in names if name not in advanced]
+            if missing:
+                cls.objects.bulk_create([cls(name=name) for name in missing], ignore_conflicts=True)
+                advanced.update(cls._advance_existing(missing))
+        return advanced
+
+    @classmethod
+    def _advance_existing(cls, names):
+        quote = connection.ops.quote_name
+        meta = cls._meta
+        name, value = quote(meta.get_field("name").column), quote(meta.get_field("value").column)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {quote(meta.db_table)} SET {value} = {value} + 1 "
+                f"WHERE {name} IN ({', '.join(['%s'] * len(names))}) RETURNING {name}, {value}",
+                names,
+            )
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def read(cls, name):
+        return cls.objects.filter(name=name).values_list("value", flat=True).first() or 0
+
+
+class ThrottleBucket(models.Model):
+    """
+    One token bucket of the issuance throttles (tokens/throttling.py):
+    ``tokens`` left as of ``refilled_at`` (Unix seconds). A bucket idle long
+    enough to refill is the same as no row, so old rows can be deleted.
+    """
+    key = models.CharField(max_length=200, primary_key=True)
+    tokens = models.FloatField()
+    refilled_at = models.FloatField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.1f}"
+
+
+class StreamSummary(models.Model):
+    """
+    The streaming statistics of one series of durations (tokens/estimates.py):
+    ``stream`` is ``arrival``, ``interval`` or ``service`` of one category or
+    desk. Shared by every worker and cron process; each update locks the row.
+    """
+    scope = models.CharField(max_length=16)
+    scope_id = models.BigIntegerField()
+    stream = models.CharField(max_length=16)
+    mean = models.FloatField(null=True, blank=True)
+    var = models.FloatField(default=0.0)
+    count = models.BigIntegerField(default=0)
+    last_at = models.FloatField(null=True, blank=True)
+    buckets = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "scope_id", "stream"], name="unique_stream_summary"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.scope_id} {self.stream}: {self.count} samples"
+
+
 class QRSettings(models.Model):
     size = models.IntegerField(default=256)
     border = models.IntegerField(default=4)
@@ -80,13 +462,23 @@ class QRSettings(models.Model):
     generation_start_time = models.TimeField(default="09:00")
     generation_end_time = models.TimeField(default="18:00")
     daily_reset = models.BooleanField(default=True)
-   
+    reset_time = models.TimeField(default="00:00")  # local time the day rolls over
+    last_reset_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"QR Settings (size={self.size}, border={self.border}, error_correction={self.error_correction}, expiry_hours={self.expiry_hours})"
 
 
 class QRCode(models.Model):
+    RENDER_PENDING = 'pending'
+    RENDER_READY = 'ready'
+    RENDER_FAILED = 'failed'
+    RENDER_STATUS_CHOICES = [
+        (RENDER_PENDING, 'Pending'),
+        (RENDER_READY, 'Ready'),
+        (RENDER_FAILED, 'Failed'),
+    ]
+
     token = models.ForeignKey('Token', on_delete=models.CASCADE, related_name='qrcodes')
     category = models.ForeignKey('users.Category', on_delete=models.CASCADE, default=1)
     image = models.ImageField(upload_to='qrcodes/', blank=True, null=True)
@@ -96,16 +488,27 @@ class QRCode(models.Model):
     generated_at = models.DateTimeField(auto_now_add=True)
     payload = models.JSONField(default=dict, blank=True)  # If you want to store QR payload
     format = models.CharField(max_length=10, default='PNG')  # For QR image format
+    render_status = models.CharField(max_length=10, choices=RENDER_STATUS_CHOICES, default=RENDER_READY)
+    # Precomputed by expire_qr_codes, so verification checks a flag instead of comparing dates
+    expired = models.BooleanField(default=False)
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL
     )
 
+    class Meta:
+        # The expiry sweep reads only codes not yet flagged, in expiry order
+        indexes = [models.Index(fields=["expires_at"], condition=models.Q(expired=False), name="tokens_qr_unexpired_idx")]
+
     def __str__(self):
         return f"QR for {self.token} (expires {self.expires_at})"
 
 
 class QRScan(models.Model):
     qr = models.ForeignKey(QRCode, on_delete=models.SET_NULL, null=True, blank=True, related_name="scans")
+    # Set instead of ``qr`` once the QR code has been archived by the daily reset
+    qr_history = models.ForeignKey(
+        'QRCodeHistory', on_delete=models.SET_NULL, null=True, blank=True, related_name="scans"
+    )
     scanned_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL
     )
@@ -122,7 +525,88 @@ class QRScan(models.Model):
     details = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
-        return f"Scan {self.id}: {self.qr.token.token_id} @ {self.scan_time.isoformat()}"
+        qr = self.qr or self.qr_history
+        return f"Scan {self.id}: {qr.token.token_id if qr else 'INVALID'} @ {self.scan_time.isoformat()}"
+
+
+class Counter(models.Model):
+    """
+    A service desk. ``current_token`` is the token the desk is serving right
+    now, so call-next, complete, recall and transfer are keyed on the desk
+    instead of searching the token table for a "called" row.
+    """
+    name = models.CharField(max_length=32, unique=True)
+    categories = models.ManyToManyField(Category, blank=True, related_name="counters")
+    staff = models.OneToOneField(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="counter"
+    )
+    current_token = models.OneToOneField(
+        Token, null=True, blank=True, on_delete=models.SET_NULL, related_name="serving_counter"
+    )
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["name"]
+
+    def __str__(self):
+        return self.name
+
+
+class TokenHistory(models.Model):
+    """
+    A token moved out of the hot ``Token`` table by the daily reset.
+
+    Rows keep the primary key they had in ``Token``; ``token_id`` is not
+    unique here because numbering restarts every day.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    token_id = models.CharField(max_length=32, db_index=True)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="token_history")
+    queue_position = models.IntegerField(default=0)
+    status = models.CharField(max_length=20, choices=Token.STATUS_CHOICES)
+    issued_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    issued_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    source = models.CharField(max_length=20, default="public")
+    called_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    called_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["category", "issued_at"])]
+
+    def __str__(self):
+        return f"{self.token_id} ({self.category}) - {self.status}, archived {self.archived_at:%Y-%m-%d}"
+
+
+class QRCodeHistory(models.Model):
+    """A QR code archived together with its token; keeps the original primary key."""
+    id = models.BigIntegerField(primary_key=True)
+    token = models.ForeignKey(TokenHistory, on_delete=models.CASCADE, related_name='qrcodes')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="+")
+    image = models.ImageField(upload_to='qrcodes/', blank=True, null=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    expired = models.BooleanField(default=False)
+    data = models.CharField(max_length=128, default="UNKNOWN")
+    checksum = models.CharField(max_length=128, blank=True, null=True)
+    generated_at = models.DateTimeField()
+    payload = models.JSONField(default=dict, blank=True)
+    format = models.CharField(max_length=10, default='PNG')
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Archived QR for {self.token.token_id} (expired {self.expires_at})"
 
 
 class QRTemplate(models.Model):
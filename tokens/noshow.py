@@ -0,0 +1,102 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from .config import get_config
+from .dispatch import flush_engine
+from .models import CategorySchedule, Counter, Token, TokenSequence
+from .notifications import broadcast_each
+from .positions import tombstone
+from .transitions import transition_many
+
+
+NO_SHOW_SECONDS = getattr(settings, "TOKEN_NO_SHOW_SECONDS", 900)
+NO_SHOW_ACTION = getattr(settings, "TOKEN_NO_SHOW_ACTION", CategorySchedule.NO_SHOW)
+BATCH_SIZE = getattr(settings, "TOKEN_NO_SHOW_BATCH_SIZE", 500)
+
+
+def _policies():
+    """
+    ``(policy, category_ids, excluded)`` triples, ``policy`` being
+    ``(timeout_seconds, action)``: one per policy a schedule overrides with
+    the categories using it, then the default for every other category.
+    """
+    default = (NO_SHOW_SECONDS, NO_SHOW_ACTION)
+    groups = defaultdict(list)
+    for category_id, schedule in get_config().schedules.items():
+        policy = (schedule.no_show_seconds or NO_SHOW_SECONDS, schedule.no_show_action or NO_SHOW_ACTION)
+        if policy != default:
+            groups[policy].append(category_id)
+    overridden = [category_id for ids in groups.values() for category_id in ids]
+    return [(policy, ids, None) for policy, ids in groups.items()] + [(default, None, overridden)]
+
+
+def sweep_no_shows(now=None, batch_size=None):
+    """
+    Move tokens left called past their category's timeout to no-show, or
+    back to the end of their line, and free the desks holding them.
+
+    Stale tokens are found through the ``(status, called_at)`` index, one
+    query per distinct timeout, and handled ``batch_size`` at a time: one
+    conditional UPDATE per batch (plus one position UPDATE per category when
+    requeueing), one desk UPDATE and one ``tokens_no_show`` notification
+    per category. Returns ``{"noshow": n, "requeued": n, "batches": n}``.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or BATCH_SIZE
+    flush_engine()
+    totals = {"noshow": 0, "requeued": 0, "batches": 0}
+    for (seconds, action), category_ids, excluded in _policies():
+        stale = Token.objects.filter(status="called", called_at__lt=now - timedelta(seconds=seconds))
+        if category_ids is not None:
+            stale = stale.filter(category_id__in=category_ids)
+        elif excluded:
+            stale = stale.exclude(category_id__in=excluded)
+        while True:
+            pks = list(stale.order_by("called_at").values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            moved = _sweep_batch(pks, action, now)
+            totals["requeued" if action == CategorySchedule.REQUEUE else "noshow"] += moved
+            totals["batches"] += 1
+            if len(pks) < batch_size:
+                break
+    return totals
+
+
+def _sweep_batch(pks, action, now):
+    with transaction.atomic():
+        if action == CategorySchedule.REQUEUE:
+            rows = transition_many(
+                pks, "waiting", ("called",), now=now, notify=False, called_by_id=None, called_at=None,
+            )
+            _requeue(rows)
+        else:
+            rows = transition_many(pks, "noshow", ("called",), now=now, notify=False)
+        if not rows:
+            return 0
+        Counter.objects.filter(current_token_id__in=[row.pk for row in rows]).update(current_token=None, updated_at=now)
+        by_category = defaultdict(list)
+        for row in rows:
+            by_category[row.category_id].append(row.token_id)
+        message = {"event": "tokens_no_show", "action": action}
+        transaction.on_commit(lambda: broadcast_each(message, by_category))
+    return len(rows)
+
+
+def _requeue(rows):
+    # Requeued tokens take fresh positions at the back of their own line, one block per category;
+    # the positions they had stay empty
+    tombstone((row.category_id, row.queue_position) for row in rows)
+    by_category = defaultdict(list)
+    for row in sorted(rows, key=lambda row: row.queue_position):
+        by_category[row.category_id].append(row.pk)
+    for category_id, pks in by_category.items():
+        block = TokenSequence.allocate(get_config().category(category_id), count=len(pks), numbers=False)
+        Token.objects.filter(pk__in=pks).update(queue_position=Case(
+            *(When(pk=pk, then=Value(block.position(offset))) for offset, pk in enumerate(pks)),
+        ))
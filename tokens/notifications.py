@@ -0,0 +1,146 @@
+from collections import defaultdict, deque
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .models import SharedSequence
+
+
+# Sockets join one group per category they watch; staff browsers also join
+# STAFF_GROUP (scan events), and admin dashboards join only ADMIN_GROUP,
+# which receives every event once. See tokens/consumers.py.
+STAFF_GROUP = "staff"
+ADMIN_GROUP = "admins"
+
+
+def category_group(category_id):
+    return f"category-{category_id}"
+
+
+# Numbered deltas kept per category for sockets resuming after a reconnect
+REPLAY_SIZE = getattr(settings, "TOKEN_STREAM_REPLAY_SIZE", 500)
+
+_rings = defaultdict(lambda: deque(maxlen=REPLAY_SIZE))
+
+
+def _seq_key(category_id):
+    return f"token-stream-seq:{category_id}"
+
+
+def next_seq(category_id):
+    """
+    The next number in ``category_id``'s event stream. Numbers come from a
+    ``SharedSequence`` row, so web workers and cron commands
+    (``sweep_no_shows``, ``expire_qr_codes``) draw from one sequence.
+    """
+    return SharedSequence.advance(_seq_key(category_id))
+
+
+def next_seqs(category_ids):
+    """``next_seq`` for several categories at once: ``{category_id: number}`` from one statement."""
+    keys = {_seq_key(category_id): category_id for category_id in category_ids}
+    return {keys[key]: seq for key, seq in SharedSequence.advance_many(keys).items()}
+
+
+def current_seq(category_id):
+    """The number of the last event sent to ``category_id``'s watchers."""
+    return SharedSequence.read(_seq_key(category_id))
+
+
+def remember(message):
+    """
+    Keep a numbered delta in this process's replay ring for its category.
+    Deltas are stored when broadcast, whether or not a socket is connected,
+    and again when received from another process; only the first copy is
+    kept, and a delta that overtook an older one is put back in order.
+    """
+    ring, seq = _rings[message["category_id"]], message["seq"]
+    if not ring or seq > ring[-1]["seq"]:
+        ring.append(message)
+    elif seq != ring[-1]["seq"] and all(kept["seq"] != seq for kept in ring):
+        ordered = sorted([*ring, message], key=lambda kept: kept["seq"])
+        ring.clear()
+        ring.extend(ordered[-REPLAY_SIZE:])
+
+
+def missed(category_id, after, latest):
+    """
+    The deltas of ``category_id`` numbered after ``after``, if this process
+    holds every one of them up to ``latest`` (the last number sent);
+    ``None`` when some are gone or never reached this process, and the
+    socket needs a snapshot instead.
+    """
+    if not 0 <= latest - after <= REPLAY_SIZE:
+        return None
+    deltas = [message for message in _rings.get(category_id, ()) if message["seq"] > after]
+    if [message["seq"] for message in deltas] != list(range(after + 1, latest + 1)):
+        return None
+    return deltas
+
+
+def _send(groups, message):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    for group in groups:
+        async_to_sync(layer.group_send)(group, {"type": "send_notification", "message": message})
+
+
+def _delta(message, category_id, seq=None):
+    delta = dict(message, category_id=category_id, seq=seq or next_seq(category_id))
+    remember(delta)
+    return delta
+
+
+def broadcast(message, category_id):
+    """
+    Send ``message`` to the sockets watching ``category_id``, numbered as
+    the next delta of that category's stream, and to admins; a no-op
+    without a channel layer.
+    """
+    if get_channel_layer() is None:
+        return
+    _send([category_group(category_id)], _delta(message, category_id))
+    _send([ADMIN_GROUP], message)
+
+
+def _part(message, entries, key):
+    return dict(message, count=sum(len(entry[key]) for entry in entries), categories=entries)
+
+
+def broadcast_each(message, items_by_category, key="token_ids"):
+    """
+    Send one event about tokens of several categories. Each category's
+    watchers get ``message`` with only their category's entry in
+    ``categories`` (``{"id", key}``), as a numbered delta, all numbered by
+    one statement; admins get every entry in one message. A socket watching two categories gets each part
+    once, never the same message twice.
+    """
+    if get_channel_layer() is None:
+        return
+    entries = [{"id": category_id, key: items} for category_id, items in items_by_category.items()]
+    seqs = next_seqs(items_by_category)
+    for entry in entries:
+        _send([category_group(entry["id"])], _delta(_part(message, [entry], key), entry["id"], seqs[entry["id"]]))
+    _send([ADMIN_GROUP], _part(message, entries, key))
+
+
+def broadcast_tokens(status, tokens):
+    """
+    Once the transaction commits, send a ``tokens_updated`` delta for
+    ``tokens`` (``(category_id, token_id, queue_position)``) that moved to
+    ``status``: one message per category touched.
+    """
+    by_category = defaultdict(list)
+    for category_id, token_id, position in tokens:
+        by_category[category_id].append({"token_id": token_id, "queue_position": position})
+    if by_category:
+        message = {"event": "tokens_updated", "status": status}
+        transaction.on_commit(lambda: broadcast_each(message, by_category, key="tokens"))
+
+
+def broadcast_staff(message):
+    """Send a staff-only ``message`` (scan activity) to staff browsers and admins."""
+    _send([STAFF_GROUP, ADMIN_GROUP], message)
@@ -0,0 +1,228 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Token, TokenSequence
+
+
+# Departed positions remembered per category; past this many the category counts waiting rows instead
+TOMBSTONE_LIMIT = getattr(settings, "TOKEN_TOMBSTONE_LIMIT", 1000)
+
+
+def advance_serving(category_id, position):
+    """
+    Move the category's now-serving cursor past ``position`` (just dispatched)
+    once the current transaction commits. The cursor stops right before the
+    next waiting token, so the head of the line is exact; tombstones it
+    jumps over are forgotten.
+    """
+    transaction.on_commit(lambda: _locked(category_id, _advance, position))
+
+
+def tombstone(departed):
+    """
+    Record tokens that left the waiting line other than by being dispatched
+    (called by number, completed while waiting, issued already called,
+    deleted, ...). ``departed`` holds ``(category_id, queue_position)``
+    pairs. Positions behind the now-serving cursor are ignored, and a
+    departure from the head of the line moves the cursor instead. Recording
+    a position twice is harmless. Applied on commit.
+    """
+    by_category = defaultdict(set)
+    for category_id, position in departed:
+        by_category[category_id].add(position)
+    if by_category:
+        transaction.on_commit(lambda: _each(by_category, _bury))
+
+
+def requeued(pks):
+    """
+    Tokens ``pks`` went back to waiting; on commit their current positions
+    leave the tombstones, and a position behind the cursor moves the cursor
+    back to it.
+    """
+    pks = list(pks)
+    if pks:
+        transaction.on_commit(lambda: _each(_waiting_positions(pks), _unbury))
+
+
+def _waiting_positions(pks):
+    by_category = defaultdict(set)
+    rows = Token.objects.filter(pk__in=pks, status="waiting").values_list("category_id", "queue_position")
+    for category_id, position in rows:
+        by_category[category_id].add(position)
+    return by_category
+
+
+def _each(by_category, apply):
+    for category_id, positions in by_category.items():
+        _locked(category_id, apply, positions)
+
+
+def _locked(category_id, apply, *args):
+    with transaction.atomic():
+        sequence = TokenSequence.objects.select_for_update().filter(category_id=category_id).first()
+        if sequence is not None and apply(sequence, *args) is not False:
+            sequence.save(update_fields=["serving_position", "buried", "updated_at"])
+
+
+def _head_after(category_id, position):
+    return (
+        Token.objects.filter(category_id=category_id, status="waiting", queue_position__gt=position)
+        .order_by("queue_position").values_list("queue_position", flat=True).first()
+    )
+
+
+def _set_buried(sequence, positions):
+    positions = sorted(position for position in positions if position > sequence.serving_position)
+    sequence.buried = positions if len(positions) <= TOMBSTONE_LIMIT else None
+
+
+def _advance(sequence, position):
+    if sequence.serving_position >= position:
+        return False
+    head = _head_after(sequence.category_id, position)
+    sequence.serving_position = (head or sequence.next_position) - 1
+    if head is None:
+        # An empty line has nothing ahead of anyone: an overflowed category starts tracking again
+        sequence.buried = []
+    elif sequence.buried is not None:
+        _set_buried(sequence, sequence.buried)
+    return True
+
+
+def _bury(sequence, positions):
+    ahead = {position for position in positions if position > sequence.serving_position}
+    if not ahead:
+        return False
+    if sequence.buried is not None:
+        _set_buried(sequence, ahead.union(sequence.buried))
+    if sequence.serving_position + 1 in ahead:
+        _advance(sequence, sequence.serving_position + 1)
+    return True
+
+
+def _unbury(sequence, positions):
+    cursor = sequence.serving_position
+    behind = [position for position in positions if position <= cursor]
+    if behind:
+        # The line now starts further back: what lies between the new cursor and the old one and is not
+        # waiting becomes a tombstone
+        sequence.serving_position = min(behind) - 1
+        waiting = set(
+            Token.objects.filter(
+                category_id=sequence.category_id, status="waiting",
+                queue_position__gt=sequence.serving_position, queue_position__lte=cursor,
+            ).values_list("queue_position", flat=True)
+        )
+        gone = set(range(sequence.serving_position + 1, cursor + 1)) - waiting
+        if sequence.buried is not None:
+            _set_buried(sequence, gone.union(sequence.buried))
+    elif sequence.buried is not None:
+        _set_buried(sequence, set(sequence.buried) - set(positions))
+    else:
+        return False
+    return True
+
+
+@receiver(post_delete, sender=Token, dispatch_uid="tokens-positions-tombstone")
+def _token_deleted(sender, instance, **kwargs):
+    # A deleted waiting token leaves a gap no row describes any more
+    if instance.status == "waiting":
+        tombstone([(instance.category_id, instance.queue_position)])
+
+
+def _gaps(positions):
+    # Positions between consecutive waiting tokens that no waiting token holds
+    for before, after in zip(positions, positions[1:]):
+        yield from range(before + 1, after)
+
+
+def resync(sequence):
+    """
+    Recompute ``sequence``'s cursor and tombstones from the token table
+    (after a reset or a bulk change). Sets the fields; the caller saves.
+    """
+    waiting = list(
+        Token.objects.filter(category_id=sequence.category_id, status="waiting")
+        .order_by("queue_position").values_list("queue_position", flat=True)
+    )
+    sequence.serving_position = max((waiting[0] if waiting else sequence.next_position) - 1, 0)
+    _set_buried(sequence, _bounded(_gaps(waiting)))
+    return sequence
+
+
+def _bounded(positions):
+    # At most one past the limit, enough for _set_buried to see the overflow
+    bounded = []
+    for position in positions:
+        bounded.append(position)
+        if len(bounded) > TOMBSTONE_LIMIT:
+            break
+    return bounded
+
+
+def resync_categories(category_ids=None):
+    """
+    ``resync`` the sequences of ``category_ids`` (``None`` for all): one
+    UPDATE for every cursor, then the tombstones from one ordered read of
+    the waiting positions.
+    """
+    sequences = TokenSequence.objects.all()
+    if category_ids is not None:
+        sequences = sequences.filter(category_id__in=category_ids)
+    head = (
+        Token.objects.filter(category_id=OuterRef("category_id"), status="waiting")
+        .order_by("queue_position").values("queue_position")[:1]
+    )
+    waiting = Token.objects.filter(status="waiting")
+    if category_ids is not None:
+        waiting = waiting.filter(category_id__in=category_ids)
+    now = timezone.now()
+    with transaction.atomic():
+        sequences.update(
+            serving_position=Greatest(Coalesce(Subquery(head), F("next_position")) - 1, Value(0)), updated_at=now,
+        )
+        positions = defaultdict(list)
+        rows = waiting.order_by("category_id", "queue_position").values_list("category_id", "queue_position")
+        for category_id, position in rows.iterator():
+            positions[category_id].append(position)
+        locked = list(sequences.select_for_update())
+        for sequence in locked:
+            _set_buried(sequence, _bounded(_gaps(positions.get(sequence.category_id, []))))
+        TokenSequence.objects.bulk_update(locked, ["buried"])
+
+
+def queue_standing(token, sequence):
+    """
+    ``(people_ahead, position)`` for a waiting token from its category's
+    cursors; ``None`` for tokens that are not waiting.
+
+    The cursor sits just before the first waiting token, so everything
+    between it and the token is ahead except the tombstones in that range,
+    which the sequence row lists: no query. A category with more than
+    ``TOMBSTONE_LIMIT`` of them counts the waiting tokens ahead instead,
+    over the ``(category, status, queue_position)`` index.
+    """
+    if token.status != "waiting" or sequence is None:
+        return None
+    gap = max(token.queue_position - sequence.serving_position - 1, 0)
+    if not gap:
+        ahead = 0
+    elif sequence.buried is None:
+        ahead = Token.objects.filter(
+            category_id=token.category_id, status="waiting",
+            queue_position__gt=sequence.serving_position, queue_position__lt=token.queue_position,
+        ).count()
+    else:
+        buried = sequence.buried
+        ahead = gap - (bisect_left(buried, token.queue_position) - bisect_right(buried, sequence.serving_position))
+    ahead = max(ahead, 0)
+    return ahead, ahead + 1
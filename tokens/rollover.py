@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import logging
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef, Q
+from django.utils import timezone
+
+from .engine import invalidate_engine
+from .positions import resync
+from .throttling import prune_buckets
+from .models import (
+    Token, QRCode, QRScan, QRSettings, TokenSequence, PooledToken, SequenceLease,
+    TokenHistory, QRCodeHistory,
+)
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK_SIZE = getattr(settings, "TOKEN_ARCHIVE_CHUNK_SIZE", 500)
+# PostgreSQL advisory lock key held by the running daily reset
+RESET_LOCK_ID = 0x746F6B656E5F7273  # b"token_rs"
+
+TOKEN_HISTORY_FIELDS = [
+    "id", "token_id", "category_id", "queue_position", "status", "issued_at",
+    "updated_at", "created_by_id", "issued_by_id", "source", "called_by_id", "called_at",
+]
+QR_HISTORY_FIELDS = [
+    "id", "token_id", "category_id", "image", "expires_at", "expired", "data", "checksum",
+    "generated_at", "payload", "format", "created_by_id",
+]
+
+
+def reset_boundary(qr_settings, now=None):
+    """The most recent local ``reset_time`` at or before ``now``."""
+    now = timezone.localtime(now or timezone.now())
+    boundary = timezone.make_aware(datetime.combine(now.date(), qr_settings.reset_time))
+    if boundary > now:
+        boundary -= timedelta(days=1)
+    return boundary
+
+
+def reset_due(qr_settings, now=None):
+    if qr_settings is None or not qr_settings.daily_reset:
+        return False
+    boundary = reset_boundary(qr_settings, now)
+    return qr_settings.last_reset_at is None or qr_settings.last_reset_at < boundary
+
+
+def archivable_tokens(before):
+    """
+    Tokens issued before ``before`` that are done with: completed ones,
+    no-shows, and tokens whose QR code has expired (flagged, or past its
+    ``expires_at`` by ``before``). Other waiting, called and in-progress
+    tokens carry over into the new day and keep their numbers.
+    """
+    expired_qr = QRCode.objects.filter(token=OuterRef("pk"), expires_at__lt=before)
+    return Token.objects.filter(issued_at__lt=before).filter(
+        Q(status__in=["completed", "noshow"]) | Q(qr_expired=True) | Exists(expired_qr),
+    )
+
+
+def archive_tokens(before, chunk_size=None, now=None):
+    """
+    Move archivable tokens and their QR codes into the history tables, one
+    chunk per transaction, walking the table in primary key order. Scans of
+    the archived QR codes are re-pointed at ``QRCodeHistory`` and desk scans
+    of the archived tokens at ``TokenHistory``. Rows locked
+    by a request in flight are skipped and picked up by the next run.
+    Returns the number of tokens archived.
+    """
+    from scans.models import Scan
+
+    chunk_size = chunk_size or ARCHIVE_CHUNK_SIZE
+    now = now or timezone.now()
+    candidates = archivable_tokens(before)
+    archived, last_id = 0, 0
+    while True:
+        ids = list(candidates.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+        if not ids:
+            return archived
+        last_id = ids[-1]
+        with transaction.atomic():
+            # Re-check under lock: a token may have been called since the ids were read
+            rows = list(
+                candidates.filter(pk__in=ids).select_for_update(skip_locked=True).values(*TOKEN_HISTORY_FIELDS)
+            )
+            token_pks = [row["id"] for row in rows]
+            qr_rows = list(QRCode.objects.filter(token__in=token_pks).values(*QR_HISTORY_FIELDS))
+            qr_pks = [row["id"] for row in qr_rows]
+
+            TokenHistory.objects.bulk_create([TokenHistory(archived_at=now, **row) for row in rows])
+            QRCodeHistory.objects.bulk_create([QRCodeHistory(archived_at=now, **row) for row in qr_rows])
+            QRScan.objects.filter(qr__in=qr_pks).update(qr_history_id=F("qr_id"), qr=None)
+            Scan.objects.filter(token__in=token_pks).update(token_history_id=F("token_id"), token=None)
+            QRCode.objects.filter(pk__in=qr_pks).delete()
+            Token.objects.filter(pk__in=token_pks).delete()
+        archived += len(token_pks)
+
+
+def reset_sequence(sequence_id, now=None):
+    """
+    Restart one category's numbering and queue positions.
+
+    Counters go back to 1 unless tokens carried over into the new day still
+    hold numbers, in which case they continue after the highest one so
+    ``token_id`` stays unique. The now-serving cursor moves to just before
+    the first carried-over waiting token. Pooled tokens and kiosk leases
+    reserved numbers from the old day, so they are dropped. Returns the
+    sequence.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        sequence = TokenSequence.objects.select_for_update().get(pk=sequence_id)
+        # Pooled tokens being claimed right now are locked; they keep their number and count as carried over
+        unclaimed = PooledToken.objects.select_for_update(skip_locked=True).filter(category_id=sequence.category_id)
+        PooledToken.objects.filter(pk__in=list(unclaimed.values_list("pk", flat=True))).delete()
+        SequenceLease.objects.filter(category_id=sequence.category_id).exclude(
+            status=SequenceLease.RETURNED,
+        ).update(status=SequenceLease.RETURNED)
+
+        pattern = re.compile(rf"^{sequence.prefix}(\d+)$")
+        held = list(Token.objects.filter(token_id__startswith=sequence.prefix).values_list("token_id", flat=True))
+        held += PooledToken.objects.filter(category_id=sequence.category_id).values_list("token_id", flat=True)
+        numbers = [int(match.group(1)) for match in map(pattern.match, held) if match]
+        max_position = Token.objects.filter(category_id=sequence.category_id).aggregate(
+            Max("queue_position"),
+        )["queue_position__max"]
+
+        sequence.next_number = max(numbers, default=0) + 1
+        sequence.next_position = (max_position or 0) + 1
+        sequence.reset_at = now
+        resync(sequence)
+        sequence.save(update_fields=[
+            "next_number", "next_position", "serving_position", "buried", "reset_at", "updated_at",
+        ])
+    return sequence
+
+
+@contextmanager
+def reset_lock():
+    """
+    Whether this process may run the daily reset: on PostgreSQL a
+    session-level advisory lock, held across the reset's many transactions
+    and released when it ends (or its connection dies). Other backends run
+    the reset unguarded.
+    """
+    if connection.vendor != "postgresql":
+        yield True
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [RESET_LOCK_ID])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [RESET_LOCK_ID])
+
+
+def run_daily_reset(force=False, chunk_size=None, now=None):
+    """
+    Roll the queue over to a new day if the configured boundary has passed
+    since the last reset (or ``force`` is set): archive finished and expired
+    tokens, restart every category's sequence and drop idle throttle
+    buckets. One process at a time runs it (``reset_lock``). Returns ``None`` when nothing was due, else a dict with ``archived``
+    and ``sequences`` counts.
+    """
+    now = now or timezone.now()
+    qr_settings = QRSettings.objects.first()
+    if not force and not reset_due(qr_settings, now):
+        return None
+    with reset_lock() as acquired:
+        if not acquired:
+            logger.info("Daily reset already running; skipping")
+            return None
+        if not force and not reset_due(QRSettings.objects.first(), now):
+            # Another process finished the reset between the check above and taking the lock
+            return None
+        boundary = reset_boundary(qr_settings, now) if qr_settings else now
+        archived = archive_tokens(boundary, chunk_size=chunk_size, now=now)
+        sequence_ids = list(TokenSequence.objects.values_list("pk", flat=True))
+        for sequence_id in sequence_ids:
+            reset_sequence(sequence_id, now)
+        if qr_settings is not None:
+            QRSettings.objects.filter(pk=qr_settings.pk).update(last_reset_at=now)
+        prune_buckets()
+        invalidate_engine()
+    return {"archived": archived, "sequences": len(sequence_ids)}
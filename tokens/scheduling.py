@@ -0,0 +1,155 @@
+from collections import deque, namedtuple
+import heapq
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .config import get_config
+
+
+Candidate = namedtuple("Candidate", ["key", "category_id", "weight", "priority", "waited", "pass_value", "aged"])
+
+
+class CategoryState:
+    __slots__ = ("pass_value", "served", "aged")
+
+    def __init__(self, pass_value=0.0):
+        self.pass_value = pass_value
+        self.served = 0
+        self.aged = 0
+
+
+class Ranking:
+    """
+    Candidate categories, best first. Built fresh for every pick: O(k) to
+    heapify k categories, then one pop per category tried.
+    """
+
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self._heap = list(candidates)
+        heapq.heapify(self._heap)
+
+    def __iter__(self):
+        while self._heap:
+            yield heapq.heappop(self._heap)
+
+
+class FairScheduler:
+    """
+    Picks which category a desk serving several categories calls from next.
+
+    Stride scheduling: every category has a pass value that advances by
+    ``1 / weight`` each time it is served, and the lowest pass wins, so over
+    time categories are served in proportion to their weights. A category
+    that sat empty rejoins at the current virtual time instead of cashing in
+    the turns it missed. ``CategorySchedule.priority`` is compared before the
+    pass, and a head token that has waited ``max_wait_seconds`` puts its
+    category ahead of everything (longest wait first).
+
+    Each pick ranks every category the desk serves from their current heads
+    (one ``waiting_heads`` query without the queue engine), so a pick costs
+    O(k) for k categories rather than a persistent heap's O(log k); desks
+    serve a handful of categories. Pass values are per process, so workers
+    balance independently. The last ``log_size`` decisions are kept for
+    tuning and served by the ``scheduler/`` endpoint.
+    """
+
+    def __init__(self, log_size=200):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.virtual_time = 0.0
+        self.decisions = deque(maxlen=log_size)
+
+    def _params(self, category_id):
+        schedule = get_config().schedules.get(category_id)
+        if schedule is None:
+            return 1, 0, 0
+        return max(schedule.weight, 1), schedule.priority, schedule.max_wait_seconds
+
+    def order(self, heads, now=None):
+        """
+        Rank the categories in ``heads`` ({category_id: issued_at of its
+        first waiting token}). Returns a ``Ranking``.
+        """
+        now = now or timezone.now()
+        candidates = []
+        with self.lock:
+            for category_id, issued_at in heads.items():
+                weight, priority, max_wait = self._params(category_id)
+                state = self.states.get(category_id)
+                if state is None:
+                    state = self.states[category_id] = CategoryState(self.virtual_time)
+                state.pass_value = max(state.pass_value, self.virtual_time)
+                waited = max((now - issued_at).total_seconds(), 0.0) if issued_at else 0.0
+                aged = bool(max_wait) and waited >= max_wait
+                key = (0, -waited, 0.0, category_id) if aged else (1, -priority, state.pass_value, category_id)
+                candidates.append(Candidate(key, category_id, weight, priority, waited, state.pass_value, aged))
+        return Ranking(candidates)
+
+    def charge(self, ranking, chosen, server_id=None, now=None):
+        """
+        Record that ``chosen`` (from ``ranking``) was served and advance its
+        pass, once the transaction that claimed its token commits; a call
+        rolled back charges nothing.
+        """
+        now = now or timezone.now()
+        transaction.on_commit(lambda: self._charge(ranking, chosen, server_id, now))
+
+    def _charge(self, ranking, chosen, server_id, now):
+        if chosen.aged:
+            reason = "aged"
+        elif any(c.priority < chosen.priority for c in ranking.candidates):
+            reason = "priority"
+        else:
+            reason = "weighted"
+        with self.lock:
+            state = self.states[chosen.category_id]
+            self.virtual_time = max(self.virtual_time, state.pass_value)
+            state.pass_value += 1.0 / chosen.weight
+            state.served += 1
+            state.aged += chosen.aged
+            self.decisions.append({
+                "at": now,
+                "server": server_id,
+                "category_id": chosen.category_id,
+                "reason": reason,
+                "candidates": [
+                    {
+                        "category_id": c.category_id,
+                        "weight": c.weight,
+                        "priority": c.priority,
+                        "pass": round(c.pass_value, 4),
+                        "waited_seconds": round(c.waited, 1),
+                    }
+                    for c in sorted(ranking.candidates, key=lambda c: c.key)
+                ],
+            })
+
+    def stats(self):
+        """Per-category pass values and counts plus the recent decisions, for tuning."""
+        config = get_config()
+        with self.lock:
+            categories = []
+            for category_id, state in sorted(self.states.items()):
+                weight, priority, max_wait = self._params(category_id)
+                category = config.categories.get(category_id)
+                categories.append({
+                    "category": {"id": category_id, "name": category.name if category else None},
+                    "weight": weight,
+                    "priority": priority,
+                    "max_wait_seconds": max_wait,
+                    "pass": round(state.pass_value, 4),
+                    "served": state.served,
+                    "aged": state.aged,
+                })
+            return {
+                "virtual_time": round(self.virtual_time, 4),
+                "categories": categories,
+                "decisions": list(reversed(self.decisions)),
+            }
+
+
+scheduler = FairScheduler(log_size=getattr(settings, "TOKEN_SCHEDULER_LOG_SIZE", 200))
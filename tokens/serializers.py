@@ -1,7 +1,6 @@
 from rest_framework import serializers
-from .models import Token, QRCode, QRScan, QRSettings, QRTemplate, AuditLog
+from .models import Token, QRCode, QRScan, QRSettings, QRTemplate, AuditLog, Counter
 from .utils import generate_qr_code
-from django.utils import timezone
 from django.core.files.base import ContentFile
 import qrcode
 from io import BytesIO
@@ -15,16 +14,23 @@ from .utils import generate_qr_code
 
 class TokenSerializer(serializers.ModelSerializer):
     qr_code = serializers.SerializerMethodField()
+    qr_status = serializers.SerializerMethodField()
     category_name = serializers.CharField(source="category.name", read_only=True)
 
     class Meta:
         model = Token
-        fields = ["id", "token_id", "category", "category_name", "status", "issued_at", "qr_code"]
+        fields = ["id", "token_id", "category", "category_name", "status", "issued_at", "qr_code", "qr_status"]
 
-    def get_qr_code(self, obj):
+    def _latest_qr(self, obj):
         if getattr(obj, "source", None) == "manual" or str(obj.token_id).startswith("MAN"):
             return None
-        qr = QRCode.objects.filter(token=obj).order_by('-id').first()
+        if not hasattr(obj, "_latest_qr"):
+            # Freshly issued tokens and queue engine tokens already carry their QR
+            obj._latest_qr = getattr(obj, "qr_code", None) or QRCode.objects.filter(token=obj).order_by('-id').first()
+        return obj._latest_qr
+
+    def get_qr_code(self, obj):
+        qr = self._latest_qr(obj)
         if qr and qr.image:
             request = self.context.get("request")
             url = qr.image.url
@@ -33,6 +39,11 @@ class TokenSerializer(serializers.ModelSerializer):
             return url
         return None
 
+    def get_qr_status(self, obj):
+        # "pending" while the background worker is still rendering the image
+        qr = self._latest_qr(obj)
+        return qr.render_status if qr else None
+
     def create(self, validated_data):
         # Token.save() will auto-generate the QRCode
         return Token.objects.create(**validated_data)
@@ -47,7 +58,8 @@ from .models import QRCode
 class QRCodeSerializer(serializers.ModelSerializer):
     class Meta:
         model = QRCode
-        fields = ['id', 'token', 'category', 'image', 'expires_at', 'data', 'generated_at']
+        fields = ['id', 'token', 'category', 'image', 'render_status', 'expires_at', 'expired', 'data', 'generated_at']
+        read_only_fields = ['render_status']
 
     def create(self, validated_data):
         # Generate QR code image with the 'data' field
@@ -79,6 +91,17 @@ class QRSettingsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+# ----------------------------
+# Counter Serializer
+# ----------------------------
+class CounterSerializer(serializers.ModelSerializer):
+    current_token = serializers.SlugRelatedField(slug_field="token_id", read_only=True)
+
+    class Meta:
+        model = Counter
+        fields = ["id", "name", "categories", "staff", "is_active", "current_token", "updated_at"]
+
+
 # ----------------------------
 # QR Template Serializer
 # ----------------------------
@@ -127,15 +150,17 @@ class ScanActivityReportSerializer(serializers.ModelSerializer):
         ]
 
     def get_token_id(self, obj):
-        if obj.qr:
-            return obj.qr.token.token_id
+        qr = obj.qr or obj.qr_history
+        if qr:
+            return qr.token.token_id
         elif hasattr(obj, 'token'):
             return obj.token.token_id
         return "INVALID"
 
     def get_token_category(self, obj):
-        if obj.qr and obj.qr.token.category:
-            return obj.qr.token.category.name
+        qr = obj.qr or obj.qr_history
+        if qr and qr.token.category:
+            return qr.token.category.name
         elif hasattr(obj, 'token') and obj.token.category:
             return obj.token.category.name
         return None
@@ -148,13 +173,13 @@ class ScanActivityReportSerializer(serializers.ModelSerializer):
     def get_scan_result(self, obj):
         if obj.verification_status == "MANUAL":
             return "MANUAL ENTRY"
-        if not obj.qr:
+        qr = obj.qr or obj.qr_history
+        if not qr:
             return "INVALID"
-        token = obj.qr.token
-        now = timezone.now()
+        token = qr.token
         if token.status == "completed":
             return "ALREADY USED"
-        elif obj.qr.expires_at < now:
+        elif qr.expired:
             return "EXPIRED"
         elif obj.verification_status == "SUCCESS":
             return "VALID"
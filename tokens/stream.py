@@ -0,0 +1,41 @@
+import time
+
+from .engine import get_engine
+from .models import Token
+from .notifications import current_seq
+
+
+# A snapshot is reused by sockets subscribing within this many seconds while no delta was sent
+SNAPSHOT_TTL = 5
+
+_snapshots = {}
+
+
+def snapshot(category_id):
+    """
+    The ``snapshot`` event for ``category_id``: its waiting and called
+    tokens in queue order, numbered with the last delta sent before it was
+    read. Subscribers arriving together (a reconnect storm) share one read.
+    """
+    seq, now = current_seq(category_id), time.monotonic()
+    cached = _snapshots.get(category_id)
+    if cached is not None and cached[0]["seq"] == seq and now - cached[1] < SNAPSHOT_TTL:
+        return cached[0]
+    engine = get_engine()
+    if engine is not None:
+        rows = [(r.token_id, r.status, r.queue_position) for r in engine.tokens([category_id], ("waiting", "called"))]
+    else:
+        rows = (
+            Token.objects.filter(category_id=category_id, status__in=["waiting", "called"])
+            .order_by("queue_position").values_list("token_id", "status", "queue_position")
+        )
+    message = {
+        "event": "snapshot",
+        "category_id": category_id,
+        "seq": seq,
+        "tokens": [
+            {"token_id": token_id, "status": status, "queue_position": position} for token_id, status, position in rows
+        ],
+    }
+    _snapshots[category_id] = (message, now)
+    return message
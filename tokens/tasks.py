@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+
+from .models import QRCode, TokenPool
+from .config import current_qr_settings
+from .engine import get_engine
+from .notifications import broadcast
+from .utils import store_qr_images, token_qr_job
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "QR_RENDER_WORKERS", 2),
+                thread_name_prefix="qr-render",
+            )
+        return _executor
+
+
+def enqueue_qr_render(qr_code_id):
+    """
+    Render the image for a pending QRCode row on the background worker pool
+    once the surrounding transaction commits.
+    """
+    transaction.on_commit(lambda: _get_executor().submit(_run_in_worker, qr_code_id))
+
+
+def _run_in_worker(qr_code_id):
+    close_old_connections()
+    try:
+        render_qr_code(qr_code_id)
+    finally:
+        connection.close()
+
+
+def render_qr_code(qr_code_id):
+    """Render and store the image for one QRCode row, then announce it with a ``qr_ready`` event."""
+    try:
+        qr_code = QRCode.objects.select_related("token__category").get(pk=qr_code_id)
+    except QRCode.DoesNotExist:
+        return None
+    token = qr_code.token
+    try:
+        path = store_qr_images([token_qr_job(token, current_qr_settings())])[0]
+    except Exception:
+        logger.exception("Background QR render failed for token %s", token.token_id)
+        QRCode.objects.filter(pk=qr_code_id).update(render_status=QRCode.RENDER_FAILED)
+        return None
+
+    QRCode.objects.filter(pk=qr_code_id).update(image=path, render_status=QRCode.RENDER_READY)
+    engine = get_engine()
+    if engine is not None:
+        engine.set_qr(token.pk, path, QRCode.RENDER_READY)
+    broadcast({
+        "event": "qr_ready",
+        "token_id": token.token_id,
+        "qr_code_id": qr_code_id,
+        "image": default_storage.url(path),
+    }, token.category_id)
+    return path
+
+
+def schedule_pool_refill(pool_id):
+    """
+    Refill a token pool on the background worker after commit. At most one
+    refill per pool is queued at a time; the refill itself is a no-op until
+    the pool has drained to its threshold.
+    """
+    if not cache.add(f"token-pool-refill:{pool_id}", True, timeout=300):
+        return
+    transaction.on_commit(lambda: _get_executor().submit(_refill_in_worker, pool_id))
+
+
+def _refill_in_worker(pool_id):
+    from .issuance import refill_pool
+
+    close_old_connections()
+    try:
+        pool = TokenPool.objects.select_related("category").filter(pk=pool_id, enabled=True).first()
+        if pool is not None:
+            refill_pool(pool)
+    except Exception:
+        logger.exception("Token pool refill failed for pool %s", pool_id)
+    finally:
+        cache.delete(f"token-pool-refill:{pool_id}")
+        connection.close()
@@ -1,3 +1,1251 @@
-from django.test import TestCase
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import StringIO
+import hashlib
+import json
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from users.models import Category, User
+
+from . import config, estimates, notifications, tasks, throttling
+from .config import get_config
+from .consumers import NotificationConsumer
+from .dispatch import complete_tokens, counter_call_next, dispatch_next, now_serving
+from .emergency import pause_queue, resume_heads
+from .engine import ENGINE_EPOCH_KEY, QueueEngine, get_engine
+from .expiry import expire_qr_codes
+from .idempotency import purge_expired_keys
+from .issuance import (
+    LeaseError, build_qr_code, bulk_issue_tokens, claim_pooled_token, expire_leases, lease_block, refill_pool,
+    register_leased_tokens,
+)
+from .models import (
+    CategorySchedule, Counter, IdempotencyKey, PooledToken, QRCode, QRCodeHistory, QRScan, SequenceLease,
+    SharedSequence, StreamSummary, Token, TokenHistory, TokenPool, TokenSequence, TokenTransition,
+)
+from .noshow import sweep_no_shows
+from .notifications import (
+    ADMIN_GROUP, STAFF_GROUP, broadcast, broadcast_each, category_group, current_seq, missed, next_seq,
+)
+from .positions import queue_standing
+from .rollover import run_daily_reset
+from .scheduling import FairScheduler
+from .throttling import take_token, throttled_counts
+from .transitions import TransitionError, transition, transition_many
+from .utils import (
+    QRRenderJob, QRRenderService, colored_qr_job, qr_job_path, render_qr_bytes, store_qr_images, token_qr_job,
+)
+
+
+# One media root for the whole module: stored_paths remembers images across tests, as it does across requests
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def make_category(name):
+    return Category.objects.create(name=name)
+
+
+def make_token(category, **fields):
+    token = Token(category=category, **fields)
+    token.save(with_qr=False)
+    return token
+
+
+def make_user(username, role="staff", **extra):
+    return User.objects.create_user(username=username, password="secret", role=role, **extra)
+
+
+class TokenTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        config._snapshot = None
+        throttling._empty.clear()
+        self.client = APIClient()
+
+    def login(self, user):
+        self.client.force_authenticate(user)
+        return user
+
+
+class WaitStatisticsTests(TokenTestCase):
+    def test_wait_stats_lists_each_category(self):
+        category = make_category("General")
+        with self.captureOnCommitCallbacks(execute=True):
+            make_token(category)
+            make_token(category)
+        self.login(make_user("staff"))
+        response = self.client.get("/api/tokens/wait-stats/")
+        self.assertEqual(response.status_code, 200)
+        [entry] = response.data["categories"]
+        self.assertEqual(entry["category"], {"id": category.id, "name": "General"})
+        self.assertEqual(entry["arrival"]["samples"], 1)
+        self.assertIn("arrivals_per_hour", entry)
+
+    def record_calls(self, category, *offsets):
+        start = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            for offset in offsets:
+                estimates.record_call(category.id, now=start + timedelta(seconds=offset))
+        return start
+
+    def test_estimated_wait_from_call_intervals(self):
+        category = make_category("General")
+        self.record_calls(category, 0, 60, 120)
+        # Two 60 s gaps: the mean is 60 and the 90th percentile is the top edge of their bucket
+        self.assertEqual(estimates.WaitEstimator(category.id).seconds(2), (180, 224))
+        summary = estimates.category_summary(category.id)["interval"]
+        self.assertEqual(summary, {"mean_seconds": 60.0, "p50_seconds": 85.4, "p90_seconds": 85.4, "samples": 2})
+
+    def test_service_time_feeds_category_and_desk(self):
+        category = make_category("General")
+        called_at = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            estimates.record_service([(category.id, called_at)], counter_id=7, now=called_at + timedelta(seconds=30))
+        # No calls yet: the estimate falls back to the service time
+        self.assertEqual(estimates.WaitEstimator(category.id).seconds(0), (30, 38))
+        self.assertEqual(estimates.counter_summary(7)["service"]["p90_seconds"], 38.0)
+
+    def test_statistics_are_shared_through_the_database(self):
+        category = make_category("General")
+        start = self.record_calls(category, 0, 60)
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            estimates.record_call(category.id, now=start + timedelta(seconds=120))
+        row = StreamSummary.objects.get(scope="category", scope_id=category.id, stream="interval")
+        self.assertEqual(row.count, 2)
+        self.assertEqual(row.mean, 60.0)
+        self.assertEqual(estimates.WaitEstimator(category.id).seconds(0), (60, 85))
+
+
+class CallNextTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.general = make_category("General")
+        self.priority = make_category("Priority")
+        self.manual = make_token(self.general, token_id="MAN001", source="manual", status="called")
+        self.resumed = make_token(self.priority, status="called")
+        self.waiting = make_token(self.general)
+
+    def statuses(self):
+        return dict(Token.objects.values_list("pk", "status"))
+
+    def test_anonymous_call_next_completes_nothing(self):
+        response = self.client.post("/api/tokens/call_next/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["token_id"], self.waiting.token_id)
+        statuses = self.statuses()
+        self.assertEqual(statuses[self.manual.pk], "called")
+        self.assertEqual(statuses[self.resumed.pk], "called")
+        self.assertEqual(statuses[self.waiting.pk], "called")
+
+    def test_staff_call_next_completes_only_their_own_token(self):
+        staff = self.login(make_user("desk"))
+        staff.categories.add(self.general, self.priority)
+        own = make_token(self.general, status="called", called_by=staff)
+        response = self.client.post("/api/tokens/call_next/")
+        self.assertEqual(response.status_code, 200)
+        statuses = self.statuses()
+        self.assertEqual(statuses[own.pk], "completed")
+        self.assertEqual(statuses[self.manual.pk], "called")
+        self.assertEqual(statuses[self.resumed.pk], "called")
+        self.assertEqual(statuses[self.waiting.pk], "called")
+
+
+class DailyResetTests(TokenTestCase):
+    def test_reset_archives_finished_tokens_and_carries_waiting_ones(self):
+        from scans.models import Scan
+
+        category = make_category("General")
+        yesterday = timezone.now() - timedelta(days=1)
+        done = make_token(category, issued_at=yesterday)
+        Token.objects.filter(pk=done.pk).update(status="completed")
+        missed = make_token(category, issued_at=yesterday)
+        Token.objects.filter(pk=missed.pk).update(status="noshow")
+        waiting = make_token(category, issued_at=yesterday)
+        scan = Scan.objects.create(token=done)
+
+        result = run_daily_reset(force=True)
+
+        self.assertEqual(result["archived"], 2)
+        self.assertEqual(list(Token.objects.values_list("pk", flat=True)), [waiting.pk])
+        self.assertEqual(set(TokenHistory.objects.values_list("pk", flat=True)), {done.pk, missed.pk})
+        scan.refresh_from_db()
+        self.assertIsNone(scan.token_id)
+        self.assertEqual(scan.token_history_id, done.pk)
+        # Only the carried-over waiting token still holds a number
+        self.assertEqual(TokenSequence.objects.get(category=category).next_number, 4)
+
+    def test_numbering_restarts_after_scanned_tokens_are_archived(self):
+        from scans.models import Scan
+
+        category = make_category("General")
+        yesterday = timezone.now() - timedelta(days=1)
+        for _ in range(3):
+            token = make_token(category, issued_at=yesterday)
+            Token.objects.filter(pk=token.pk).update(status="completed")
+            Scan.objects.create(token=token)
+
+        run_daily_reset(force=True)
+
+        self.assertFalse(Token.objects.exists())
+        self.assertEqual(make_token(category).token_id, "G001")
+
+    def test_tokens_with_expired_qr_codes_are_archived(self):
+        category = make_category("General")
+        yesterday = timezone.now() - timedelta(days=1)
+        flagged = make_token(category, issued_at=yesterday, qr_expired=True)
+        lapsed = make_token(category, issued_at=yesterday)
+        QRCode.objects.create(token=lapsed, category=category, expires_at=yesterday + timedelta(hours=1))
+        valid = make_token(category, issued_at=yesterday)
+        QRCode.objects.create(token=valid, category=category, expires_at=timezone.now() + timedelta(hours=1))
+
+        result = run_daily_reset(force=True)
+
+        self.assertEqual(result["archived"], 2)
+        self.assertEqual(set(TokenHistory.objects.values_list("pk", flat=True)), {flagged.pk, lapsed.pk})
+        self.assertEqual(QRCodeHistory.objects.get().token_id, lapsed.pk)
+        self.assertEqual(list(Token.objects.values_list("pk", flat=True)), [valid.pk])
+        self.assertEqual(TokenSequence.objects.get(category=category).serving_position, 2)
+
+
+class ConfigSnapshotTests(TokenTestCase):
+    def test_change_by_another_worker_seen_through_the_shared_version(self):
+        category = make_category("General")
+        get_config()
+        # Another worker's edit: the row changes and the shared version moves, this worker's snapshot stays
+        Category.objects.filter(pk=category.pk).update(name="Renamed")
+        config._checked_at = 0.0
+        self.assertEqual(get_config().category(category.pk).name, "General")
+        SharedSequence.advance(config.CONFIG_VERSION_KEY)
+        config._checked_at = 0.0
+        self.assertEqual(get_config().category(category.pk).name, "Renamed")
+
+    def test_stale_snapshot_reloaded_after_max_age(self):
+        category = make_category("General")
+        get_config()
+        Category.objects.filter(pk=category.pk).update(name="Renamed")
+        config._checked_at = 0.0
+        self.assertEqual(get_config().category(category.pk).name, "General")
+        config._checked_at = config._loaded_at = time.monotonic() - config.CONFIG_MAX_AGE
+        self.assertEqual(get_config().category(category.pk).name, "Renamed")
+
+
+class EventStreamTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        notifications._rings.clear()
+        self.category = make_category("General")
+
+    def connect(self, query):
+        async def run():
+            communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f"/ws/?{query}")
+            communicator.scope["user"] = AnonymousUser()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            messages = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                messages.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return messages
+        return async_to_sync(run)()
+
+    def test_deltas_broadcast_without_sockets_are_replayed_on_resume(self):
+        for event in ("one", "two", "three"):
+            broadcast({"event": event}, self.category.pk)
+        self.assertEqual(current_seq(self.category.pk), 3)
+
+        messages = self.connect(f"categories={self.category.pk}&resume={self.category.pk}:1")
+        self.assertEqual([(m["event"], m["seq"]) for m in messages], [("two", 2), ("three", 3)])
+
+    def test_each_category_numbered_by_one_statement(self):
+        others = [make_category("Priority"), make_category("Senior")]
+        broadcast({"event": "one"}, self.category.pk)
+        ids = [self.category.pk] + [other.pk for other in others]
+        broadcast_each({"event": "two"}, {category_id: ["A001"] for category_id in ids})
+        self.assertEqual([current_seq(category_id) for category_id in ids], [2, 1, 1])
+        with CaptureQueriesContext(connection) as again:
+            broadcast_each({"event": "three"}, {category_id: ["A001"] for category_id in ids})
+        updates = [query for query in again.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual([current_seq(category_id) for category_id in ids], [3, 2, 2])
+        self.assertEqual([m["seq"] for m in missed(others[0].pk, 0, 2)], [1, 2])
+
+    def test_resume_past_a_gap_gets_a_snapshot(self):
+        broadcast({"event": "one"}, self.category.pk)
+        # A delta numbered by another process (a cron command) that never reached this one
+        next_seq(self.category.pk)
+        broadcast({"event": "three"}, self.category.pk)
+
+        self.assertIsNone(missed(self.category.pk, 0, 3))
+        messages = self.connect(f"categories={self.category.pk}&resume={self.category.pk}:0")
+        self.assertEqual([(m["event"], m["seq"]) for m in messages], [("snapshot", 3)])
+
+
+class IssuanceThrottleTests(TokenTestCase):
+    def test_bucket_allows_a_burst_then_refills_at_the_rate(self):
+        start = 1000.0
+        taken = [take_token("client:1", 3, 60, now=start) for _ in range(4)]
+        self.assertEqual(taken, [True, True, True, False])
+        # One token refills every 20 seconds
+        self.assertFalse(take_token("client:1", 3, 60, now=start + 19))
+        self.assertTrue(take_token("client:1", 3, 60, now=start + 20))
+        self.assertFalse(take_token("client:1", 3, 60, now=start + 21))
+
+    def test_no_double_burst_across_a_minute_boundary(self):
+        admitted = sum(take_token("client:2", 30, 60, now=59.0 + i / 100) for i in range(60))
+        self.assertEqual(admitted, 30)
+        self.assertEqual(sum(take_token("client:2", 30, 60, now=61.0) for _ in range(30)), 1)
+
+    def test_rejections_answered_with_429_and_counted(self):
+        make_category("General")
+        with self.settings(TOKEN_ISSUANCE_RATES={"client": "1/min", "category": None}):
+            take_token("issuance:client:ip:127.0.0.1", 1, 60)
+            response = self.client.post("/api/tokens/public-create/", {"category": 1})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(throttled_counts()["client"], 1)
+
+    def test_empty_bucket_refused_from_memory(self):
+        start = 1000.0
+        take_token("client:3", 1, 60, now=start)
+        self.assertFalse(take_token("client:3", 1, 60, now=start + 1))
+        with self.assertNumQueries(0):
+            self.assertFalse(take_token("client:3", 1, 60, now=start + 59))
+        self.assertTrue(take_token("client:3", 1, 60, now=start + 60))
+
+    def test_rejections_counted_in_memory_until_flushed(self):
+        with self.settings(TOKEN_ISSUANCE_RATES={"client": "1/min", "category": None}):
+            take_token("issuance:client:ip:127.0.0.1", 1, 60)
+            with patch.object(throttling, "_flushed_at", time.monotonic()):
+                for _ in range(3):
+                    self.assertEqual(self.client.post("/api/tokens/public-create/", {}).status_code, 429)
+                self.assertEqual(SharedSequence.read("issuance-throttled:client"), 0)
+                self.assertEqual(throttled_counts()["client"], 3)
+
+    def test_unknown_category_gets_no_bucket(self):
+        category = make_category("General")
+        throttle = throttling.IssuanceCategoryThrottle()
+        keys = [
+            throttle.get_key(SimpleNamespace(data={"category": value}), None)
+            for value in (category.pk, str(category.pk), "x" * 300, 999, None)
+        ]
+        self.assertEqual(keys, [str(category.pk), str(category.pk), None, None, None])
+
+
+class EmergencyControlTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+
+    def make_tokens(self, count, status):
+        block = TokenSequence.allocate(self.category, count=count)
+        Token.objects.bulk_create([
+            Token(category=self.category, token_id=block.token_id(i), queue_position=block.position(i), status=status)
+            for i in range(count)
+        ])
+
+    def token_updates(self, queries):
+        return [q["sql"] for q in queries if q["sql"].startswith('UPDATE "tokens_token"')]
+
+    def test_pause_is_one_update_per_source_status_however_many_tokens(self):
+        self.make_tokens(1200, "called")
+        self.make_tokens(3, "inprogress")
+        with CaptureQueriesContext(connection) as queries:
+            moved = pause_queue(statuses=("called", "inprogress"))
+        self.assertEqual(moved, 1203)
+        self.assertEqual(len(self.token_updates(queries.captured_queries)), 2)
+        self.assertEqual(TokenTransition.objects.filter(to_status=TokenTransition.WAITING).count(), 1203)
+        self.assertEqual(
+            TokenTransition.objects.filter(from_status=TokenTransition.INPROGRESS).count(), 3,
+        )
+
+    def test_pause_leaves_finished_tokens_alone(self):
+        self.make_tokens(2, "noshow")
+        self.make_tokens(2, "completed")
+        self.make_tokens(2, "called")
+        self.assertEqual(pause_queue(statuses=("called", "inprogress")), 2)
+        self.assertEqual(
+            dict(Token.objects.values_list("status").annotate(n=Count("pk"))),
+            {"noshow": 2, "completed": 2, "waiting": 2},
+        )
+
+    def test_resume_calls_each_category_head(self):
+        other = make_category("Priority")
+        self.make_tokens(3, "waiting")
+        make_token(other)
+        make_token(other)
+        self.assertEqual(resume_heads(), 2)
+        called = Token.objects.filter(status="called").order_by("category_id")
+        self.assertEqual([t.queue_position for t in called], [1, 1])
+        self.assertTrue(all(t.called_at for t in called))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class KioskLeaseTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+
+    def test_expired_lease_numbers_are_not_handed_out_again(self):
+        first = lease_block(self.category, "kiosk-1", 5)
+        SequenceLease.objects.filter(pk=first.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        second = lease_block(self.category, "kiosk-2", 5)
+        first.refresh_from_db()
+        self.assertEqual(first.status, SequenceLease.EXPIRED)
+        self.assertEqual(second.start_number, first.end_number)
+
+    def test_late_registration_for_an_expired_lease_is_accepted(self):
+        lease = lease_block(self.category, "kiosk-1", 5)
+        SequenceLease.objects.filter(pk=lease.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        expire_leases()
+        lease.refresh_from_db()
+        issued, duplicates = register_leased_tokens(lease, [{"token_id": "G002"}, {"token_id": "G001"}])
+        self.assertEqual([token.token_id for token, _qr in issued], ["G001", "G002"])
+        self.assertEqual(duplicates, [])
+
+    def test_resent_batch_reports_duplicates(self):
+        lease = lease_block(self.category, "kiosk-1", 5)
+        register_leased_tokens(lease, [{"token_id": "G001"}])
+        issued, duplicates = register_leased_tokens(lease, [{"token_id": "G001"}, {"token_id": "G002"}])
+        self.assertEqual([token.token_id for token, _qr in issued], ["G002"])
+        self.assertEqual(duplicates, ["G001"])
+        self.assertEqual(Token.objects.count(), 2)
+
+    def test_lease_returned_at_the_daily_reset_is_refused(self):
+        lease = lease_block(self.category, "kiosk-1", 5)
+        run_daily_reset(force=True)
+        lease.refresh_from_db()
+        with self.assertRaises(LeaseError):
+            register_leased_tokens(lease, [{"token_id": "G001"}])
+
+    def lease(self, count=5):
+        return self.client.post(
+            "/api/tokens/lease-block/", {"category": self.category.pk, "kiosk_id": "kiosk-1", "count": count},
+            format="json",
+        )
+
+    def register(self, lease_id, *token_ids):
+        return self.client.post(
+            "/api/tokens/register-leased/",
+            {"lease_id": lease_id, "tokens": [{"token_id": token_id} for token_id in token_ids]}, format="json",
+        )
+
+    def test_endpoints_require_the_kiosk_account(self):
+        with patch("tokens.views.is_within_generation_time", return_value=True):
+            self.assertIn(self.lease().status_code, (401, 403))
+            kiosk = self.login(make_user("kiosk-1"))
+            lease_id = self.lease().data["lease_id"]
+        self.assertEqual(SequenceLease.objects.get().leased_by, kiosk)
+        self.login(make_user("kiosk-2"))
+        self.assertEqual(self.register(lease_id, "G001").status_code, 404)
+        self.login(kiosk)
+        self.assertEqual(self.register(lease_id, "G001").status_code, 201)
+
+    @patch("tokens.issuance.LEASE_MAX_ACTIVE", 2)
+    def test_active_leases_per_kiosk_are_capped(self):
+        kiosk = make_user("kiosk-1")
+        lease_block(self.category, "kiosk-1", 5, leased_by=kiosk)
+        lease_block(self.category, "kiosk-1", 5, leased_by=kiosk)
+        with self.assertRaises(LeaseError):
+            lease_block(self.category, "kiosk-1", 5, leased_by=kiosk)
+        SequenceLease.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(lease_block(self.category, "kiosk-1", 5, leased_by=kiosk).start_number, 11)
+
+    @override_settings(TOKEN_ISSUANCE_RATES={"client": "1/min", "category": None})
+    def test_leasing_is_throttled_like_issuance(self):
+        self.login(make_user("kiosk-1"))
+        with patch("tokens.views.is_within_generation_time", return_value=True):
+            self.assertEqual(self.lease().status_code, 201)
+            self.assertEqual(self.lease().status_code, 429)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TokenSaveTests(TokenTestCase):
+    def test_new_token_gets_one_qr_unless_saved_without(self):
+        category = make_category("General")
+        token = Token(category=category)
+        token.save()
+        self.assertEqual(QRCode.objects.filter(token=token).count(), 1)
+        bare = make_token(category)
+        self.assertFalse(QRCode.objects.filter(token=bare).exists())
+
+
+class TokenSequenceTests(TokenTestCase):
+    def test_numbers_and_positions_come_from_one_counter(self):
+        category = make_category("General")
+        tokens = [make_token(category) for _ in range(3)]
+        self.assertEqual([t.token_id for t in tokens], ["G001", "G002", "G003"])
+        self.assertEqual([t.queue_position for t in tokens], [1, 2, 3])
+
+    def test_prefixes_stay_unique_between_similar_names(self):
+        first, second = make_category("General"), make_category("Gold")
+        self.assertEqual(make_token(first).token_id, "G001")
+        self.assertEqual(make_token(second).token_id, "GO001")
+
+    def test_manual_token_takes_a_position_but_no_number(self):
+        category = make_category("General")
+        make_token(category)
+        manual = make_token(category, token_id="MAN001", source="manual", status="called")
+        self.assertEqual(manual.queue_position, 2)
+        self.assertEqual(make_token(category).token_id, "G002")
+
+
+class FairSchedulerTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scheduler = FairScheduler()
+        self.busy = make_category("Busy")
+        self.quiet = make_category("Quiet")
+        CategorySchedule.objects.create(category=self.busy, weight=2)
+
+    def pick(self, heads):
+        ranking = self.scheduler.order(heads)
+        chosen = next(iter(ranking))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.scheduler.charge(ranking, chosen)
+        return chosen.category_id
+
+    def test_categories_served_in_proportion_to_weight(self):
+        now = timezone.now()
+        picks = [self.pick({self.busy.pk: now, self.quiet.pk: now}) for _ in range(6)]
+        self.assertEqual(picks.count(self.busy.pk), 4)
+        self.assertEqual(picks.count(self.quiet.pk), 2)
+
+    def test_aged_head_goes_first(self):
+        CategorySchedule.objects.create(category=self.quiet, max_wait_seconds=60)
+        now = timezone.now()
+        self.pick({self.busy.pk: now, self.quiet.pk: now})
+        self.assertEqual(self.pick({self.busy.pk: now, self.quiet.pk: now - timedelta(minutes=5)}), self.quiet.pk)
+
+    def test_rolled_back_call_charges_nothing(self):
+        ranking = self.scheduler.order({self.busy.pk: timezone.now(), self.quiet.pk: timezone.now()})
+        chosen = next(iter(ranking))
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.scheduler.charge(ranking, chosen)
+                raise RuntimeError
+        self.assertEqual(self.scheduler.states[chosen.category_id].served, 0)
+        self.assertEqual(self.scheduler.stats()["decisions"], [])
+
+
+class QueueStandingTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.tokens = [make_token(self.category) for _ in range(6)]
+
+    def standing(self, index):
+        token = Token.objects.get(pk=self.tokens[index].pk)
+        return queue_standing(token, TokenSequence.objects.get(category=self.category))
+
+    def move(self, indexes, status, expected=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_many([self.tokens[index].pk for index in indexes], status, expected)
+
+    def buried(self):
+        return TokenSequence.objects.get(category=self.category).buried
+
+    def test_people_ahead_counts_only_waiting_tokens(self):
+        # The two newest tokens left the line out of order: one called by number, one completed
+        self.move([4], "called")
+        self.move([5], "completed")
+        self.assertEqual(self.buried(), [5, 6])
+        self.assertEqual(self.standing(0), (0, 1))
+        token, sequence = Token.objects.get(pk=self.tokens[3].pk), TokenSequence.objects.get(category=self.category)
+        with self.assertNumQueries(0):
+            self.assertEqual(queue_standing(token, sequence), (3, 4))
+
+    def test_tombstones_in_the_middle_are_skipped(self):
+        self.move([1, 2], "completed")
+        self.assertEqual(self.standing(3), (1, 2))
+        self.assertEqual(self.standing(5), (3, 4))
+
+    def test_dispatch_moves_the_cursor_past_tombstones(self):
+        self.move([1], "completed")
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatch_next([self.category.pk])
+        sequence = TokenSequence.objects.get(category=self.category)
+        self.assertEqual((sequence.serving_position, sequence.buried), (2, []))
+        self.assertEqual(self.standing(2), (0, 1))
+        self.assertEqual(self.standing(4), (2, 3))
+
+    def test_deleted_and_requeued_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Token.objects.get(pk=self.tokens[1].pk).delete()
+        self.move([2], "called")
+        self.assertEqual(self.standing(3), (1, 2))
+        # Sent back to the line at its old position: it is ahead again
+        self.move([2], "waiting")
+        self.assertEqual(self.buried(), [2])
+        self.assertEqual(self.standing(3), (2, 3))
+
+    def test_too_many_tombstones_fall_back_to_counting(self):
+        with patch("tokens.positions.TOMBSTONE_LIMIT", 1):
+            self.move([1, 2], "completed")
+        self.assertIsNone(self.buried())
+        with self.assertNumQueries(3):
+            self.assertEqual(self.standing(3), (1, 2))
+        # Once the line empties the category tracks tombstones again
+        with self.captureOnCommitCallbacks(execute=True):
+            Token.objects.filter(pk__in=[token.pk for token in self.tokens]).delete()
+        self.assertEqual(self.buried(), [])
+
+    def test_public_endpoint_reports_the_exact_count(self):
+        self.move([0], "completed")
+        response = self.client.get(f"/api/tokens/public/{self.tokens[2].token_id}/")
+        self.assertEqual(response.data["people_ahead"], 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class QRImageStoreTests(TokenTestCase):
+    def test_images_are_stored_once_and_hot_paths_skip_storage(self):
+        job = colored_qr_job(f"T{time.time_ns()}")
+        first = store_qr_images([job, job])
+        with patch.object(default_storage, "exists", wraps=default_storage.exists) as exists:
+            second = store_qr_images([job])
+        exists.assert_not_called()
+        self.assertEqual(first, second * 2)
+        self.assertTrue(default_storage.exists(first[0]))
+
+    def test_dedupe_repoints_every_image_field_to_the_content_addressed_copy(self):
+        category = make_category("General")
+        content = f"png {time.time_ns()}".encode()
+        canonical = f"qrcodes/{hashlib.sha256(content).hexdigest()}.png"
+        first, second, kept = (
+            default_storage.save(name, ContentFile(content)) for name in ("qrcodes/a.png", "qrcodes/b.png", canonical)
+        )
+        token = make_token(category)
+        qr_code = QRCode.objects.create(token=token, category=category, image=first)
+        pooled = PooledToken.objects.create(category=category, token_id="P001", image=second)
+        now = timezone.now()
+        archived = TokenHistory.objects.create(
+            id=10 ** 9, token_id="H001", category=category, status="completed", issued_at=now, updated_at=now,
+        )
+        history = QRCodeHistory.objects.create(id=10 ** 9, token=archived, category=category, image=kept, generated_at=now)
+
+        call_command("dedupe_qr_images", stdout=StringIO())
+        qr_code.refresh_from_db()
+        pooled.refresh_from_db()
+        history.refresh_from_db()
+        self.assertEqual({qr_code.image.name, pooled.image.name, history.image.name}, {kept})
+        self.assertEqual([default_storage.exists(path) for path in (first, second, kept)], [False, False, True])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class BulkIssuanceTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+
+    def test_chunks_report_progress_and_share_one_sequence_allocation(self):
+        batches = list(bulk_issue_tokens(self.category, 5, chunk_size=2))
+        self.assertEqual([(done, total) for done, total, _issued in batches], [(2, 5), (4, 5), (5, 5)])
+        issued = [pair for _done, _total, chunk in batches for pair in chunk]
+        self.assertEqual([token.token_id for token, _qr in issued], ["G001", "G002", "G003", "G004", "G005"])
+        self.assertEqual([token.queue_position for token, _qr in issued], [1, 2, 3, 4, 5])
+        self.assertEqual(TokenSequence.objects.get(category=self.category).next_number, 6)
+        self.assertEqual(QRCode.objects.filter(render_status=QRCode.RENDER_READY).count(), 5)
+        for token, qr_code in issued:
+            self.assertEqual(qr_code.token_id, token.pk)
+            self.assertTrue(default_storage.exists(qr_code.image.name))
+
+    def test_queries_per_chunk_do_not_grow_with_its_size(self):
+        def queries(count):
+            with CaptureQueriesContext(connection) as captured:
+                list(bulk_issue_tokens(self.category, count, chunk_size=count))
+            return len(captured)
+
+        queries(1)  # creates the category's sequence row and loads the config snapshot
+        self.assertEqual(queries(2), queries(8))
+
+    def test_endpoint_streams_progress_then_the_created_tokens(self):
+        self.login(make_user("admin", role="admin"))
+        response = self.client.post(
+            "/api/tokens/admin-bulk-generate/", {"category": self.category.pk, "count": 3, "stream": True},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["event"] for line in lines], ["progress", "done"])
+        self.assertEqual(lines[-1]["count"], 3)
+        self.assertEqual([entry["token_id"] for entry in lines[-1]["created"]], ["G001", "G002", "G003"])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, QR_RENDER_MODE="async")
+class AsyncQRRenderTests(TokenTestCase):
+    def issue(self):
+        with patch.object(tasks, "_get_executor") as executor, self.captureOnCommitCallbacks(execute=True):
+            token = Token(category=make_category("General"))
+            token.save()
+        return token, executor.return_value
+
+    def test_token_commits_with_a_pending_qr_rendered_after_commit(self):
+        token, executor = self.issue()
+        qr_code = QRCode.objects.get(token=token)
+        self.assertEqual(qr_code.render_status, QRCode.RENDER_PENDING)
+        self.assertFalse(qr_code.image)
+        executor.submit.assert_called_once_with(tasks._run_in_worker, qr_code.pk)
+
+        path = tasks.render_qr_code(qr_code.pk)
+        qr_code.refresh_from_db()
+        self.assertEqual(qr_code.render_status, QRCode.RENDER_READY)
+        self.assertEqual(qr_code.image.name, path)
+        self.assertTrue(default_storage.exists(path))
+
+    def test_failed_render_is_retried_by_the_command(self):
+        token, _executor = self.issue()
+        qr_code = QRCode.objects.get(token=token)
+        with patch.object(tasks, "store_qr_images", side_effect=OSError("disk full")), self.assertLogs(tasks.logger):
+            self.assertIsNone(tasks.render_qr_code(qr_code.pk))
+        qr_code.refresh_from_db()
+        self.assertEqual(qr_code.render_status, QRCode.RENDER_FAILED)
+
+        call_command("render_pending_qr", include_failed=True, stdout=StringIO())
+        qr_code.refresh_from_db()
+        self.assertEqual(qr_code.render_status, QRCode.RENDER_READY)
+
+
+class QRRenderServiceTests(TestCase):
+    jobs = [QRRenderJob(f"G{n:03d}", box_size=4) for n in range(1, 6)]
+
+    def test_pool_returns_the_inline_bytes_in_job_order(self):
+        service = QRRenderService(max_workers=2, chunksize=2)
+        self.addCleanup(service.shutdown)
+        self.assertEqual(service.render_many(self.jobs), [render_qr_bytes(job) for job in self.jobs])
+        self.assertEqual(service.render(self.jobs[0]), render_qr_bytes(self.jobs[0]))
+
+    def test_broken_pool_falls_back_to_inline_rendering(self):
+        service = QRRenderService(max_workers=2)
+        with patch.object(service, "_get_pool") as pool, self.assertLogs(level="ERROR"):
+            pool.return_value.map.side_effect = BrokenProcessPool
+            service._pool = pool.return_value
+            rendered = service.render_many(self.jobs)
+        self.assertEqual(rendered, [render_qr_bytes(job) for job in self.jobs])
+        self.assertIsNone(service._pool)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class SingleQRTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        patcher = patch("tokens.views.is_within_generation_time", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_one_qr(self, response):
+        self.assertEqual(response.status_code, 201)
+        token = Token.objects.get(token_id=response.data["token"]["token_id"])
+        [qr_code] = QRCode.objects.filter(token=token)
+        self.assertEqual(qr_code.render_status, QRCode.RENDER_READY)
+        self.assertEqual(qr_code.image.name, qr_job_path(token_qr_job(token, get_config().qr_settings)))
+        self.assertTrue(response.data["qr_code"]["image"].endswith(qr_code.image.url))
+
+    def test_public_create_renders_one_qr(self):
+        self.assert_one_qr(self.client.post("/api/tokens/public-create/", {"category": self.category.pk}, format="json"))
+
+    def test_admin_generate_renders_one_qr(self):
+        self.login(make_user("admin", role="admin"))
+        self.assert_one_qr(self.client.post("/api/tokens/admin_generate/", {"category": self.category.pk}, format="json"))
+
+    def test_manual_token_gets_no_qr(self):
+        token = Token(category=self.category, token_id="MAN001", source="manual", status="called")
+        token.save()
+        self.assertFalse(QRCode.objects.filter(token=token).exists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TokenPoolTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.pool = TokenPool.objects.create(category=self.category, size=3, refill_threshold=1)
+        patcher = patch.object(tasks, "_get_executor")
+        self.executor = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_refill_mints_numbers_and_images_only_at_the_threshold(self):
+        self.assertEqual(refill_pool(self.pool), 3)
+        pooled = list(PooledToken.objects.all())
+        self.assertEqual([p.token_id for p in pooled], ["G001", "G002", "G003"])
+        self.assertTrue(all(default_storage.exists(p.image.name) for p in pooled))
+        self.assertEqual(refill_pool(self.pool), 0)
+        # Numbers are taken, positions are not: a token issued the slow way queues first
+        self.assertEqual((make_token(self.category).token_id, Token.objects.get().queue_position), ("G004", 1))
+
+    def test_claim_takes_the_next_position_and_the_pooled_image(self):
+        refill_pool(self.pool)
+        image = PooledToken.objects.get(token_id="G001").image.name
+        make_token(self.category)
+        with self.captureOnCommitCallbacks(execute=True):
+            token = claim_pooled_token(self.category, status="waiting")
+        self.assertEqual((token.token_id, token.queue_position), ("G001", 2))
+        self.assertEqual(QRCode.objects.get(token=token).image.name, image)
+        self.assertFalse(PooledToken.objects.filter(token_id="G001").exists())
+        self.pool.refresh_from_db()
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 0))
+        self.executor.submit.assert_called_once_with(tasks._refill_in_worker, self.pool.pk)
+
+    def test_empty_pool_is_a_miss_and_schedules_a_refill(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIsNone(claim_pooled_token(self.category, status="waiting"))
+        self.pool.refresh_from_db()
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 1))
+        self.executor.submit.assert_called_once_with(tasks._refill_in_worker, self.pool.pk)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class IdempotencyTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        patcher = patch("tokens.views.is_within_generation_time", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, key, category=None):
+        return self.client.post(
+            "/api/tokens/public-create/", {"category": category or self.category.pk}, format="json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retry_replays_the_first_response_without_issuing_again(self):
+        first = self.create("kiosk-1:42")
+        retry = self.create("kiosk-1:42")
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(Token.objects.count(), 1)
+        self.create("kiosk-1:43")
+        self.assertEqual(Token.objects.count(), 2)
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.create("kiosk-1:42")
+        other = make_category("Priority")
+        self.assertEqual(self.create("kiosk-1:42", other.pk).status_code, 422)
+        self.assertFalse(Token.objects.filter(category=other).exists())
+
+    def test_retry_while_the_first_request_runs_gets_a_conflict(self):
+        self.create("kiosk-1:42")
+        IdempotencyKey.objects.update(status_code=None)
+        self.assertEqual(self.create("kiosk-1:42").status_code, 409)
+
+    def test_key_of_a_crashed_request_is_reclaimed(self):
+        # The worker died before storing a response: the record stays in progress
+        self.create("kiosk-1:42")
+        Token.objects.all().delete()
+        IdempotencyKey.objects.update(status_code=None, response={}, created_at=timezone.now() - timedelta(minutes=2))
+        retry = self.create("kiosk-1:42")
+        self.assertEqual(retry.status_code, 201)
+        self.assertFalse(retry.has_header("Idempotent-Replayed"))
+        self.assertEqual(Token.objects.count(), 1)
+        record = IdempotencyKey.objects.get()
+        self.assertEqual((record.status_code, record.response["token"]), (201, retry.data["token"]))
+        self.assertEqual(self.create("kiosk-1:42")["Idempotent-Replayed"], "true")
+
+    def test_client_errors_are_replayed_and_expired_keys_purged(self):
+        self.assertEqual(self.create("kiosk-1:42", 999999).status_code, 400)
+        self.assertEqual(self.create("kiosk-1:42", 999999).status_code, 400)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 400)
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        self.assertEqual(purge_expired_keys(), 1)
+
+
+class CounterTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.general = make_category("General")
+        self.priority = make_category("Priority")
+        self.staff = self.login(make_user("desk"))
+        self.desk = Counter.objects.create(name="Desk 1", staff=self.staff)
+        self.desk.categories.add(self.general)
+        self.other = Counter.objects.create(name="Desk 2")
+        self.tokens = [make_token(self.general) for _ in range(3)]
+
+    def call_next(self, counter):
+        return self.client.post(f"/api/tokens/counters/{counter.pk}/call-next/")
+
+    def test_call_next_completes_the_desk_token_and_calls_the_head(self):
+        first = self.call_next(self.desk)
+        self.assertEqual((first.data["token_id"], first.data["completed"]), ("G001", []))
+        second = self.call_next(self.desk)
+        self.assertEqual((second.data["token_id"], second.data["completed"]), ("G002", ["G001"]))
+        self.desk.refresh_from_db()
+        self.assertEqual(self.desk.current_token_id, self.tokens[1].pk)
+        self.assertEqual(Token.objects.get(pk=self.tokens[1].pk).called_by, self.staff)
+        self.assertEqual(now_serving(), [{
+            "counter": {"id": self.desk.pk, "name": "Desk 1"},
+            "token_id": "G002",
+            "category": {"id": self.general.pk, "name": "General"},
+        }])
+
+    def test_complete_leaves_the_desk_idle(self):
+        self.call_next(self.desk)
+        response = self.client.post(f"/api/tokens/counters/{self.desk.pk}/complete/")
+        self.assertEqual((response.data["token_id"], response.data["completed"]), (None, ["G001"]))
+        self.desk.refresh_from_db()
+        self.assertIsNone(self.desk.current_token)
+
+    def test_transfer_to_an_idle_desk_only(self):
+        self.call_next(self.desk)
+        response = self.client.post(f"/api/tokens/counters/{self.desk.pk}/transfer/", {"counter": self.other.pk}, format="json")
+        self.assertEqual(response.data["counter"]["id"], self.other.pk)
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.current_token_id, self.tokens[0].pk)
+        self.call_next(self.desk)
+        busy = self.client.post(f"/api/tokens/counters/{self.desk.pk}/transfer/", {"counter": self.other.pk}, format="json")
+        self.assertEqual(busy.status_code, 400)
+
+    def test_transfer_to_a_category_requeues_at_the_back(self):
+        make_token(self.priority)
+        self.call_next(self.desk)
+        response = self.client.post(
+            f"/api/tokens/counters/{self.desk.pk}/transfer/", {"category": self.priority.pk}, format="json",
+        )
+        self.assertEqual((response.data["status"], response.data["queue_position"]), ("waiting", 2))
+        token = Token.objects.get(pk=self.tokens[0].pk)
+        self.assertEqual((token.category, token.called_by), (self.priority, None))
+
+    def test_inactive_desk_cannot_call(self):
+        Counter.objects.filter(pk=self.desk.pk).update(is_active=False)
+        self.assertEqual(self.call_next(self.desk).status_code, 404)
+
+    def test_token_endpoints_go_through_the_seated_desk(self):
+        self.staff.categories.add(self.general)
+        self.assertEqual(self.client.post("/api/tokens/call_next/").data["token_id"], "G001")
+        self.desk.refresh_from_db()
+        self.assertEqual(self.desk.current_token_id, self.tokens[0].pk)
+        response = self.client.post("/api/tokens/G001/complete/")
+        self.assertEqual((response.data["completed_token_id"], response.data["next_token_id"]), ("G001", "G002"))
+        self.desk.refresh_from_db()
+        self.assertEqual(self.desk.current_token_id, self.tokens[1].pk)
+        transition = TokenTransition.objects.get(token=self.tokens[0].pk, to_status=TokenTransition.COMPLETED)
+        self.assertEqual(transition.counter_id, self.desk.pk)
+
+    def test_completing_a_token_frees_its_desk(self):
+        self.call_next(self.desk)
+        complete_tokens([self.tokens[0].pk])
+        self.desk.refresh_from_db()
+        self.assertIsNone(self.desk.current_token)
+        self.assertEqual(now_serving(), [])
+
+
+class QueueEngineTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.tokens = [make_token(self.category) for _ in range(3)]
+        self.staff = make_user("desk")
+        self.engine = QueueEngine()
+        self.engine.rebuild()
+
+    def test_dispatch_is_served_from_memory_and_written_behind(self):
+        with self.assertNumQueries(0):
+            _completed, first = self.engine.dispatch([self.category.pk], self.staff.pk)
+            completed, second = self.engine.dispatch([self.category.pk], self.staff.pk, complete=[first.pk])
+            waiting = self.engine.tokens([self.category.pk])
+        self.assertEqual((first.token_id, second.token_id, completed), ("G001", "G002", ["G001"]))
+        self.assertEqual([r.token_id for r in waiting], ["G003"])
+        self.assertEqual(Token.objects.get(pk=first.pk).status, "waiting")
+
+        self.assertEqual(self.engine.flush(), 2)
+        statuses = dict(Token.objects.values_list("token_id", "status"))
+        self.assertEqual(statuses, {"G001": "completed", "G002": "called", "G003": "waiting"})
+        self.assertEqual(
+            list(TokenTransition.objects.order_by("pk").values_list("token", "from_status", "to_status")),
+            [
+                (first.pk, TokenTransition.WAITING, TokenTransition.CALLED),
+                (first.pk, TokenTransition.CALLED, TokenTransition.COMPLETED),
+                (second.pk, TokenTransition.WAITING, TokenTransition.CALLED),
+            ],
+        )
+        self.assertEqual(self.engine.check(), [])
+
+    def test_calling_a_token_that_is_not_waiting_does_nothing(self):
+        self.assertIsNotNone(self.engine.call(self.tokens[1].pk, self.staff.pk))
+        self.assertIsNone(self.engine.call(self.tokens[1].pk, self.staff.pk))
+        self.assertEqual(self.engine.called_by(None, self.staff.pk), [self.tokens[1].pk])
+        _completed, head = self.engine.dispatch([self.category.pk])
+        self.assertEqual(head.token_id, "G001")
+
+    def test_failed_flush_keeps_the_transitions_for_the_next_one(self):
+        self.engine.dispatch([self.category.pk], self.staff.pk)
+        with patch.object(Token.objects, "bulk_update", side_effect=RuntimeError("database away")), \
+                self.assertLogs("tokens.engine", "ERROR"):
+            self.assertEqual(self.engine.flush(), 0)
+        self.assertEqual(self.engine.check(), [])
+        self.assertEqual(Token.objects.get(pk=self.tokens[0].pk).status, "called")
+        self.assertEqual(TokenTransition.objects.count(), 1)
+
+    def test_flush_never_overwrites_a_status_set_elsewhere(self):
+        _completed, head = self.engine.dispatch([self.category.pk], self.staff.pk)
+        # Completed by a scan in another process before the engine wrote the call
+        transition(head.pk, "completed", ("waiting",))
+        with self.assertLogs("tokens.engine", "WARNING"):
+            self.assertEqual(self.engine.flush(), 0)
+        self.assertEqual(Token.objects.get(pk=head.pk).status, "completed")
+        self.assertFalse(TokenTransition.objects.filter(token=head.pk, to_status=TokenTransition.CALLED).exists())
+        self.assertNotIn(head.pk, self.engine.records)
+        self.assertEqual(self.engine.check(), [])
+
+    @override_settings(QUEUE_ENGINE=True)
+    def test_changes_from_a_cron_process_reach_the_engine_through_the_epoch(self):
+        # This process does not serve the queue, so it builds no engine of its own
+        self.assertIsNone(get_engine())
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        Token.objects.filter(pk=self.tokens[0].pk).update(status="called", called_at=an_hour_ago)
+        self.assertEqual(SharedSequence.read(ENGINE_EPOCH_KEY), self.engine.epoch)
+        sweep_no_shows()
+        self.assertNotEqual(SharedSequence.read(ENGINE_EPOCH_KEY), self.engine.epoch)
+        self.engine.rebuild()
+        self.assertEqual(sorted(r.token_id for r in self.engine.records.values()), ["G002", "G003"])
+
+
+class TransitionLogTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.staff = make_user("desk")
+        self.desk = Counter.objects.create(name="Desk 1", staff=self.staff)
+        self.desk.categories.add(self.category)
+        self.tokens = [make_token(self.category) for _ in range(2)]
+
+    def log(self):
+        return list(TokenTransition.objects.order_by("pk").values_list(
+            "token", "from_status", "to_status", "counter", "actor",
+        ))
+
+    def test_desk_moves_are_logged_with_desk_and_actor(self):
+        counter_call_next(self.desk.pk)
+        counter_call_next(self.desk.pk)
+        first, second = (token.pk for token in self.tokens)
+        self.assertEqual(self.log(), [
+            (first, TokenTransition.WAITING, TokenTransition.CALLED, self.desk.pk, self.staff.pk),
+            (first, TokenTransition.CALLED, TokenTransition.COMPLETED, self.desk.pk, self.staff.pk),
+            (second, TokenTransition.WAITING, TokenTransition.CALLED, self.desk.pk, self.staff.pk),
+        ])
+
+    def test_rolled_back_move_leaves_no_log(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            counter_call_next(self.desk.pk)
+            raise RuntimeError
+        self.assertEqual(self.log(), [])
+        self.assertEqual(Token.objects.get(pk=self.tokens[0].pk).status, "waiting")
+
+    def test_log_outlives_the_daily_reset(self):
+        counter_call_next(self.desk.pk)
+        counter_call_next(self.desk.pk)
+        Token.objects.update(issued_at=timezone.now() - timedelta(days=1))
+        run_daily_reset(force=True)
+        self.assertTrue(TokenHistory.objects.filter(pk=self.tokens[0].pk).exists())
+        self.assertEqual(TokenTransition.objects.filter(token=self.tokens[0].pk).count(), 2)
+
+
+class StateMachineTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.tokens = [make_token(self.category) for _ in range(3)]
+
+    def test_a_token_moved_meanwhile_is_skipped_not_overwritten(self):
+        token = self.tokens[0]
+        self.assertIsNotNone(transition(token.pk, "called", ("waiting",)))
+        self.assertIsNone(transition(token.pk, "called", ("waiting",)))
+        self.assertEqual(TokenTransition.objects.filter(token=token.pk).count(), 1)
+        self.assertEqual(complete_tokens([token.pk]), [token.token_id])
+        self.assertEqual(complete_tokens([token.pk]), [])
+
+    def test_moves_outside_the_state_machine_are_refused(self):
+        Token.objects.filter(pk=self.tokens[0].pk).update(status="completed")
+        with self.assertRaises(TransitionError):
+            transition(self.tokens[0].pk, "waiting", ("completed",))
+        with self.assertRaises(TransitionError):
+            transition(self.tokens[1].pk, "archived")
+        # Without ``expected`` only the allowed sources are matched
+        self.assertEqual(transition_many([t.pk for t in self.tokens], "waiting"), [])
+        self.assertEqual(Token.objects.get(pk=self.tokens[0].pk).status, "completed")
+
+    def test_status_edit_goes_through_the_state_machine(self):
+        token = self.tokens[1]
+        refused = self.client.patch(f"/api/tokens/{token.token_id}/", {"status": "noshow"}, format="json")
+        self.assertEqual(refused.status_code, 400)
+        self.assertEqual(Token.objects.get(pk=token.pk).status, "waiting")
+        moved = self.client.patch(f"/api/tokens/{token.token_id}/", {"status": "called"}, format="json")
+        self.assertEqual(moved.status_code, 200)
+        self.assertEqual(Token.objects.get(pk=token.pk).status, "called")
+        self.assertTrue(TokenTransition.objects.filter(token=token.pk, to_status=TokenTransition.CALLED).exists())
+
+
+class NoShowSweepTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.desk = Counter.objects.create(name="Desk 1")
+        self.now = timezone.now()
+
+    def called(self, minutes_ago, category=None):
+        return make_token(category or self.category, status="called", called_at=self.now - timedelta(minutes=minutes_ago))
+
+    def test_stale_calls_become_no_shows_in_batches_and_free_their_desks(self):
+        stale = [self.called(20) for _ in range(3)]
+        fresh = self.called(5)
+        Counter.objects.filter(pk=self.desk.pk).update(current_token=stale[0])
+
+        result = sweep_no_shows(now=self.now, batch_size=2)
+
+        self.assertEqual(result, {"noshow": 3, "requeued": 0, "batches": 2})
+        statuses = dict(Token.objects.values_list("pk", "status"))
+        self.assertEqual([statuses[t.pk] for t in stale], ["noshow"] * 3)
+        self.assertEqual(statuses[fresh.pk], "called")
+        self.desk.refresh_from_db()
+        self.assertIsNone(self.desk.current_token)
+
+    def test_schedule_can_requeue_at_the_back_with_its_own_timeout(self):
+        CategorySchedule.objects.create(category=self.category, no_show_seconds=60, no_show_action=CategorySchedule.REQUEUE)
+        late = self.called(2)
+        waiting = make_token(self.category)
+
+        self.assertEqual(sweep_no_shows(now=self.now)["requeued"], 1)
+
+        late.refresh_from_db()
+        self.assertEqual((late.status, late.called_by, late.called_at), ("waiting", None, None))
+        self.assertGreater(late.queue_position, waiting.queue_position)
+
+
+class QRExpiryTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.now = timezone.now()
+        self.tokens = [make_token(self.category) for _ in range(3)]
+        for token, hours in zip(self.tokens, (-2, -1, 1)):
+            qr_code = build_qr_code(token, image=f"qrcodes/{token.token_id}.png")
+            qr_code.expires_at = self.now + timedelta(hours=hours)
+            qr_code.save()
+
+    def test_sweep_flags_due_codes_and_their_tokens_in_chunks(self):
+        self.assertEqual(expire_qr_codes(now=self.now, chunk_size=1), {"qr_codes": 2, "tokens": 2})
+        self.assertEqual(
+            list(Token.objects.order_by("pk").values_list("qr_expired", flat=True)), [True, True, False],
+        )
+        self.assertEqual(list(QRCode.objects.order_by("pk").values_list("expired", flat=True)), [True, True, False])
+        self.assertEqual(expire_qr_codes(now=self.now), {"qr_codes": 0, "tokens": 0})
+
+    def test_flagged_codes_fail_verification(self):
+        expire_qr_codes(now=self.now)
+        self.login(make_user("scanner"))
+        expired = self.client.post("/api/tokens/verify-qr/", {"token_id": self.tokens[0].token_id}, format="json")
+        valid = self.client.post("/api/tokens/verify-qr/", {"token_id": self.tokens[2].token_id}, format="json")
+        self.assertEqual((expired.data["verified"], valid.data["verified"]), (False, True))
+
+
+class SubscriptionTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        notifications._rings.clear()
+        self.general = make_category("General")
+        self.priority = make_category("Priority")
+
+    def subscriptions(self, user, requested=()):
+        consumer = NotificationConsumer()
+        consumer.scope = {"user": user}
+        return async_to_sync(consumer._subscriptions)(list(requested))
+
+    def test_groups_follow_the_filter_and_the_role(self):
+        staff = make_user("desk")
+        staff.categories.add(self.priority)
+        admin = make_user("admin", role="admin")
+        self.assertEqual(self.subscriptions(AnonymousUser()), (
+            [category_group(self.general.pk), category_group(self.priority.pk)], [self.general.pk, self.priority.pk],
+        ))
+        self.assertEqual(self.subscriptions(AnonymousUser(), [self.priority.pk, 999999]), (
+            [category_group(self.priority.pk)], [self.priority.pk],
+        ))
+        self.assertEqual(self.subscriptions(staff), (
+            [category_group(self.priority.pk), STAFF_GROUP], [self.priority.pk],
+        ))
+        self.assertEqual(self.subscriptions(admin), ([ADMIN_GROUP], []))
+
+    def listen(self, query, user, send):
+        async def run():
+            communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f"/ws/?{query}")
+            communicator.scope["user"] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            while not await communicator.receive_nothing(timeout=0.2):
+                await communicator.receive_json_from()
+            await database_sync_to_async(send)()
+            messages = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                messages.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return messages
+        return async_to_sync(run)()
+
+    def test_display_gets_only_its_category(self):
+        def send():
+            broadcast({"event": "general"}, self.general.pk)
+            broadcast({"event": "priority"}, self.priority.pk)
+
+        messages = self.listen(f"categories={self.priority.pk}", AnonymousUser(), send)
+        self.assertEqual([(m["event"], m["category_id"]) for m in messages], [("priority", self.priority.pk)])
+
+    def test_admin_gets_a_multi_category_event_once(self):
+        def send():
+            broadcast_each({"event": "tokens_no_show"}, {self.general.pk: ["G001"], self.priority.pk: ["P001"]})
+
+        [message] = self.listen("", make_user("admin", role="admin"), send)
+        self.assertEqual(message["count"], 2)
+        self.assertEqual([entry["id"] for entry in message["categories"]], [self.general.pk, self.priority.pk])
+
+
+class QRScanTests(TokenTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = make_category("General")
+        self.token = make_token(self.category, status="called", called_at=timezone.now())
+        self.qr_code = build_qr_code(self.token, image="qrcodes/G001.png")
+        self.qr_code.save()
+        self.login(make_user("scanner"))
+
+    def scan(self, **data):
+        return self.client.post("/api/tokens/scans/", data, format="json")
+
+    def test_scanning_a_called_token_completes_it_once(self):
+        first = self.scan(token_id=self.token.pk)
+        second = self.scan(token_id=self.token.pk)
+        self.assertEqual((first.status_code, first.data["token_status"]), (201, "completed"))
+        self.assertEqual((second.status_code, second.data["token_status"]), (201, "completed"))
+        self.assertEqual(Token.objects.get(pk=self.token.pk).status, "completed")
+        self.assertEqual(TokenTransition.objects.filter(token=self.token.pk).count(), 1)
+        self.assertEqual(QRScan.objects.count(), 2)
+
+    def test_qr_scan_is_recorded(self):
+        response = self.scan(qr=self.qr_code.pk)
+        self.assertEqual((response.status_code, response.data["verification_status"]), (201, "SUCCESS"))
+        self.assertEqual(QRScan.objects.get().qr, self.qr_code)
+
+    def test_scanning_an_expired_qr_is_refused(self):
+        QRCode.objects.filter(pk=self.qr_code.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        expire_qr_codes()
+        response = self.scan(qr=self.qr_code.pk)
+        self.assertEqual(response.data["verification_status"], "FAILED")
+        self.assertEqual(QRScan.objects.get().verification_status, "FAILED")
+        self.assertEqual(Token.objects.get(pk=self.token.pk).status, "called")
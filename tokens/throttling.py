@@ -0,0 +1,175 @@
+from collections import Counter
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Least
+from django.db.models.lookups import GreaterThanOrEqual
+from rest_framework.throttling import BaseThrottle
+
+from users.models import Category
+from .config import get_config
+from .models import SharedSequence, ThrottleBucket
+
+
+DEFAULT_RATES = {
+    "client": "30/min",
+    "category": "600/min",
+}
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# How often a worker adds its rejections to the shared counters
+THROTTLED_FLUSH_INTERVAL = getattr(settings, "TOKEN_THROTTLED_FLUSH_SECONDS", 10.0)
+# Empty buckets a worker remembers before it starts over
+EMPTY_BUCKETS_MAX = 10000
+
+# Buckets this worker found empty: key -> (tokens, refilled_at) as last read. Other workers
+# only take tokens, so while that state has not refilled one token the bucket is still empty.
+_empty = {}
+# Rejections not yet added to the shared counters
+_throttled = Counter()
+_flushed_at = 0.0
+_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """``"30/min"`` -> ``(30, 60)``; ``None`` disables the limit."""
+    if not rate:
+        return None, None
+    num, period = rate.split("/")
+    return int(num), PERIODS[period[0]]
+
+
+def take_token(key, capacity, window, now=None):
+    """
+    Take one token from the bucket ``key``, which holds up to ``capacity``
+    tokens and refills at ``capacity`` per ``window`` seconds. The refill
+    and the take are one conditional UPDATE on the bucket's row, so every
+    worker draws from the same bucket and two racing requests cannot both
+    take the last token. Returns whether a token was taken.
+
+    A bucket this worker has seen empty is refused from memory until it
+    has refilled a token, so a client hammering an empty bucket costs no
+    queries.
+    """
+    now = time.time() if now is None else now
+    rate = capacity / window
+    seen = _empty.get(key)
+    if seen is not None:
+        tokens, refilled_at = seen
+        if min(float(capacity), tokens + (now - refilled_at) * rate) < 1.0:
+            return False
+        _empty.pop(key, None)
+    level = Least(Value(float(capacity)), F("tokens") + (Value(now) - F("refilled_at")) * Value(rate))
+    bucket = ThrottleBucket.objects.filter(key=key)
+    if bucket.filter(GreaterThanOrEqual(level, 1.0)).update(tokens=level - 1, refilled_at=now):
+        return True
+    seen = bucket.values_list("tokens", "refilled_at").first()
+    if seen is not None:
+        if len(_empty) >= EMPTY_BUCKETS_MAX:
+            _empty.clear()
+        _empty[key] = seen
+        return False
+    try:
+        with transaction.atomic():
+            ThrottleBucket.objects.create(key=key, tokens=capacity - 1, refilled_at=now)
+        return True
+    except IntegrityError:
+        # Another worker created the bucket first
+        return bool(bucket.filter(GreaterThanOrEqual(level, 1.0)).update(tokens=level - 1, refilled_at=now))
+
+
+def prune_buckets(now=None):
+    """Delete buckets idle for a day, the longest period a rate can use; they would be full anyway."""
+    now = time.time() if now is None else now
+    return ThrottleBucket.objects.filter(refilled_at__lt=now - PERIODS["d"]).delete()[0]
+
+
+class IssuanceThrottle(BaseThrottle):
+    """
+    Token-bucket admission control for token issuance, evaluated by DRF
+    before the view runs, so a rejection costs at most one UPDATE and no QR
+    work.
+    Subclasses pick the bucket key; rates come from ``TOKEN_ISSUANCE_RATES``
+    (``"30/min"``: bursts of up to 30, refilled at 30 a minute). Buckets are
+    rows in the database, shared by every worker.
+    """
+    scope = None
+
+    def get_rate(self):
+        rates = getattr(settings, "TOKEN_ISSUANCE_RATES", DEFAULT_RATES)
+        return parse_rate(rates.get(self.scope, DEFAULT_RATES.get(self.scope)))
+
+    def get_key(self, request, view):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        capacity, window = self.get_rate()
+        key = self.get_key(request, view)
+        if capacity is None or key is None:
+            return True
+        self.refill_seconds = window / capacity
+        if take_token(f"issuance:{self.scope}:{key}", capacity, window):
+            return True
+        record_throttled(self.scope)
+        return False
+
+    def wait(self):
+        # At most one token's refill time away from the next admission
+        return self.refill_seconds
+
+
+class IssuanceClientThrottle(IssuanceThrottle):
+    """Per kiosk/browser: the authenticated user, else the client address."""
+    scope = "client"
+
+    def get_key(self, request, view):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            return f"user:{user.pk}"
+        return f"ip:{self.get_ident(request)}"
+
+
+class IssuanceCategoryThrottle(IssuanceThrottle):
+    """Per category, across all clients."""
+    scope = "category"
+
+    def get_key(self, request, view):
+        # Only known categories get a bucket; the view refuses the rest
+        try:
+            return str(get_config().category(request.data.get("category")).pk)
+        except Category.DoesNotExist:
+            return None
+
+
+def _throttled_key(scope):
+    return f"issuance-throttled:{scope}"
+
+
+def record_throttled(scope):
+    """Count a rejection in memory; the shared counters are brought up to date every few seconds."""
+    with _lock:
+        _throttled[scope] += 1
+        due = time.monotonic() - _flushed_at >= THROTTLED_FLUSH_INTERVAL
+    if due:
+        flush_throttled()
+
+
+def flush_throttled():
+    global _flushed_at
+    with _lock:
+        pending = dict(_throttled)
+        _throttled.clear()
+        _flushed_at = time.monotonic()
+    for scope, count in pending.items():
+        SharedSequence.advance(_throttled_key(scope), by=count)
+
+
+def throttled_counts():
+    """Rejections per scope across all workers, as of their last flush, and all of this worker's."""
+    flush_throttled()
+    return {scope: SharedSequence.read(_throttled_key(scope)) for scope in DEFAULT_RATES}
+
+
+ISSUANCE_THROTTLES = [IssuanceClientThrottle, IssuanceCategoryThrottle]
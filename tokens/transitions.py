@@ -0,0 +1,235 @@
+from collections import namedtuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Token, TokenTransition
+from .notifications import broadcast_tokens
+from .positions import requeued, tombstone
+
+
+# The token state machine: each status and the statuses it may move to.
+# "completed" is final; a no-show can only rejoin the line.
+ALLOWED = {
+    "waiting": ("called", "inprogress", "completed"),
+    "called": ("waiting", "inprogress", "completed", "noshow"),
+    "inprogress": ("waiting", "completed"),
+    "completed": (),
+    "noshow": ("waiting",),
+}
+
+# Largest number of primary keys bound into one UPDATE
+CHUNK_SIZE = 500
+
+
+class TransitionError(Exception):
+    pass
+
+
+class Transition(namedtuple("Transition", ["token", "category_id", "from_status", "to_status", "counter_id", "actor_id", "at"])):
+    """One status change of one token; ``token`` is its primary key."""
+
+    def __new__(cls, token, category_id, from_status, to_status, counter_id=None, actor_id=None, at=None):
+        return super().__new__(cls, token, category_id, from_status, to_status, counter_id, actor_id, at)
+
+    def as_row(self, now=None):
+        return TokenTransition(
+            token=self.token,
+            category_id=self.category_id,
+            from_status=TokenTransition.STATUS_CODES[self.from_status],
+            to_status=TokenTransition.STATUS_CODES[self.to_status],
+            counter_id=self.counter_id,
+            actor_id=self.actor_id,
+            at=self.at or now or timezone.now(),
+        )
+
+
+# A token as it stands right after a transition, plus the status it left
+Changed = namedtuple("Changed", ["pk", "token_id", "category_id", "queue_position", "called_at", "from_status"])
+RETURNED = ("id", "token_id", "category_id", "queue_position", "called_at")
+
+
+def log_transitions(transitions):
+    """
+    Append ``transitions`` to the log with one INSERT. Call it inside the
+    transaction that changed the statuses, so the log and the tokens commit
+    or roll back together.
+    """
+    now = timezone.now()
+    rows = [transition.as_row(now) for transition in transitions if transition.from_status != transition.to_status]
+    if rows:
+        TokenTransition.objects.bulk_create(rows)
+    return len(rows)
+
+
+def sources(status, expected=None):
+    """
+    The statuses a token may be in to move to ``status``, narrowed to
+    ``expected`` when given. Raises ``TransitionError`` for a move the
+    state machine does not allow.
+    """
+    if status not in ALLOWED:
+        raise TransitionError(f"Unknown status {status!r}")
+    allowed = [source for source, targets in ALLOWED.items() if status in targets]
+    if expected is None:
+        return allowed
+    refused = [source for source in expected if source not in allowed]
+    if refused:
+        raise TransitionError(f"A {refused[0]} token cannot become {status}")
+    return list(expected)
+
+
+def _assignments(changes):
+    # "col = %s, ..." and its parameters for ``changes`` by attribute name
+    quote = connection.ops.quote_name
+    assignments, params = [], []
+    for name, value in changes.items():
+        field = Token._meta.get_field(name)
+        assignments.append(f"{quote(field.column)} = %s")
+        params.append(field.get_db_prep_save(value, connection))
+    return ", ".join(assignments), params
+
+
+def _changed(rows, from_status):
+    convert = _converter("called_at")
+    return [
+        Changed(pk, token_id, category_id, position, convert(at), from_status)
+        for pk, token_id, category_id, position, at in rows
+    ]
+
+
+def _update(pks, from_status, changes):
+    # UPDATE ... WHERE id IN (...) AND status = <from_status> RETURNING ...: the
+    # status check and the write are one statement, so of two racing writers
+    # only the first matches the row.
+    fields = Token._meta
+    quote = connection.ops.quote_name
+    assignments, params = _assignments(changes)
+    returned = ", ".join(quote(fields.get_field(name).column) for name in RETURNED)
+    rows = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start:start + CHUNK_SIZE]
+            cursor.execute(
+                f"UPDATE {quote(fields.db_table)} SET {assignments} "
+                f"WHERE {quote(fields.pk.column)} IN ({', '.join(['%s'] * len(chunk))}) "
+                f"AND {quote(fields.get_field('status').column)} = %s RETURNING {returned}",
+                params + chunk + [from_status],
+            )
+            rows.extend(cursor.fetchall())
+    return _changed(rows, from_status)
+
+
+def _update_matching(tokens, from_status, to_status, changes, actor_id, now):
+    # One statement for every token of the queryset ``tokens`` in ``from_status``: an UPDATE whose
+    # WHERE is the queryset's own SQL, so no primary keys travel to the database. On PostgreSQL the
+    # log is written by the same statement, an INSERT ... SELECT over the UPDATE's RETURNING rows.
+    fields, log = Token._meta, TokenTransition._meta
+    quote = connection.ops.quote_name
+    assignments, params = _assignments(changes)
+    selected, selected_params = tokens.filter(status=from_status).values("pk").query.sql_with_params()
+    returned = ", ".join(quote(fields.get_field(name).column) for name in RETURNED)
+    update = (
+        f"UPDATE {quote(fields.db_table)} SET {assignments} "
+        f"WHERE {quote(fields.pk.column)} IN ({selected}) "
+        f"AND {quote(fields.get_field('status').column)} = %s RETURNING {returned}"
+    )
+    params += list(selected_params) + [from_status]
+    if connection.vendor != "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(update, params)
+            rows = _changed(cursor.fetchall(), from_status)
+        log_transitions(Transition(row.pk, row.category_id, from_status, to_status, None, actor_id, now) for row in rows)
+        return rows
+    columns = ", ".join(
+        quote(log.get_field(name).column)
+        for name in ("token", "category", "from_status", "to_status", "counter", "actor", "at")
+    )
+    pk, category = quote(fields.pk.column), quote(fields.get_field("category").column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"WITH moved AS ({update}), logged AS ("
+            f"INSERT INTO {quote(log.db_table)} ({columns}) "
+            f"SELECT {pk}, {category}, %s, %s, NULL, %s, %s FROM moved"
+            f") SELECT {returned} FROM moved",
+            params + [
+                TokenTransition.STATUS_CODES[from_status], TokenTransition.STATUS_CODES[to_status], actor_id,
+                log.get_field("at").get_db_prep_save(now, connection),
+            ],
+        )
+        return _changed(cursor.fetchall(), from_status)
+
+
+def _converter(name):
+    # The backend's conversions for a raw column value, as the ORM applies them when reading a row
+    column = Token._meta.get_field(name).get_col(Token._meta.db_table)
+    converters = connection.ops.get_db_converters(column) + column.get_db_converters(connection)
+
+    def convert(value):
+        for converter in converters:
+            value = converter(value, column, connection)
+        return value
+    return convert
+
+
+def transition_many(pks, status, expected=None, counter_id=None, actor_id=None, now=None, notify=True, **changes):
+    """
+    Move the tokens ``pks`` to ``status`` with one conditional UPDATE per
+    allowed source status (``expected`` narrows them), log the moves and
+    return a ``Changed`` for each token that moved. Tokens already moved by
+    someone else are skipped rather than overwritten. ``changes`` sets other
+    fields in the same statement, by attribute name (``called_by_id``).
+    Tokens leaving the waiting line become tombstones and tokens rejoining
+    it leave them (tokens/positions.py). Watchers get a ``tokens_updated``
+    delta on commit unless ``notify`` is false (callers that send their own
+    event).
+    """
+    pks = list(pks)
+    if not pks:
+        return []
+    now = now or timezone.now()
+    changes = dict(changes, status=status, updated_at=now)
+    changed = []
+    with transaction.atomic():
+        for source in sources(status, expected):
+            changed.extend(_update(pks, source, changes))
+        log_transitions(
+            Transition(row.pk, row.category_id, row.from_status, status, counter_id, actor_id, now) for row in changed
+        )
+        if status == "waiting":
+            requeued(row.pk for row in changed)
+        else:
+            tombstone((row.category_id, row.queue_position) for row in changed if row.from_status == "waiting")
+        if notify:
+            broadcast_tokens(status, ((row.category_id, row.token_id, row.queue_position) for row in changed))
+        if changed:
+            from .engine import tokens_changed
+            tokens_changed(row.pk for row in changed)
+    return changed
+
+
+def transition_matching(tokens, status, expected, actor_id=None, now=None, **changes):
+    """
+    Move every token of the queryset ``tokens`` that is in one of
+    ``expected`` to ``status``, log the moves and return a ``Changed`` for
+    each. Unlike ``transition_many`` the tokens are never listed first: each
+    expected status costs one set-based statement however many tokens
+    match (on PostgreSQL the log INSERT is part of it), for the emergency
+    controls. Callers notify watchers themselves.
+    """
+    now = now or timezone.now()
+    changes = dict(changes, status=status, updated_at=now)
+    changed = []
+    with transaction.atomic():
+        for source in sources(status, expected):
+            changed.extend(_update_matching(tokens, source, status, changes, actor_id, now))
+        if changed:
+            from .engine import tokens_changed
+            tokens_changed(row.pk for row in changed)
+    return changed
+
+
+def transition(pk, status, expected=None, counter_id=None, actor_id=None, now=None, notify=True, **changes):
+    """``transition_many`` for one token: its ``Changed``, or ``None`` if it was not in an expected status."""
+    changed = transition_many([pk], status, expected, counter_id, actor_id, now, notify, **changes)
+    return changed[0] if changed else None
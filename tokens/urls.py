@@ -7,6 +7,7 @@ from .views import (
     QRScanViewSet,
     QRSettingsViewSet,
     AuditLogViewSet,
+    CounterViewSet,
    
     category_summary,
     session_info,
@@ -16,7 +17,13 @@ from .views import (
     category_management,
     scan_count,
     
-    queue_emergency
+    queue_emergency,
+    token_pool_stats,
+    issuance_throttle_stats,
+    now_serving_display,
+    queue_engine_check,
+    scheduler_stats,
+    wait_statistics,
 )
 from django.conf import settings
 from django.conf.urls.static import static
@@ -28,6 +35,7 @@ router.register(r'qr', QRCodeViewSet, basename='qr')
 router.register(r'scans', QRScanViewSet, basename='qrscans')
 router.register(r'settings', QRSettingsViewSet, basename='qrsettings')
 router.register(r'audit', AuditLogViewSet, basename='auditlogs')
+router.register(r'counters', CounterViewSet, basename='counter')
 
 
 token_list = TokenViewSet.as_view({'get': 'live_queue'})
@@ -66,4 +74,10 @@ urlpatterns += [
    
     
     path('queue/emergency/', queue_emergency, name='queue-emergency'),
+    path('pool-stats/', token_pool_stats, name='token-pool-stats'),
+    path('throttle-stats/', issuance_throttle_stats, name='issuance-throttle-stats'),
+    path('now-serving/', now_serving_display, name='now-serving'),
+    path('queue-engine/', queue_engine_check, name='queue-engine-check'),
+    path('scheduler/', scheduler_stats, name='scheduler-stats'),
+    path('wait-stats/', wait_statistics, name='wait-stats'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -6,66 +6,245 @@ import hashlib
 from django.utils import timezone
 from datetime import timedelta
 from PIL import Image
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+import logging
+import multiprocessing
+import threading
 
-def generate_qr_code(token_obj, qr_settings=None):
-    
-    default_format = getattr(qr_settings, 'default_format', 'PNG')
-    default_size = getattr(qr_settings, 'default_size', 10)
-    error_correction = getattr(qr_settings, 'error_correction', 'M')
-    expiry_hours = getattr(qr_settings, 'default_expiry_hours', 24)
-    border = getattr(qr_settings, 'default_border', 4)
-    base_url = getattr(qr_settings, 'base_url', 'https://example.com/')
 
-    expires_at = timezone.now() + timedelta(hours=expiry_hours)
+# ----------------------------
+# QR rendering service
+# ----------------------------
+class QRRenderJob(namedtuple("QRRenderJob", [
+    "data", "fill_color", "back_color", "box_size", "border",
+    "error_correction", "image_format", "frame_color", "frame_width",
+])):
+    """Everything needed to turn ``data`` into encoded image bytes; picklable for worker processes."""
 
-    payload = {
-        "tokenId": token_obj.token_id,
-        "category_id": token_obj.category.id,
-        "category_name": token_obj.category.name,
-        "timestamp": timezone.now().isoformat(),
-        "queuePosition": token_obj.queue_position,
-        "status": token_obj.status,
-        "expires_at": expires_at.isoformat(),
-    }
+    def __new__(cls, data, fill_color="black", back_color="white", box_size=10, border=4,
+                error_correction="M", image_format="PNG", frame_color=None, frame_width=20):
+        return super().__new__(cls, str(data), fill_color, back_color, int(box_size), int(border),
+                               error_correction, image_format, frame_color, frame_width)
+
+
+def render_qr_bytes(job):
+    """Render one QRRenderJob in the current process and return the encoded image bytes."""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=getattr(qrcode.constants, f"ERROR_CORRECT_{job.error_correction}", qrcode.constants.ERROR_CORRECT_M),
+        box_size=job.box_size,
+        border=job.border,
+    )
+    qr.add_data(job.data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color=job.fill_color, back_color=job.back_color)
+    if job.frame_color:
+        img = img.convert("RGBA")
+        framed = Image.new("RGBA", (img.width + job.frame_width * 2, img.height + job.frame_width * 2), job.frame_color)
+        framed.paste(img, (job.frame_width, job.frame_width))
+        img = framed
+    buffer = BytesIO()
+    img.save(buffer, format=job.image_format)
+    return buffer.getvalue()
+
+
+class QRRenderService:
+    """
+    Renders batches of QRRenderJobs on a ProcessPoolExecutor so QR matrix
+    construction and PNG encoding run outside the web worker's GIL.
+
+    With ``max_workers=0`` jobs are rendered inline in the calling process.
+    """
+
+    def __init__(self, max_workers=0, start_method="spawn", chunksize=16):
+        self.max_workers = max_workers
+        self.start_method = start_method
+        self.chunksize = chunksize
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+            return self._pool
+
+    def render(self, job):
+        return self.render_many([job])[0]
+
+    def render_many(self, jobs):
+        """Render ``jobs`` and return their encoded bytes in the same order."""
+        jobs = list(jobs)
+        if not self.max_workers or not jobs:
+            return [render_qr_bytes(job) for job in jobs]
+        try:
+            return list(self._get_pool().map(render_qr_bytes, jobs, chunksize=self.chunksize))
+        except BrokenProcessPool:
+            logging.exception("QR render pool broke; rendering %d job(s) inline", len(jobs))
+            self.shutdown()
+            return [render_qr_bytes(job) for job in jobs]
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+_render_service = None
+_render_service_lock = threading.Lock()
+
+
+def get_render_service():
+    """Process-wide QRRenderService configured from ``QR_RENDER_PROCESSES``."""
+    global _render_service
+    with _render_service_lock:
+        if _render_service is None:
+            _render_service = QRRenderService(
+                max_workers=getattr(settings, "QR_RENDER_PROCESSES", 0),
+                start_method=getattr(settings, "QR_RENDER_START_METHOD", "spawn"),
+            )
+        return _render_service
+
+
+# ----------------------------
+# Content-addressed image cache
+# ----------------------------
+def qr_job_key(job):
+    """Hash of every render parameter; identical jobs always produce identical bytes."""
+    return hashlib.sha256("\x1f".join(map(str, job)).encode("utf-8")).hexdigest()
 
-    checksum = hashlib.sha256(str(payload).encode("utf-8")).hexdigest()
+
+def qr_job_path(job):
+    return f"qrcodes/{qr_job_key(job)}.{job.image_format.lower()}"
+
+
+class QRImageCache:
+    """Thread-safe LRU; ``image_cache`` holds recently rendered image bytes keyed by ``qr_job_key``."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image_bytes = self._entries.get(key)
+            if image_bytes is not None:
+                self._entries.move_to_end(key)
+            return image_bytes
+
+    def put(self, key, image_bytes):
+        with self._lock:
+            self._entries[key] = image_bytes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+image_cache = QRImageCache(max_entries=getattr(settings, "QR_IMAGE_CACHE_SIZE", 512))
+
+
+def render_qr_cached(jobs):
+    """Encoded bytes for ``jobs``; only jobs missing from the LRU are sent to the render service."""
+    jobs = list(jobs)
+    keys = [qr_job_key(job) for job in jobs]
+    results = [image_cache.get(key) for key in keys]
+    misses = {key: job for key, job, image_bytes in zip(keys, jobs, results) if image_bytes is None}
+    if misses:
+        rendered = dict(zip(misses, get_render_service().render_many(misses.values())))
+        for key, image_bytes in rendered.items():
+            image_cache.put(key, image_bytes)
+        results = [image_bytes if image_bytes is not None else rendered[key] for key, image_bytes in zip(keys, results)]
+    return results
+
+
+# Paths this process has stored or seen in storage; blobs are content-addressed and never change
+stored_paths = QRImageCache(max_entries=getattr(settings, "QR_IMAGE_CACHE_SIZE", 512))
+
+
+def store_qr_images(jobs):
+    """
+    Storage paths for ``jobs``, writing each distinct image exactly once.
+
+    Images live at ``qrcodes/<sha256 of the job>.<format>``. Paths hot in
+    the in-process LRU are returned without touching storage; others are
+    checked with one ``exists`` each, and only images missing there are
+    rendered (skipping the render for bytes still in the image LRU).
+    """
+    jobs = list(jobs)
+    paths = [qr_job_path(job) for job in jobs]
+    missing = {}
+    for path, job in zip(paths, jobs):
+        if path in missing or stored_paths.get(path):
+            continue
+        if default_storage.exists(path):
+            stored_paths.put(path, True)
+        else:
+            missing[path] = job
+    if missing:
+        for path, image_bytes in zip(missing, render_qr_cached(missing.values())):
+            saved_path = default_storage.save(path, ContentFile(image_bytes))
+            if saved_path != path:
+                # Another worker stored the same blob first; keep the canonical copy
+                default_storage.delete(saved_path)
+            stored_paths.put(path, True)
+    return paths
+
+
+# ----------------------------
+# Token QR policy
+# ----------------------------
+def token_qr_payload(token_obj, qr_settings=None):
+    """
+    The payload stored with a token's QR row: ``(qr_data, checksum, expires_at)``.
+
+    Expiry and error correction come from QRSettings; the image itself always
+    encodes the bare token_id framed in the category colour.
+    """
+    expiry_hours = getattr(qr_settings, 'expiry_hours', 24)
+    expires_at = timezone.now() + timedelta(hours=expiry_hours)
 
     qr_data = {
         "token_id": token_obj.token_id,
         "category_id": token_obj.category.id,
         "category_name": token_obj.category.name,
         "category_color": getattr(token_obj.category, 'color', None),
+        "queue_position": token_obj.queue_position,
         "expires_at": expires_at.isoformat(),
     }
+    checksum = hashlib.sha256(str(qr_data).encode("utf-8")).hexdigest()
+    return qr_data, checksum, expires_at
 
-    fill_color = getattr(token_obj.category, 'color', '#000000')
 
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=getattr(qrcode.constants, f"ERROR_CORRECT_{error_correction}") if qr_settings else qrcode.constants.ERROR_CORRECT_M,
-        box_size=int(default_size),
-        border=int(border),
+def token_qr_job(token_obj, qr_settings=None):
+    return QRRenderJob(
+        token_obj.token_id,
+        border=getattr(qr_settings, 'border', 4),
+        error_correction=getattr(qr_settings, 'error_correction', 'M'),
+        frame_color=getattr(token_obj.category, 'color', None) or "#007BFF",
+        frame_width=20,
+        image_format="PNG",
     )
-    qr.add_data(payload)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color=fill_color, back_color="white")
 
-    buffer = BytesIO()
-    img.save(buffer, format=default_format)
-    buffer.seek(0)
 
-    filename = f"qrcodes/qrcode_{token_obj.token_id}.{default_format.lower()}"
-    content = ContentFile(buffer.read())
-    saved_path = default_storage.save(filename, content)
+def generate_qr_code(token_obj, qr_settings=None):
+    """Render and store the QR for ``token_obj``; returns ``(qr_data, checksum, saved_path)``."""
+    qr_data, checksum, _expires_at = token_qr_payload(token_obj, qr_settings)
+    saved_path = store_qr_images([token_qr_job(token_obj, qr_settings)])[0]
+    return qr_data, checksum, saved_path
+
+
+def colored_qr_job(data, color="#007BFF"):
+    """Job for the token_id QR framed in the category colour."""
+    return QRRenderJob(data, frame_color=color, frame_width=20)
 
-    return qr_data, checksum, saved_path  
 
 def generate_colored_qr_code(data, color="#007BFF"):
-    qr_img = qrcode.make(data)
-    qr_img = qr_img.convert("RGBA")
-    border_size = 20
-    bg = Image.new("RGBA", (qr_img.width + border_size*2, qr_img.height + border_size*2), color)
-    bg.paste(qr_img, (border_size, border_size))
-    buffer = BytesIO()
-    bg.save(buffer, format="PNG")
-    return buffer
+    return BytesIO(render_qr_cached([colored_qr_job(data, color)])[0])
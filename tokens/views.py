@@ -3,18 +3,19 @@ from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.parsers import MultiPartParser
+from rest_framework.exceptions import ValidationError
 from django.utils import timezone
 from django.db.models import Max
 from datetime import time 
 
-from django.http import FileResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.conf import settings
-from django.db.models import Count
+from django.db.models import Count, Prefetch
 from datetime import date, timedelta
 from django.utils.crypto import get_random_string
 from django.core.files.base import ContentFile
 
-from .models import Token, QRCode, QRScan, QRSettings, QRTemplate, AuditLog
+from .models import Token, QRCode, QRScan, QRSettings, QRTemplate, AuditLog, TokenPool, PooledToken, SequenceLease, Counter
 from .serializers import (
     TokenSerializer,
     QRCodeSerializer,
@@ -22,20 +23,36 @@ from .serializers import (
     QRSettingsSerializer,
     QRTemplateSerializer,
     AuditLogSerializer,
+    CounterSerializer,
     ScanActivityReportSerializer,
     VerificationLogSerializer,
 )
 from users.models import Category
-from .utils import generate_colored_qr_code
+from .idempotency import idempotent
+from .throttling import ISSUANCE_THROTTLES, throttled_counts
+from .config import get_config, current_qr_settings
+from .engine import get_engine
+from .scheduling import scheduler
+from .positions import queue_standing
+from .emergency import pause_queue, resume_heads, clear_queue
+from . import estimates
+from .estimates import WaitEstimator
+from .transitions import Transition, TransitionError, log_transitions, transition
+from django.db import transaction
+from .dispatch import (
+    call_token, called_tokens, complete_tokens, dispatch_next, counter_call_next, counter_complete, counter_recall,
+    counter_transfer, display_payload, flush_engine, now_serving, CounterError,
+)
+from .issuance import bulk_issue_tokens, claim_pooled_token, lease_block, register_leased_tokens, LeaseError
+import json
 
 
 def is_within_generation_time():
-    settings = QRSettings.objects.first()
+    settings = current_qr_settings()
     now = timezone.localtime()
     now_time = now.time()
     start = settings.generation_start_time
     end = settings.generation_end_time
-    print("DEBUG:", "Now:", now_time, "Start:", start, "End:", end)
     if start < end:
         return start <= now_time <= end
     else:
@@ -65,29 +82,69 @@ class TokenViewSet(viewsets.ModelViewSet):
                 qs = qs.none()
         return qs
 
+    def _queue_categories(self):
+        """Category ids the requesting user serves; ``None`` means every category."""
+        user = self.request.user
+        if hasattr(user, "role") and user.role == "staff":
+            staff_categories = getattr(user, "categories", None)
+            return list(staff_categories.values_list("pk", flat=True)) if staff_categories is not None else []
+        return None
+
+    def _seated_counter(self):
+        """Primary key of the active desk the requesting user staffs, if any."""
+        user = self.request.user
+        if not user.is_authenticated:
+            return None
+        return Counter.objects.filter(staff=user, is_active=True).values_list("pk", flat=True).first()
+
+    def perform_update(self, serializer):
+        # A status edit goes through the state machine as a conditional UPDATE, never a blind full-row save
+        token = serializer.instance
+        new_status = serializer.validated_data.pop("status", token.status)
+        if new_status != token.status:
+            flush_engine()
+            user = self.request.user
+            actor_id = user.pk if user.is_authenticated else None
+            try:
+                moved = transition(token.pk, new_status, (token.status,), actor_id=actor_id)
+            except TransitionError as exc:
+                raise ValidationError({"status": str(exc)})
+            if moved is None:
+                raise ValidationError({"status": "Token status changed meanwhile; reload and retry."})
+            token.status = new_status
+        if serializer.validated_data:
+            serializer.save()
+
     @action(detail=False, methods=["get"])
     def active(self, request):
-      tokens = self.get_queryset().filter(status__in=["waiting", "called"]).order_by("queue_position")
+      engine = get_engine()
+      if engine is not None:
+          records = engine.tokens(self._queue_categories(), ("waiting", "called"), exclude_manual=True)
+          tokens = [record.as_token() for record in records]
+      else:
+          tokens = self.get_queryset().filter(status__in=["waiting", "called"]).order_by("queue_position")
       serializer = TokenSerializer(tokens, many=True, context={"request": request})
       return Response(serializer.data)
 
 
     @action(detail=False, methods=["post"])
     def call_next(self, request):
-        user = request.user
-        qs = self.get_queryset()
-        # Complete the current "called" token, if any
-        current_token = qs.filter(status="called").first()
-        if current_token:
-            current_token.status = "completed"
-            current_token.save()
-        # Call only the next "waiting" token
-        next_token = qs.filter(status="waiting").order_by("queue_position").first()
-        if not next_token:
+        called_by = request.user if request.user.is_authenticated else None
+        counter_id = self._seated_counter()
+        if counter_id is not None:
+            # A seated desk completes the token it serves and calls from its own categories
+            try:
+                result = counter_call_next(counter_id, called_by=called_by)
+            except CounterError as e:
+                return Response({"detail": str(e)}, status=404)
+        else:
+            category_ids = self._queue_categories()
+            # Complete the caller's own "called" token (anonymous callers complete nothing) and call the
+            # next "waiting" one in one transaction
+            result = dispatch_next(category_ids, called_by=called_by, complete=called_tokens(category_ids, called_by))
+        if not result.token:
             return Response({"detail": "No waiting tokens available"}, status=404)
-        next_token.status = "called"
-        next_token.save()
-        return Response(TokenSerializer(next_token).data)
+        return Response(TokenSerializer(result.token).data)
 
     @action(detail=True, methods=["post"])
     def complete(self, request, token_id=None):
@@ -95,26 +152,23 @@ class TokenViewSet(viewsets.ModelViewSet):
             token = self.get_object()
         except Token.DoesNotExist:
             return Response({"error": "Token not found"}, status=404)
-        token.status = "completed"
-        token.save()
-    # Automatically call the next waiting token (if any)
-        next_token = self.get_queryset().filter(status="waiting").order_by("queue_position").first()
-        if next_token:
-            next_token.status = "called"
-            next_token.save()
-            return Response({
-                "success": True,
-                "completed_token_id": token.token_id,
-                "next_token_id": next_token.token_id,
-                "next_status": next_token.status,
-            })
+        called_by = request.user if request.user.is_authenticated else None
+        counter_id = self._seated_counter()
+        # Complete the token and automatically call the next waiting one (if any)
+        if counter_id is not None:
+            try:
+                result = counter_call_next(counter_id, called_by=called_by, complete=[token.pk])
+            except CounterError as e:
+                return Response({"detail": str(e)}, status=404)
         else:
-            return Response({
-                "success": True,
-                "completed_token_id": token.token_id,
-                "next_token_id": None,
-                "next_status": None,
-            })
+            result = dispatch_next(self._queue_categories(), called_by=called_by, complete=[token.pk])
+        next_token = result.token
+        return Response({
+            "success": True,
+            "completed_token_id": token.token_id,
+            "next_token_id": next_token.token_id if next_token else None,
+            "next_status": next_token.status if next_token else None,
+        })
 
     @action(detail=False, methods=["post"])
     def manual_call(self, request):
@@ -137,7 +191,7 @@ class TokenViewSet(viewsets.ModelViewSet):
             if not category_id:
                 return Response({"detail": "category_id is required for admin"}, status=400)
             try:
-                category = Category.objects.get(id=category_id)
+                category = get_config().category(category_id)
             except Category.DoesNotExist:
                 return Response({"detail": "Invalid category"}, status=400)
         else:
@@ -148,17 +202,18 @@ class TokenViewSet(viewsets.ModelViewSet):
             existing_token = Token.objects.filter(token_id=token_id, category_id=category_id, source="manual").exclude(status="completed").first()
             if existing_token:
                 return Response({"detail": "This manual token is already active or called."}, status=400)
-            # Find the current max queue_position for this category
-            max_position = Token.objects.filter(category_id=category_id).aggregate(Max('queue_position'))['queue_position__max'] or 0
-            # Create manual token at the end of the queue
-            token = Token.objects.create(
-                token_id=token_id,
-                category_id=category_id,
-                status="called",
-                issued_at=timezone.now(),
-                source="manual",
-                queue_position=max_position + 1
-            )
+            # Create manual token at the end of the queue (position comes from the category sequence)
+            with transaction.atomic():
+                token = Token.objects.create(
+                    token_id=token_id,
+                    category_id=category_id,
+                    status="called",
+                    issued_at=timezone.now(),
+                    source="manual",
+                )
+                log_transitions([Transition(
+                    token.pk, token.category_id, None, "called", actor_id=user.pk if user.is_authenticated else None,
+                )])
             return Response({
                 "token_id": token.token_id,
                 "status": token.status,
@@ -174,13 +229,12 @@ class TokenViewSet(viewsets.ModelViewSet):
             token = Token.objects.filter(token_id=token_id, category_id=category_id).first()
             if not token:
                 return Response({"detail": "Token not found."}, status=404)
-            if token.status != "waiting":
+            if not call_token(token, called_by=user if user.is_authenticated else None):
                 return Response({"detail": "Token is not in waiting status."}, status=400)
-            token.status = "called"
-            token.save()
             return Response(TokenSerializer(token).data)
 
-    @action(detail=False, methods=["post"], permission_classes=[AllowAny])
+    @action(detail=False, methods=["post"], permission_classes=[AllowAny], throttle_classes=ISSUANCE_THROTTLES)
+    @idempotent("admin-generate")
     def admin_generate(self, request):
         if not is_within_generation_time():
             return Response({"error": "Token generation is only allowed between configured hours."}, status=403)
@@ -190,30 +244,17 @@ class TokenViewSet(viewsets.ModelViewSet):
         if not category_id:
             return Response({"detail": "category is required"}, status=400)
         try:
-            category = Category.objects.get(id=category_id)
+            category = get_config().category(category_id)
         except Category.DoesNotExist:
             return Response({"detail": "Invalid category"}, status=400)
-        max_position = Token.objects.filter(category_id=category_id).aggregate(Max('queue_position'))['queue_position__max'] or 0
-        token = Token.objects.create(
-            category=category,
+        fields = dict(
             status=status,
             issued_at=issued_at,
             created_by=request.user if request.user.is_authenticated else None,
             source="admin",
-            queue_position=max_position + 1,
         )
-        expires_at = timezone.now() + timedelta(hours=24)
-        qr_data = token.token_id  
-        color = category.color if hasattr(category, "color") else "#007BFF"
-        qr_buffer = generate_colored_qr_code(qr_data, color)
-        file_name = f"qr_{token.token_id}.png"
-        qr_code = QRCode.objects.create(
-            token=token,
-            category=category,
-            expires_at=expires_at,
-            data=qr_data,
-        )
-        qr_code.image.save(file_name, ContentFile(qr_buffer.getvalue()), save=True)
+        token = claim_pooled_token(category, **fields) or Token.objects.create(category=category, **fields)
+        qr_code = token.qr_code
         # --- FIX: Add queue_position and category to qr_code response ---
         return Response({
             "token": {
@@ -226,8 +267,9 @@ class TokenViewSet(viewsets.ModelViewSet):
                 "queue_position": token.queue_position,
             },
             "qr_code": {
-                "image": request.build_absolute_uri(qr_code.image.url) if qr_code.image else None,
-                "data": qr_code.data,
+                "image": request.build_absolute_uri(qr_code.image.url) if qr_code and qr_code.image else None,
+                "status": qr_code.render_status if qr_code else QRCode.RENDER_FAILED,
+                "data": token.token_id,
                 "category": {
                     "id": category.id,
                     "name": category.name,
@@ -236,7 +278,8 @@ class TokenViewSet(viewsets.ModelViewSet):
             },
         }, status=201)
 
-    @action(detail=False, methods=['post'], url_path='public-create')
+    @action(detail=False, methods=['post'], url_path='public-create', throttle_classes=ISSUANCE_THROTTLES)
+    @idempotent("public-create")
     def public_create(self, request):
         if not is_within_generation_time():
             return Response({"error": "Token generation is only allowed between configured hours."}, status=403)
@@ -244,25 +287,13 @@ class TokenViewSet(viewsets.ModelViewSet):
         if not category_id:
             return Response({"error": "Category required"}, status=400)
         try:
-            category = Category.objects.get(id=category_id)
+            category = get_config().category(category_id)
         except Category.DoesNotExist:
             return Response({"error": "Invalid category"}, status=400)
-        token = Token.objects.create(category=category, status="waiting")
-        expires_at = timezone.now() + timedelta(hours=24)
-
-        # Generate QR code with category color and token_id as data
-        qr_data = token.token_id
-        color = category.color if hasattr(category, "color") else "#007BFF"
-        qr_buffer = generate_colored_qr_code(qr_data, color)
-        file_name = f"qr_{token.token_id}.png"
-
-        qr_code = QRCode.objects.create(
-            token=token,
-            category=category,
-            expires_at=expires_at,
-            data=qr_data,
-        )
-        qr_code.image.save(file_name, ContentFile(qr_buffer.getvalue()), save=True)
+        # Served from the category's pre-minted pool when one is enabled and stocked
+        token = claim_pooled_token(category, status="waiting") or Token.objects.create(category=category, status="waiting")
+        # Token.save() issued the token's single QR (rendered in the background in async mode)
+        qr_code = token.qr_code
 
         return Response({
             "token": {
@@ -275,27 +306,104 @@ class TokenViewSet(viewsets.ModelViewSet):
                 "queue_position": token.queue_position,
             },
             "qr_code": {
-                "image": request.build_absolute_uri(qr_code.image.url) if qr_code.image else None,
-                "data": qr_code.data,
+                "image": request.build_absolute_uri(qr_code.image.url) if qr_code and qr_code.image else None,
+                "status": qr_code.render_status if qr_code else QRCode.RENDER_FAILED,
+                "data": token.token_id,
             },
         }, status=201)
 
+    @action(
+        detail=False, methods=["post"], url_path="lease-block", permission_classes=[IsAuthenticated],
+        throttle_classes=ISSUANCE_THROTTLES,
+    )
+    @idempotent("lease-block")
+    def lease_tokens(self, request):
+        """
+        Kiosk: lease a block of token numbers to print from while offline.
+        POST {"category": id, "kiosk_id": str, "count": int}, signed in as the kiosk's account.
+        """
+        if not is_within_generation_time():
+            return Response({"error": "Token generation is only allowed between configured hours."}, status=403)
+        category_id = request.data.get("category")
+        kiosk_id = request.data.get("kiosk_id")
+        if not category_id or not kiosk_id:
+            return Response({"detail": "category and kiosk_id are required"}, status=400)
+        try:
+            category = get_config().category(category_id)
+        except Category.DoesNotExist:
+            return Response({"detail": "Invalid category"}, status=400)
+        try:
+            lease = lease_block(category, str(kiosk_id), int(request.data.get("count", 50)), leased_by=request.user)
+        except (LeaseError, ValueError) as e:
+            return Response({"detail": str(e)}, status=400)
+        return Response({
+            "lease_id": lease.pk,
+            "category": {
+                "id": category.id,
+                "name": category.name,
+            },
+            "prefix": lease.prefix,
+            "start_number": lease.start_number,
+            "end_number": lease.end_number - 1,
+            "expires_at": lease.expires_at,
+        }, status=201)
+
+    @action(
+        detail=False, methods=["post"], url_path="register-leased", permission_classes=[IsAuthenticated],
+        throttle_classes=ISSUANCE_THROTTLES,
+    )
+    def register_leased(self, request):
+        """
+        Kiosk: report tokens printed from a lease, signed in as the account that leased it.
+        POST {"lease_id": id, "tokens": [{"token_id": "G101", "issued_at": iso}, ...]}
+        """
+        entries = request.data.get("tokens")
+        if not isinstance(entries, list) or not entries:
+            return Response({"detail": "tokens must be a non-empty list"}, status=400)
+        try:
+            lease = SequenceLease.objects.select_related("category").get(
+                pk=request.data.get("lease_id"), leased_by=request.user,
+            )
+        except (SequenceLease.DoesNotExist, ValueError):
+            return Response({"detail": "Lease not found"}, status=404)
+        try:
+            issued, duplicates = register_leased_tokens(lease, entries)
+        except LeaseError as e:
+            return Response({"detail": str(e)}, status=409)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=400)
+        return Response({
+            "registered": [{
+                "token_id": token.token_id,
+                "queue_position": token.queue_position,
+                "qr_image": request.build_absolute_uri(qr_code.image.url) if qr_code.image else None,
+            } for token, qr_code in issued],
+            "duplicates": duplicates,
+        }, status=201)
+
     @action(detail=False, methods=['get'], url_path='public/(?P<token_id>[^/.]+)')
     def public(self, request, token_id=None):
         try:
-            token = Token.objects.get(token_id=token_id)
+            token = Token.objects.select_related("category__token_sequence").get(token_id=token_id)
         except Token.DoesNotExist:
             return Response({"detail": "Invalid QR Code"}, status=404)
         qr_code = QRCode.objects.filter(token=token).order_by('-id').first()
+        category = get_config().category(token.category_id)
+        # From the category's cursors and the departed tokens ahead, not a count of the waiting rows
+        standing = queue_standing(token, getattr(token.category, "token_sequence", None))
         return Response({
             "token_id": token.token_id,
             "status": token.status,
             "category": {
-                "id": token.category.id,
-                "name": token.category.name,
+                "id": category.id,
+                "name": category.name,
             },
             "queue_position": token.queue_position,
+            "people_ahead": standing[0] if standing else None,
+            "position": standing[1] if standing else None,
+            **WaitEstimator(token.category_id).payload(standing[0] if standing else None),
             "qr_image": request.build_absolute_uri(qr_code.image.url) if qr_code and qr_code.image else None,
+            "qr_status": qr_code.render_status if qr_code else None,
         })
 
     @action(detail=False, methods=["get"])
@@ -312,33 +420,14 @@ class TokenViewSet(viewsets.ModelViewSet):
         if not category_id or count < 1:
             return Response({"detail": "category and count required"}, status=400)
         try:
-            category = Category.objects.get(id=category_id)
+            category = get_config().category(category_id)
         except Category.DoesNotExist:
             return Response({"detail": "Invalid category"}, status=400)
-        created_tokens = []
-        max_position = Token.objects.filter(category_id=category_id).aggregate(Max('queue_position'))['queue_position__max'] or 0
-        for i in range(count):
-            token = Token.objects.create(
-                category=category,
-                status=status_val,
-                issued_at=timezone.now(),
-                created_by=request.user if request.user.is_authenticated else None,
-                source="admin",
-                queue_position=max_position + i + 1,
-            )
-            expires_at = timezone.now() + timedelta(hours=24)
-            qr_data = token.token_id
-            color = category.color if hasattr(category, "color") else "#007BFF"
-            qr_buffer = generate_colored_qr_code(qr_data, color)
-            file_name = f"qr_{token.token_id}.png"
-            qr_code = QRCode.objects.create(
-                token=token,
-                category=category,
-                expires_at=expires_at,
-                data=qr_data,
-            )
-            qr_code.image.save(file_name, ContentFile(qr_buffer.getvalue()), save=True)
-            created_tokens.append({
+        created_by = request.user if request.user.is_authenticated else None
+        batches = bulk_issue_tokens(category, count, status=status_val, created_by=created_by, source="admin")
+
+        def serialize(issued):
+            return [{
                 "token_id": token.token_id,
                 "status": token.status,
                 "category": {
@@ -347,32 +436,63 @@ class TokenViewSet(viewsets.ModelViewSet):
                 },
                 "queue_position": token.queue_position,
                 "qr_image": request.build_absolute_uri(qr_code.image.url) if qr_code.image else None,
-            })
+            } for token, qr_code in issued]
+
+        stream = request.data.get("stream") or request.query_params.get("stream")
+        if str(stream).lower() in ("1", "true", "yes"):
+            # Newline-delimited JSON: one progress line per chunk, then the created tokens
+            def events():
+                created = []
+                for done, total, issued in batches:
+                    created.extend(serialize(issued))
+                    yield json.dumps({"event": "progress", "done": done, "total": total}) + "\n"
+                yield json.dumps({"event": "done", "created": created, "count": len(created)}) + "\n"
+            return StreamingHttpResponse(events(), content_type="application/x-ndjson", status=status.HTTP_201_CREATED)
+
+        created_tokens = []
+        for _done, _total, issued in batches:
+            created_tokens.extend(serialize(issued))
         return Response({"created": created_tokens, "count": len(created_tokens)}, status=status.HTTP_201_CREATED)
 
     @action(detail=False, methods=["get"])
     def live_queue(self, request):
         # Fetch all tokens with status "waiting"
-        tokens = Token.objects.filter(status="waiting").order_by("queue_position")
+        engine = get_engine()
+        if engine is not None:
+            tokens = [record.as_token() for record in engine.tokens()]
+        else:
+            tokens = (
+                Token.objects.filter(status="waiting")
+                .prefetch_related(Prefetch("qrcodes", queryset=QRCode.objects.order_by("-id")))
+                .order_by("queue_position")
+            )
+        config = get_config()
         # Group tokens by category
         categories = {}
+        estimators = {}
         for token in tokens:
-            cat_id = token.category.id
+            cat_id = token.category_id
             if cat_id not in categories:
+                category = config.category(cat_id)
                 categories[cat_id] = {
                     "category": {
-                        "id": token.category.id,
-                        "name": token.category.name,
+                        "id": category.id,
+                        "name": category.name,
                     },
                     "tokens": [],
                 }
-            qr_code = QRCode.objects.filter(token=token).order_by('-id').first()
+                estimators[cat_id] = WaitEstimator(cat_id)
+            # Each token has a single QR; prefetched newest-first for tokens from before that
+            qr_code = getattr(token, "qr_code", None) if engine is not None else next(iter(token.qrcodes.all()), None)
+            # The list holds every waiting token in order, so its length is the number ahead
+            ahead = len(categories[cat_id]["tokens"])
             categories[cat_id]["tokens"].append({
                 "token_id": token.token_id,
                 "status": token.status,
                 "queue_position": token.queue_position,
                 "issued_at": token.issued_at,
                 "qr_image": request.build_absolute_uri(qr_code.image.url) if qr_code and qr_code.image else None,
+                **estimators[cat_id].payload(ahead),
             })
         return Response({"live_queue": list(categories.values())})
 
@@ -401,13 +521,13 @@ class TokenViewSet(viewsets.ModelViewSet):
             return Response({"verified": False, "detail": "Token not found."}, status=404)
 
         qr_code = QRCode.objects.filter(token=token).order_by("-id").first()
-        verified = token.status in ["waiting", "called"]
+        verified = token.status in ["waiting", "called"] and not token.qr_expired
 
       elif qr_code_id:
         try:
             qr_code = QRCode.objects.get(id=qr_code_id)
             token = qr_code.token
-            verified = token.status in ["waiting", "called"]
+            verified = token.status in ["waiting", "called"] and not qr_code.expired
         except QRCode.DoesNotExist:
             # ❌ Log failed scan
             QRScan.objects.create(
@@ -465,6 +585,8 @@ class TokenViewSet(viewsets.ModelViewSet):
                 "generation_start_time": settings.generation_start_time,
                 "generation_end_time": settings.generation_end_time,
                 "daily_reset": settings.daily_reset,
+                "reset_time": settings.reset_time,
+                "last_reset_at": settings.last_reset_at,
             })
         elif request.method == "POST":
             data = request.data
@@ -495,6 +617,16 @@ class TokenViewSet(viewsets.ModelViewSet):
                     settings.generation_end_time = val
             if "daily_reset" in data:
                 settings.daily_reset = data["daily_reset"]
+            if "reset_time" in data:
+                val = data["reset_time"]
+                if isinstance(val, str):
+                    parts = val.split(":")
+                    h = int(parts[0])
+                    m = int(parts[1])
+                    s = int(parts[2]) if len(parts) > 2 else 0
+                    settings.reset_time = time(hour=h, minute=m, second=s)
+                else:
+                    settings.reset_time = val
             settings.save()
             return Response({"success": True, "settings": {
                 "size": settings.size,
@@ -504,6 +636,8 @@ class TokenViewSet(viewsets.ModelViewSet):
                 "generation_start_time": settings.generation_start_time,
                 "generation_end_time": settings.generation_end_time,
                 "daily_reset": settings.daily_reset,
+                "reset_time": settings.reset_time,
+                "last_reset_at": settings.last_reset_at,
             }})
 
     @action(detail=False, methods=["get"], url_path="staff-queue")
@@ -511,7 +645,10 @@ class TokenViewSet(viewsets.ModelViewSet):
         user = request.user
         if hasattr(user, "role") and user.role == "staff":
             staff_categories = getattr(user, "categories", None)
-            if staff_categories:
+            engine = get_engine()
+            if staff_categories and engine is not None:
+                tokens = [record.as_token() for record in engine.tokens(set(staff_categories.values_list("pk", flat=True)))]
+            elif staff_categories:
                 tokens = Token.objects.filter(category__in=staff_categories.all(), status="waiting").order_by("queue_position")
             else:
                 tokens = Token.objects.none()
@@ -551,33 +688,83 @@ class TokenViewSet(viewsets.ModelViewSet):
         if not staff_categories or staff_categories.count() == 0:
             return Response({"detail": "You are not assigned to any category."}, status=403)
 
-        # Complete the current called token (if any)
-        current_token = Token.objects.filter(
-            category__in=staff_categories.all(),
-            status="called"
-        ).order_by("queue_position").first()
-        if current_token:
-            current_token.status = "completed"
-            current_token.save(update_fields=["status"])
-
-        # Call the next waiting token
-        next_token = Token.objects.filter(
-            category__in=staff_categories.all(),
-            status="waiting"
-        ).order_by("queue_position").first()
+        # Complete this staff member's called token and call the next waiting one in one transaction;
+        # staff seated at a desk are served through it
+        counter = Counter.objects.filter(staff=user, is_active=True).first()
+        if counter is not None:
+            result = counter_call_next(counter.pk, called_by=user)
+        else:
+            category_ids = list(staff_categories.values_list("pk", flat=True))
+            result = dispatch_next(category_ids, called_by=user, complete=called_tokens(category_ids, user))
+        next_token = result.token
         if not next_token:
             return Response({"detail": "No waiting tokens available."}, status=status.HTTP_200_OK)
 
-        next_token.status = "called"
-        next_token.save(update_fields=["status"])
-
+        category = get_config().category(next_token.category_id)
         return Response({
             "token_id": next_token.token_id,
-            "category": next_token.category.id if next_token.category else None,
-            "category_name": next_token.category.name if next_token.category else None,
+            "category": category.id,
+            "category_name": category.name,
             "status": next_token.status,
         }, status=status.HTTP_200_OK)
 
+class CounterViewSet(viewsets.ModelViewSet):
+    queryset = Counter.objects.select_related("current_token").prefetch_related("categories")
+    serializer_class = CounterSerializer
+    permission_classes = [IsAuthenticated]
+
+    def _respond(self, counter_id, token, **extra):
+        counter = Counter.objects.get(pk=counter_id)
+        return Response(dict(display_payload(counter, token), **extra))
+
+    @action(detail=True, methods=["post"], url_path="call-next")
+    def call_next(self, request, pk=None):
+        try:
+            result = counter_call_next(pk, called_by=request.user)
+        except CounterError as e:
+            return Response({"detail": str(e)}, status=404)
+        return self._respond(pk, result.token, completed=result.completed)
+
+    @action(detail=True, methods=["post"])
+    def complete(self, request, pk=None):
+        try:
+            completed = counter_complete(pk)
+        except CounterError as e:
+            return Response({"detail": str(e)}, status=404)
+        return self._respond(pk, None, completed=completed)
+
+    @action(detail=True, methods=["post"])
+    def recall(self, request, pk=None):
+        try:
+            token = counter_recall(pk)
+        except CounterError as e:
+            return Response({"detail": str(e)}, status=400)
+        return self._respond(pk, token)
+
+    @action(detail=True, methods=["post"])
+    def transfer(self, request, pk=None):
+        """POST {"counter": id} to hand the token to another desk, or {"category": id} to requeue it there."""
+        to_category = None
+        if request.data.get("category"):
+            try:
+                to_category = get_config().category(request.data["category"])
+            except Category.DoesNotExist:
+                return Response({"detail": "Invalid category"}, status=400)
+        to_counter = request.data.get("counter") or None
+        try:
+            token = counter_transfer(pk, to_counter_id=to_counter, to_category=to_category)
+        except CounterError as e:
+            return Response({"detail": str(e)}, status=400)
+        if to_counter is not None:
+            return self._respond(to_counter, token)
+        return Response({
+            "token_id": token.token_id,
+            "status": token.status,
+            "category": {"id": to_category.id, "name": to_category.name},
+            "queue_position": token.queue_position,
+        })
+
+
 class QRCodeViewSet(viewsets.ModelViewSet):
     queryset = QRCode.objects.all().order_by("-generated_at")
     serializer_class = QRCodeSerializer
@@ -612,6 +799,7 @@ class QRCodeViewSet(viewsets.ModelViewSet):
             },
             "queue_position": token.queue_position,
             "qr_image": request.build_absolute_uri(qr_code.image.url) if qr_code and qr_code.image else None,
+            "qr_status": qr_code.render_status if qr_code else None,
         })
     @action(detail=False, methods=["post"])
     def bulk_generate(self, request):
@@ -675,19 +863,20 @@ class QRScanViewSet(viewsets.ModelViewSet):
                 token = Token.objects.get(id=token_id)
             except Token.DoesNotExist:
                 return Response({"error": "Invalid token ID"}, status=400)
+            scanned_by = request.user if request.user.is_authenticated else None
             scan = QRScan.objects.create(
                 qr=None,
-                scanned_by=request.user,
+                scanned_by=scanned_by,
                 ip_address=request.META.get("REMOTE_ADDR"),
                 user_agent=request.META.get("HTTP_USER_AGENT", ""),
                 device_type=device_type,
                 verification_status="MANUAL",
-                token=token,
             )
-            # Mark token and QR as completed
-            token.status = "completed"
-            token.save()
-            QRCode.objects.filter(token=token).update(status="completed")
+            # A token scanned twice, or finished meanwhile, is completed only once
+            if complete_tokens([token.pk], actor_id=scanned_by.pk if scanned_by else None):
+                token.status = "completed"
+            else:
+                token.refresh_from_db(fields=["status"])
             return Response({
                 "scan": self.get_serializer(scan).data,
                 "token_status": token.status
@@ -697,17 +886,14 @@ class QRScanViewSet(viewsets.ModelViewSet):
         except QRCode.DoesNotExist:
             return Response({"error": "Invalid QR code"}, status=404)
         token = qr.token
-        verification_status = "SUCCESS"
-        if qr.expires_at and qr.expires_at < timezone.now():
-            verification_status = "FAILED"
+        verification_status = "FAILED" if qr.expired else "SUCCESS"
         scan = QRScan.objects.create(
             qr=qr,
-            scanned_by=request.user,
+            scanned_by=request.user if request.user.is_authenticated else None,
             ip_address=request.META.get("REMOTE_ADDR"),
             user_agent=request.META.get("HTTP_USER_AGENT", ""),
             device_type=device_type,
             verification_status=verification_status,
-            token=token,
         )
         return Response({
             "scan": self.get_serializer(scan).data,
@@ -895,28 +1081,89 @@ def queue_emergency(request):
     if action not in ["pause", "resume", "clear"]:
         return Response({"error": "Invalid action"}, status=400)
 
-    tokens_qs = Token.objects.all()
-    if category_id:
-        tokens_qs = tokens_qs.filter(category_id=category_id)
-
+    actor_id = request.user.pk if request.user.is_authenticated else None
     if action == "pause":
-        tokens_qs.filter(status__in=["waiting", "called"]).update(status="waiting")
-        return Response({"status": "paused", "affected": tokens_qs.count()})
+        return Response({"status": "paused", "affected": pause_queue(category_id, actor_id=actor_id)})
     elif action == "resume":
-        # Set first waiting token per category to "called", rest remain "waiting"
-        categories = tokens_qs.values_list("category_id", flat=True).distinct()
-        affected = 0
-        for cat_id in categories:
-            waiting = tokens_qs.filter(category_id=cat_id, status="waiting").order_by("queue_position")
-            first = waiting.first()
-            if first:
-                first.status = "called"
-                first.save()
-                affected += 1
-        return Response({"status": "resumed", "affected": affected})
+        # First waiting token of each category is called, the rest stay waiting
+        return Response({"status": "resumed", "affected": resume_heads(category_id, actor_id=actor_id)})
     elif action == "clear":
-        count = tokens_qs.count()
-        tokens_qs.delete()
-        return Response({"status": "cleared", "affected": count})
+        return Response({"status": "cleared", "affected": clear_queue(category_id)})
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def issuance_throttle_stats(request):
+    return Response({"throttled": throttled_counts()})
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def token_pool_stats(request):
+    available = dict(
+        PooledToken.objects.values_list("category_id").annotate(count=Count("id")).values_list("category_id", "count")
+    )
+    return Response([
+        {
+            "category": {"id": pool.category.id, "name": pool.category.name},
+            "enabled": pool.enabled,
+            "available": available.get(pool.category_id, 0),
+            "size": pool.size,
+            "refill_threshold": pool.refill_threshold,
+            "hits": pool.hits,
+            "misses": pool.misses,
+            "hit_rate": pool.hit_rate,
+            "last_refilled_at": pool.last_refilled_at,
+        }
+        for pool in TokenPool.objects.select_related("category").order_by("category__name")
+    ])
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def now_serving_display(request):
+    return Response({"now_serving": now_serving()})
+
+
+@api_view(["GET", "POST"])
+@permission_classes([IsAdminUser])
+def queue_engine_check(request):
+    """Diff the in-memory queue engine against the database; POST rebuilds it from the database."""
+    engine = get_engine()
+    if engine is None:
+        return Response({"enabled": False})
+    if request.method == "POST":
+        engine.rebuild()
+    diffs = engine.check()
+    return Response({
+        "enabled": True,
+        "active_tokens": len(engine.records),
+        "consistent": not diffs,
+        "differences": [
+            {"token_id": token_id, "field": field, "engine": ours, "database": theirs}
+            for _pk, token_id, field, ours, theirs in diffs
+        ],
+    })
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def scheduler_stats(request):
+    """Per-category scheduler state and its recent decisions, newest first."""
+    return Response(scheduler.stats())
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def wait_statistics(request):
+    """Streaming arrival, call-interval and service-time statistics per category and per desk."""
+    return Response({
+        "categories": [
+            {"category": {"id": category.id, "name": category.name}, **estimates.category_summary(category.id)}
+            for category in get_config().categories.values()
+        ],
+        "counters": [
+            {"counter": {"id": pk, "name": name}, **estimates.counter_summary(pk)}
+            for pk, name in Counter.objects.filter(is_active=True).values_list("pk", "name")
+        ],
+    })